@@ -0,0 +1,812 @@
+'''
+Micro-benchmarks and a load generator.
+Usage: python benchmark.py [--json PATH] [--compare PATH] [name ...]
+With --json the results (of the benchmarks that return them) are saved,
+to --compare them with a later run.
+'''
+import os
+import sys
+import json
+import time
+import random
+import optparse
+import threading
+
+from rowstore import RowStore, group_rows
+from server import Server, Document
+from delta import make_delta, worth
+
+
+def timeit(function, repeat):
+    '''
+    Mean time, in microseconds, of a function called repeat times
+    '''
+    start = time.time()
+    for i in xrange(repeat):
+        function(i)
+    return (time.time() - start) * 1e6 / repeat
+
+
+def bench_rowstore(sizes=(1000, 10000, 100000), repeat=2000):
+    '''
+    Document.write edits: list slicing x RowStore
+    '''
+    print '%-10s %-10s %14s %14s' % ('rows', 'edit', 'list (us)', 'store (us)')
+    for size in sizes:
+        rand = random.Random(size)
+        positions = [rand.randint(0, size - 1) for i in xrange(repeat)]
+        holder = {}
+
+        # the old Document.write: rebuild the list on every edit
+        def list_replace(i):
+            row = positions[i]
+            rows = holder['rows']
+            holder['rows'] = rows[:row] + ['changed'] + rows[row+1:]
+
+        def list_insert(i):
+            row = positions[i]
+            rows = holder['rows']
+            holder['rows'] = rows[:row] + ['new', 'row'] + rows[row+1:]
+
+        def store_replace(i):
+            holder['store'].splice(positions[i], positions[i] + 1, ['changed'])
+
+        def store_insert(i):
+            holder['store'].splice(positions[i], positions[i] + 1,
+                ['new', 'row'])
+
+        for edit, list_edit, store_edit in (
+                ('replace', list_replace, store_replace),
+                ('insert', list_insert, store_insert)):
+            holder['rows'] = ['row %i' % i for i in xrange(size)]
+            holder['store'] = RowStore(holder['rows'])
+            print '%-10i %-10s %14.2f %14.2f' % (
+                size, edit,
+                timeit(list_edit, repeat), timeit(store_edit, repeat))
+
+
+class CountingProxy(object):
+    '''
+    Call a local Server like a Pyro proxy: count calls and sleep a latency
+    '''
+    def __init__(self, server, latency):
+        self._server = server
+        self._latency = latency
+        self.calls = 0
+
+    def __getattr__(self, name):
+        method = getattr(self._server, name)
+
+        def call(*args):
+            self.calls += 1
+            time.sleep(self._latency)
+            return method(*args)
+        return call
+
+
+def bench_fetch(sizes=(100, 1000, 5000), latency=0.0002):
+    '''
+    Round trips to open/refresh a document: per row x batched
+    '''
+    print '%-8s %-10s %10s %10s %10s %10s' % (
+        'rows', 'path', 'old calls', 'old (ms)', 'new calls', 'new (ms)')
+    for size in sizes:
+        server = Server()
+        client_uid = server.register_client()
+        document_uid = server.new_document(client_uid)
+        server.write_document(client_uid, document_uid, 0,
+            '\n'.join('row %i' % i for i in xrange(size)))
+
+        def open_old(proxy):
+            count = proxy.get_document_row_count(client_uid, document_uid)
+            return [proxy.get_document_row(client_uid, document_uid, i)
+                for i in xrange(count)]
+
+        def open_new(proxy):
+            return proxy.get_document_snapshot(client_uid, document_uid)
+
+        def refresh_old(proxy):
+            rows = proxy.list_changed_lines(client_uid, document_uid)
+            return [proxy.get_document_row(client_uid, document_uid, i)
+                for i in rows]
+
+        def refresh_new(proxy):
+            rows = proxy.list_changed_lines(client_uid, document_uid)
+            return [proxy.get_document_rows(client_uid, document_uid, *range_)
+                for range_ in group_rows(rows)]
+
+        for path, old, new in (
+                ('open', open_old, open_new),
+                ('refresh', refresh_old, refresh_new)):
+            result = []
+            for function in (old, new):
+                proxy = CountingProxy(server, latency)
+                start = time.time()
+                function(proxy)
+                result += [proxy.calls, (time.time() - start) * 1e3]
+            print '%-8i %-10s %10i %10.1f %10i %10.1f' % (
+                (size, path) + tuple(result))
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+def _poll_load(connect, idle, active, calls):
+    '''
+    Open idle connections, then poll from active threads: a result dict
+    '''
+    opened = []
+    try:
+        for i in xrange(idle):
+            opened.append(connect())
+    except Exception, exp:
+        print '  %i connections opened: %s' % (len(opened), exp)
+
+    proxy = connect()
+    client_uid = proxy.register_client()
+    document_uid = proxy.new_document(client_uid)
+    proxy.write_document(client_uid, document_uid, 0,
+        '\n'.join('row %i' % i for i in xrange(100)))
+    latencies = []
+
+    def poll():
+        proxy = connect()
+        revision = -1
+        for i in xrange(calls):
+            start = time.time()
+            changes = proxy.get_changes_since(client_uid, document_uid,
+                revision)
+            latencies.append(time.time() - start)
+            revision = changes['revision']
+
+    threads = [threading.Thread(target=poll) for i in xrange(active)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    return {
+        'connections': len(opened),
+        'calls/s': len(latencies) / elapsed,
+        'p50 (ms)': percentile(latencies, 50) * 1e3,
+        'p99 (ms)': percentile(latencies, 99) * 1e3,
+    }
+
+
+def bench_transport(idle=2000, active=8, calls=500):
+    '''
+    Idle connections and polling latency: framed transport x Pyro daemon
+    '''
+    import transport
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError):
+        pass
+
+    results = {}
+    server = Server()
+    framed = transport.FramedServer(server, ('127.0.0.1', 0))
+    thread = threading.Thread(target=framed.serve_forever)
+    thread.start()
+    try:
+        results['framed'] = _poll_load(
+            lambda: transport.FramedProxy(framed.address),
+            idle, active, calls)
+    finally:
+        framed.stop()
+        thread.join()
+        server.close()
+
+    try:
+        import Pyro4
+    except ImportError:
+        print '  Pyro4 is not installed: only the framed transport'
+    else:
+        daemon = Pyro4.Daemon(host='127.0.0.1')
+        uri = daemon.register(Server())
+        thread = threading.Thread(target=daemon.requestLoop)
+        thread.daemon = True
+        thread.start()
+
+        def connect():
+            proxy = Pyro4.Proxy(uri)
+            proxy._pyroBind()
+            return proxy
+        results['pyro'] = _poll_load(connect, idle, active, calls)
+        daemon.shutdown()
+
+    print '%-8s %12s %10s %10s %10s' % (
+        'server', 'connections', 'calls/s', 'p50 (ms)', 'p99 (ms)')
+    for name, result in sorted(results.items()):
+        print '%-8s %12i %10.0f %10.2f %10.2f' % (name,
+            result['connections'], result['calls/s'],
+            result['p50 (ms)'], result['p99 (ms)'])
+    return results
+
+
+def bench_cursor(sizes=(100, 10000, 1000000), repeat=200):
+    '''
+    Cursor row on every key: counting lines x client.CursorRow
+    '''
+    try:
+        import gtk
+        import client
+    except ImportError, exp:
+        print '  the client cannot be imported: %s' % exp
+        return
+
+    print '%-10s %14s %14s' % ('rows', 'count (us)', 'tracked (us)')
+    for size in sizes:
+        buff = gtk.TextBuffer()
+        buff.set_text('\n'.join('row %i' % i for i in xrange(size)))
+        # typing at the end: the worst case of counting
+        buff.place_cursor(buff.get_end_iter())
+        cursor = client.CursorRow(buff)
+
+        # the old ClientGui._get_cursor_row
+        def count(i):
+            buff.insert_at_cursor('x')
+            position = buff.get_property('cursor-position')
+            text = buff.get_text(buff.get_start_iter(),
+                buff.get_iter_at_offset(position))
+            return text.count('\n')
+
+        def tracked(i):
+            buff.insert_at_cursor('x')
+            return cursor.row
+
+        print '%-10i %14.2f %14.2f' % (size,
+            timeit(count, repeat), timeit(tracked, repeat))
+
+
+def bench_wire(sizes=(1000, 10000, 100000), repeat=5):
+    '''
+    Bytes and time to send a snapshot: JSON, pickle x wire.py
+    '''
+    import json
+    import pickle
+    import wire
+
+    formats = [
+        ('json', lambda rows: json.dumps(rows, separators=(',', ':')),
+            json.loads),
+        ('pickle', lambda rows: pickle.dumps(rows, 2), pickle.loads),
+        ('wire', lambda rows: wire.encode(rows, None), wire.decode),
+        ('wire+zlib', wire.encode, wire.decode),
+    ]
+    try:
+        import serpent # the default serializer of Pyro4
+        formats.insert(1, ('serpent', serpent.dumps, serpent.loads))
+    except ImportError:
+        pass
+
+    print '%-8s %-10s %12s %12s %12s' % (
+        'rows', 'format', 'bytes', 'encode (ms)', 'decode (ms)')
+    rand = random.Random(0)
+    for size in sizes:
+        rows = [u'row %i: %s' % (i, ' '.join(rand.choice(['some', 'text',
+            u'caf\xe9', 'of', 'a', 'document']) for j in xrange(8)))
+            for i in xrange(size)]
+        for name, dumps, loads in formats:
+            data = dumps(rows)
+            encode = timeit(lambda i: dumps(rows), repeat) / 1e3
+            decode = timeit(lambda i: loads(data), repeat) / 1e3
+            print '%-8i %-10s %12i %12.2f %12.2f' % (size, name, len(data),
+                encode, decode)
+
+
+def memory():
+    '''
+    Resident memory of the process, in bytes (the peak without /proc)
+    '''
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def latencies(function, repeat, budget, setup=None):
+    '''
+    Seconds of each call of function(i), until repeat calls or budget
+    seconds (slow calls on big documents). setup(i) is not timed.
+    '''
+    times = []
+    deadline = time.time() + budget
+    for i in xrange(repeat):
+        if setup is not None:
+            setup(i)
+        start = time.time()
+        function(i)
+        times.append(time.time() - start)
+        if time.time() > deadline:
+            break
+    return times
+
+
+def summary(times):
+    return {
+        'calls': len(times),
+        'mean_us': sum(times) * 1e6 / max(len(times), 1),
+        'p50_us': percentile(times, 50) * 1e6,
+        'p99_us': percentile(times, 99) * 1e6,
+    }
+
+
+def bench_document(sizes=(100, 1000, 10000, 100000, 1000000), repeat=2000,
+        budget=2.0):
+    '''
+    Document.write, lock, unlock_all and Server.list_changed_lines by
+    document size
+    '''
+    print '%-8s %-12s %8s %12s %12s %12s' % (
+        'rows', 'operation', 'calls', 'mean (us)', 'p50 (us)', 'p99 (us)')
+    results = {}
+    for size in sizes:
+        before = memory()
+        server = Server()
+        client_uid = server.register_client()
+        other_uid = server.register_client()
+        document_uid = server.new_document(client_uid)
+        document = server._get_document(document_uid)
+        document.rows = ['row %i of the document' % i for i in xrange(size)]
+        result = {'memory_bytes': memory() - before}
+
+        rand = random.Random(size)
+        positions = [rand.randint(0, size - 1) for i in xrange(repeat)]
+
+        def write(i):
+            document.write(positions[i], 'row %i changed' % i)
+
+        def write_rows(i):
+            # one row more: every row below moves
+            document.write(positions[i], 'row %i\nsplit' % i)
+
+        def lock(i):
+            document.lock(client_uid, positions[i])
+
+        def lock_some(i):
+            # a client with a few locks (the ones of lock are kept)
+            for row in positions[i:i + 10]:
+                if document._locks.owner(row) is None:
+                    document.lock(other_uid, row)
+
+        def unlock_all(i):
+            document.unlock_all(other_uid)
+
+        def list_changed_lines(i):
+            server.list_changed_lines(client_uid, document_uid)
+
+        for name, function, setup in (
+                ('write', write, None),
+                ('write_rows', write_rows, None),
+                ('lock', lock, None),
+                ('unlock_all', unlock_all, lock_some),
+                ('list_changed_lines', list_changed_lines, None)):
+            result[name] = summary(latencies(function, repeat, budget,
+                setup))
+            print '%-8i %-12s %8i %12.2f %12.2f %12.2f' % (size, name[:12],
+                result[name]['calls'], result[name]['mean_us'],
+                result[name]['p50_us'], result[name]['p99_us'])
+        print '%-8i %-12s %8.1f MB' % (size, 'memory',
+            result['memory_bytes'] / 1e6)
+        results[str(size)] = result
+    return results
+
+
+def _typist(address, document_uid, row, keys, poll_every, think, times,
+        errors):
+    '''
+    A client typing in its row, like client.RowSender (a lock_write or
+    lock_write_delta for each key), reading the changes of the others
+    every poll_every keys
+    '''
+    import transport
+    proxy = transport.FramedProxy(address)
+    try:
+        client_uid = proxy.register_client()
+        proxy.open_document(client_uid, document_uid)
+        revision = -1
+        text = known = ''
+        for key in xrange(keys):
+            text += random.choice('abcdefghij ')
+            delta = make_delta(known, text)
+            if known and worth(delta, text):
+                op = ('lock_write_delta', document_uid, row, delta)
+            else:
+                op = ('lock_write', document_uid, row, text)
+            start = time.time()
+            if not proxy.execute_batch(client_uid, [op])[0]:
+                errors.append(row)
+            times.append(time.time() - start)
+            known = text
+            if key % poll_every == poll_every - 1:
+                start = time.time()
+                revision = proxy.get_changes_since(client_uid, document_uid,
+                    revision, True)['revision']
+                times.append(time.time() - start)
+            if think:
+                time.sleep(think)
+        proxy.execute_batch(client_uid, [('unlock', document_uid, row)])
+    finally:
+        proxy.close()
+
+
+def bench_load(clients=(1, 8, 32), keys=300, poll_every=10, think=0,
+        rows=10000):
+    '''
+    Clients typing at once in a document, through the framed transport:
+    throughput, latency of the calls and memory of the process
+    '''
+    import transport
+    print '%-8s %10s %10s %10s %10s %10s' % (
+        'clients', 'calls', 'calls/s', 'p50 (ms)', 'p99 (ms)', 'RSS (MB)')
+    results = {}
+    for count in clients:
+        server = Server()
+        framed = transport.FramedServer(server, ('127.0.0.1', 0))
+        thread = threading.Thread(target=framed.serve_forever)
+        thread.start()
+        try:
+            client_uid = server.register_client()
+            document_uid = server.new_document(client_uid)
+            server.write_document(client_uid, document_uid, 0,
+                '\n'.join('row %i' % i for i in xrange(rows)))
+            times = []
+            errors = []
+            # each one in a row of its own, spread in the document
+            typists = [threading.Thread(target=_typist,
+                args=(framed.address, document_uid, i * rows // count, keys,
+                    poll_every, think, times, errors))
+                for i in xrange(count)]
+            start = time.time()
+            for typist in typists:
+                typist.start()
+            for typist in typists:
+                typist.join()
+            elapsed = time.time() - start
+            result = {
+                'calls': len(times),
+                'calls_per_s': len(times) / elapsed,
+                'p50_ms': percentile(times, 50) * 1e3,
+                'p99_ms': percentile(times, 99) * 1e3,
+                'denied': len(errors),
+                'memory_bytes': memory(),
+                'server': server.get_stats()['methods'],
+            }
+        finally:
+            framed.stop()
+            thread.join()
+            server.close()
+        print '%-8i %10i %10.0f %10.2f %10.2f %10.1f' % (count,
+            result['calls'], result['calls_per_s'], result['p50_ms'],
+            result['p99_ms'], result['memory_bytes'] / 1e6)
+        results[str(count)] = result
+    return results
+
+
+def size_of(value, seen=None):
+    '''
+    Bytes of an object and of everything it has (a rough count)
+    '''
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(size_of(key, seen) + size_of(item, seen)
+            for key, item in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(size_of(item, seen) for item in value)
+    elif hasattr(value, '__slots__') or hasattr(value, '__dict__'):
+        if hasattr(value, '__dict__'):
+            size += size_of(value.__dict__, seen)
+        for name in getattr(type(value), '__slots__', ()):
+            if hasattr(value, name):
+                size += size_of(getattr(value, name), seen)
+    return size
+
+
+def bench_memory(sizes=(1000, 10000, 100000, 1000000), edits=1000):
+    '''
+    Bytes by row: a list of rows x RowStore (packed, after edits, compacted)
+    '''
+    print '%-8s %10s %10s %10s %10s %10s' % (
+        'rows', 'text', 'list', 'packed', 'edited', 'compacted')
+    results = {}
+    rand = random.Random(0)
+    for size in sizes:
+        rows = [u'row %i: %s' % (i, ' '.join(rand.choice(['some', 'text',
+            u'caf\xe9', 'of', 'a', 'document']) for j in xrange(4)))
+            for i in xrange(size)]
+        result = {
+            'text': sum(len(row.encode('utf-8')) for row in rows),
+            'list': size_of(rows),
+        }
+        store = RowStore(rows)
+        result['packed'] = size_of(store)
+        for i in xrange(edits):
+            row = rand.randint(0, size - 1)
+            store[row] = store[row] + u' edited'
+        result['edited'] = size_of(store)
+        store.compact()
+        result['compacted'] = size_of(store)
+        result = dict((key, value / float(size))
+            for key, value in result.items())
+        print '%-8i %10.1f %10.1f %10.1f %10.1f %10.1f' % (size,
+            result['text'], result['list'], result['packed'],
+            result['edited'], result['compacted'])
+        results[str(size)] = result
+    return results
+
+
+def bench_open(sizes=(100000, 1000000, 4000000)):
+    '''
+    Open a saved document: read and split x mapped snapshot (storage.py)
+    '''
+    import shutil
+    import tempfile
+    import storage
+
+    print '%-8s %-8s %10s %12s %12s' % (
+        'rows', 'snapshot', 'MB', 'open (ms)', 'rows (MB)')
+    results = {}
+    for size in sizes:
+        path = tempfile.mkdtemp()
+        try:
+            saved = storage.Storage(path)
+            document = Document(u'Dbenchmark')
+            document.rows = [u'%i: a line of a log, like most of them' % i
+                for i in xrange(size)]
+            saved.snapshot(document)
+            saved.close()
+            del document
+            megabytes = sum(os.path.getsize(os.path.join(path, name))
+                for name in os.listdir(path)) / 1e6
+
+            result = {}
+            for name, mapped in (('read', False), ('mapped', True)):
+                if not mapped:
+                    for name_ in os.listdir(path):
+                        if name_.endswith('.idx'):
+                            os.rename(os.path.join(path, name_),
+                                os.path.join(path, name_ + '.off'))
+                else:
+                    for name_ in os.listdir(path):
+                        if name_.endswith('.off'):
+                            os.rename(os.path.join(path, name_),
+                                os.path.join(path, name_[:-4]))
+                loader = storage.Storage(path)
+                start = time.time()
+                document = loader.load(Document(u'Dbenchmark'))
+                document.rows[size // 2] # a row in the middle
+                elapsed = time.time() - start
+                result[name] = {
+                    'open_ms': elapsed * 1e3,
+                    # objects in memory (not the mapped file)
+                    'memory_bytes': size_of(document.rows),
+                }
+                loader.close()
+                del document
+                print '%-8i %-8s %10.1f %12.1f %12.1f' % (size, name,
+                    megabytes, elapsed * 1e3,
+                    result[name]['memory_bytes'] / 1e6)
+            results[str(size)] = result
+        finally:
+            shutil.rmtree(path)
+    return results
+
+
+def bench_viewers(viewers=(10, 100), rows=10000, rounds=50):
+    '''
+    Viewers polling a document written between polls: editors x read-only
+    clients (a snapshot by revision, shared), through the framed transport
+    '''
+    import transport
+    print '%-8s %-10s %12s %12s' % ('viewers', 'mode', 'polls/s',
+        'encoded')
+    results = {}
+    for count in viewers:
+        result = {}
+        for mode, read_only in (('editor', False), ('read-only', True)):
+            server = Server()
+            framed = transport.FramedServer(server, ('127.0.0.1', 0))
+            thread = threading.Thread(target=framed.serve_forever)
+            thread.start()
+            try:
+                editor = server.register_client()
+                document_uid = server.new_document(editor)
+                server.write_document(editor, document_uid, 0,
+                    '\n'.join('row %i' % i for i in xrange(rows)))
+                proxies = []
+                for i in xrange(count):
+                    proxy = transport.FramedProxy(framed.address)
+                    client_uid = proxy.register_client()
+                    proxy.open_document(client_uid, document_uid, read_only)
+                    proxies.append((proxy, client_uid))
+                revision = server.get_changes_since(editor, document_uid,
+                    -1)['revision']
+                start = time.time()
+                for i in xrange(rounds):
+                    server.write_document(editor, document_uid, i % rows,
+                        'row %i changed' % i)
+                    for proxy, client_uid in proxies:
+                        proxy.get_changes_since(client_uid, document_uid,
+                            revision)
+                    revision += 1
+                elapsed = time.time() - start
+                for proxy, client_uid in proxies:
+                    proxy.close()
+            finally:
+                framed.stop()
+                thread.join()
+                server.close()
+            polls = count * rounds
+            result[mode] = {
+                'polls_per_s': polls / elapsed,
+                'encoded': polls - framed.results.hits,
+            }
+            print '%-8i %-10s %12.0f %12i' % (count, mode,
+                result[mode]['polls_per_s'], result[mode]['encoded'])
+        results[str(count)] = result
+    return results
+
+
+def bench_pipeline(workers=(1, 4, 16), writes=2000, rows=1000):
+    '''
+    Bulk writes by clientcore.ClientCore over the framed transport: calls
+    in flight at once by the number of workers
+    '''
+    import transport
+    from clientcore import ClientCore
+    print '%-8s %10s %10s' % ('workers', 'writes/s', 'total (s)')
+    results = {}
+    for count in workers:
+        server = Server()
+        framed = transport.FramedServer(server, ('127.0.0.1', 0))
+        thread = threading.Thread(target=framed.serve_forever)
+        thread.start()
+        try:
+            core = ClientCore(lambda: transport.FramedProxy(framed.address),
+                workers=count)
+            document_uid = core.new_document()
+            core.call('write_document', document_uid, 0,
+                '\n'.join('row %i' % i for i in xrange(rows))).result()
+            start = time.time()
+            futures = [core.call('lock_and_write_document', document_uid,
+                i % rows, 'row %i written' % i) for i in xrange(writes)]
+            for future in futures:
+                future.result()
+            elapsed = time.time() - start
+            core.close()
+        finally:
+            framed.stop()
+            thread.join()
+            server.close()
+        results[str(count)] = {'writes_per_s': writes / elapsed}
+        print '%-8i %10.0f %10.2f' % (count, writes / elapsed, elapsed)
+    return results
+
+
+def bench_import(sizes=(100000, 1000000)):
+    '''
+    Load a big text over the framed transport: one write_document x a
+    streaming import (clientcore), with the latency of another client
+    reading the document meanwhile
+    '''
+    import transport
+    from clientcore import ClientCore
+    print '%-8s %-8s %10s %14s' % ('rows', 'path', 'total (s)',
+        'max read (ms)')
+    results = {}
+    for size in sizes:
+        lines = ['%i: a line of a log, like most of them' % i
+            for i in xrange(size)]
+        result = {}
+        for path in ('write', 'import'):
+            server = Server()
+            framed = transport.FramedServer(server, ('127.0.0.1', 0))
+            thread = threading.Thread(target=framed.serve_forever)
+            thread.start()
+            connect = lambda: transport.FramedProxy(framed.address)
+            try:
+                core = ClientCore(connect)
+                document_uid = core.new_document()
+                reads = []
+                done = threading.Event()
+
+                def read():
+                    proxy = connect()
+                    client_uid = proxy.register_client()
+                    while not done.is_set():
+                        start = time.time()
+                        proxy.get_document_row(client_uid, document_uid, 0)
+                        reads.append(time.time() - start)
+                    proxy.close()
+                reader = threading.Thread(target=read)
+                reader.start()
+                start = time.time()
+                if path == 'write':
+                    core.call('write_document', document_uid, 0,
+                        '\n'.join(lines)).result()
+                else:
+                    core.import_rows(document_uid, lines)
+                elapsed = time.time() - start
+                done.set()
+                reader.join()
+                core.close()
+            finally:
+                framed.stop()
+                thread.join()
+                server.close()
+            result[path] = {
+                'total_s': elapsed,
+                'max_read_ms': max(reads) * 1e3,
+            }
+            print '%-8i %-8s %10.2f %14.1f' % (size, path, elapsed,
+                max(reads) * 1e3)
+        results[str(size)] = result
+    return results
+
+
+def compare(old, new, path=()):
+    '''
+    Print the numbers of new results that changed from old ones
+    '''
+    if isinstance(new, dict) and isinstance(old, dict):
+        for key in sorted(new):
+            if key in old:
+                compare(old[key], new[key], path + (key,))
+    elif isinstance(new, (int, long, float)) and \
+            isinstance(old, (int, long, float)) and old != new:
+        change = (new - old) * 100.0 / old if old else float('inf')
+        print '%-50s %14.2f %14.2f %+8.1f%%' % ('.'.join(path)[-50:], old,
+            new, change)
+
+
+BENCHMARKS = {
+    'rowstore': bench_rowstore,
+    'fetch': bench_fetch,
+    'transport': bench_transport,
+    'cursor': bench_cursor,
+    'wire': bench_wire,
+    'document': bench_document,
+    'load': bench_load,
+    'memory': bench_memory,
+    'open': bench_open,
+    'viewers': bench_viewers,
+    'pipeline': bench_pipeline,
+    'import': bench_import,
+}
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [options] [name ...]')
+    parser.add_option('--json', metavar='PATH',
+        help='save the results in a JSON file')
+    parser.add_option('--compare', metavar='PATH',
+        help='compare the results with the ones saved in a JSON file')
+    options, names = parser.parse_args()
+
+    results = {}
+    for name in names or sorted(BENCHMARKS):
+        print '== %s ==' % name
+        result = BENCHMARKS[name]()
+        if result is not None:
+            results[name] = result
+    if options.json:
+        with open(options.json, 'w') as output:
+            json.dump(results, output, indent=1, sort_keys=True)
+    if options.compare:
+        with open(options.compare) as saved:
+            print '== compared with %s ==' % options.compare
+            compare(json.load(saved), results)
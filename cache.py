@@ -0,0 +1,168 @@
+'''
+Documents in memory.
+Documents are loaded on demand and the least recently used ones are
+evicted when the cache is over its budget (of documents or of rows).
+Loads and saves go out of the lock: other documents do not wait the disk.
+'''
+import threading
+from collections import OrderedDict
+
+
+class DocumentCache(object):
+    '''
+    An LRU dict of documents: uid -> Document
+    '''
+    def __init__(self, load=None, save=None, can_evict=None,
+            max_documents=None, max_rows=None):
+        self._documents = OrderedDict() # oldest first
+        self._load = load # uid -> Document or None
+        self._save = save # [Document] -> [the ones saved, to evict]
+        self._can_evict = can_evict or (lambda document: True)
+        self._max_documents = max_documents
+        self._max_rows = max_rows
+        self._lock = threading.Lock()
+        self._loading = {} # uid: Event set when it is loaded
+        self._evicting = {} # uid: revision when it was chosen to save
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, uid):
+        return uid in self._documents
+
+    def __len__(self):
+        return len(self._documents)
+
+    def __getitem__(self, uid):
+        document = self.get(uid)
+        if document is None:
+            raise KeyError(uid)
+        return document
+
+    def __setitem__(self, uid, document):
+        with self._lock:
+            self._documents.pop(uid, None)
+            self._documents[uid] = document
+        self.evict()
+
+    def keys(self):
+        return self._documents.keys()
+
+    def values(self):
+        return self._documents.values()
+
+    def peek(self, uid):
+        '''
+        A document if it is in memory (not loaded, not marked as used)
+        '''
+        return self._documents.get(uid)
+
+    def get(self, uid):
+        '''
+        A document from memory, or loaded, or None if it does not exist
+        '''
+        while True:
+            with self._lock:
+                document = self._documents.pop(uid, None)
+                if document is not None:
+                    self.hits += 1
+                    self._documents[uid] = document # the most recently used
+                    self._evicting.pop(uid, None) # used: keep it
+                    return document
+                loading = self._loading.get(uid)
+                if loading is None:
+                    self.misses += 1
+                    if self._load is None:
+                        return None
+                    loading = self._loading[uid] = threading.Event()
+                    break
+            # another thread is loading it
+            loading.wait()
+
+        document = None
+        try:
+            document = self._load(uid)
+        finally:
+            with self._lock:
+                if document is not None:
+                    self._documents[uid] = document
+                del self._loading[uid]
+            loading.set()
+        if document is not None:
+            self.evict()
+        return document
+
+    def _over_budget(self, documents, rows):
+        if self._max_documents is not None and \
+                documents > self._max_documents:
+            return True
+        return self._max_rows is not None and rows > self._max_rows
+
+    def evict(self):
+        '''
+        Remove the least recently used idle documents, until in budget
+        '''
+        if self._load is None:
+            return # nothing could be loaded again
+
+        with self._lock:
+            documents = len(self._documents) - len(self._evicting)
+            rows = 0
+            if self._max_rows is not None:
+                rows = sum(len(document.rows) \
+                    for uid, document in self._documents.items() \
+                    if uid not in self._evicting)
+            if not self._over_budget(documents, rows):
+                return
+            # the last one is the document in use
+            candidates = [document for uid, document in \
+                self._documents.items()[:-1] if uid not in self._evicting]
+
+        # can_evict waits for the document: not inside the cache lock
+        chosen = []
+        for document in candidates:
+            if not self._over_budget(documents, rows):
+                break
+            if not self._can_evict(document):
+                continue
+            chosen.append(document)
+            documents -= 1
+            rows -= len(document.rows)
+
+        evicted = []
+        with self._lock:
+            for document in chosen:
+                uid = document.uid
+                if self._documents.get(uid) is document and \
+                        uid not in self._evicting:
+                    self._evicting[uid] = document.revision
+                    evicted.append(document)
+        if not evicted:
+            return
+
+        saved = []
+        try:
+            if self._save is not None:
+                saved = self._save(evicted)
+            else:
+                saved = evicted
+        finally:
+            idle = set(document for document in saved \
+                if self._can_evict(document))
+            with self._lock:
+                for document in evicted:
+                    # not if it was used or changed while saving
+                    revision = self._evicting.pop(document.uid, None)
+                    if document not in idle or \
+                            revision != document.revision:
+                        continue
+                    del self._documents[document.uid]
+                    self.evictions += 1
+
+    def stats(self):
+        return {
+            'documents': len(self._documents),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -1,9 +1,12 @@
 '''
-A client
+A client: the GTK layer on top of clientcore.ClientCore
 '''
 
 # client x server
 import Pyro4
+from clientcore import ClientCore
+import clientcore
+from delta import make_delta, apply_delta, plan_row_edits
 
 # gui
 import gtk, gtk.glade, gobject
@@ -19,6 +22,28 @@ class LockDenied(Exception):
     pass
 
 
+class CursorRow(object):
+    '''
+    The row of the cursor in a text buffer, kept up to date by the buffer
+    signals: no text is copied to know it (the cost does not grow with the
+    document)
+    '''
+    def __init__(self, buff):
+        self.row = 0
+        self._update(buff)
+        buff.connect('mark-set', self._mark_set)
+        # after the default handler: the text is already changed
+        buff.connect_after('insert-text', self._update)
+        buff.connect_after('delete-range', self._update)
+
+    def _mark_set(self, buff, location, mark):
+        if mark.get_name() == 'insert':
+            self.row = location.get_line()
+
+    def _update(self, buff, *args):
+        self.row = buff.get_iter_at_mark(buff.get_insert()).get_line()
+
+
 class ClientGui(object):
     '''
     GUI part
@@ -39,6 +64,7 @@ class ClientGui(object):
 
         self._gui = gui
         self._text_box = text_box
+        self._cursor = CursorRow(text_box.get_buffer())
 
     def set_title(self, text):
         window = self._gui.get_widget("MainWindow")
@@ -58,14 +84,7 @@ class ClientGui(object):
         '''
         Get the line where the cursor is
         '''
-        buff = widget.get_buffer()
-        cursor_pos = buff.get_property('cursor-position')
-        # interval between the beggining and the actual position
-        initial = buff.get_iter_at_line(0)
-        final = buff.get_iter_at_offset(char_offset=cursor_pos)
-        text = buff.get_text(initial, final)
-        # count the number of linebreaks
-        return text.count('\n')
+        return self._cursor.row
 
     def key_press(self, widget, event):
         line = self._get_cursor_row(widget)
@@ -82,60 +101,138 @@ class ClientGui(object):
     def run(self):
         gtk.mainloop()
 
-from threading import Timer
-
 class Client(ClientGui):
     '''
     Client x Server methods
     '''
     SERVER_HOST = '127.0.0.1'
     SERVER_PORT = 4567
+    OPERATIONS = False # edit by operations (see ot.py), with no row locks
 
     def __init__(self):
-        server = Pyro4.Proxy('PYRO:documents.server@%(host)s:%(port)i' % {
+        uri = 'PYRO:documents.server@%(host)s:%(port)i' % {
                 'host': self.SERVER_HOST,
                 'port': self.SERVER_PORT,
-            })
-        self._uid = server.register_client()
-        self._server = server
-        self._opened_document = None
-        self._timer = None
+            }
+        # Pyro proxies cannot be shared between threads: one by thread
+        self._core = ClientCore(lambda: Pyro4.Proxy(uri),
+            operations=self.OPERATIONS, lost=self._operations_lost)
+        self._uid = self._core.uid
+        self._applying = False # the buffer is changed by the server
 
         self._edit_line = None
         super(Client, self).__init__()
 
-        # thread to update document
-        self._install_worker_to_update()
+        if self.OPERATIONS:
+            buff = self._get_buffer()
+            buff.connect('insert-text', self._text_inserted)
+            buff.connect('delete-range', self._range_deleted)
+
         self.set_title(self._uid)
 
     def _install_worker_to_update(self):
         gobject.timeout_add(5000, self._update_from_server, \
             priority=gobject.PRIORITY_HIGH_IDLE)
 
+    def _install_listener(self):
+        '''
+        Thread waiting changes from server (long poll)
+        '''
+        if self.OPERATIONS:
+            self._core.listen_operations(
+                lambda sender, changes: gobject.idle_add( \
+                    self._apply_operations, sender, changes),
+                lambda sender: gobject.idle_add( \
+                    self._reload_document, sender))
+        else:
+            self._core.listen(
+                lambda changes: gobject.idle_add(self._apply_changes, \
+                    changes),
+                lambda error: gobject.idle_add(self._fallback_to_polling))
+
+    def _apply_operations(self, sender, changes):
+        if self._core.sender is not sender:
+            return False # reloaded
+        gtk.gdk.threads_enter()
+        self._applying = True
+        try:
+            buff = self._get_buffer()
+            for revision, author, ops in changes:
+                for op in sender.remote(revision, ops, author == self._uid):
+                    start = buff.get_iter_at_line_offset(op[1], op[2])
+                    if op[0] == 'ins':
+                        buff.insert(start, op[3])
+                    else:
+                        buff.delete(start, \
+                            buff.get_iter_at_line_offset(op[3], op[4]))
+        except Exception, exp:
+            LOG.warning("Error applying operations! %s" % exp)
+        self._applying = False
+        gtk.gdk.threads_leave()
+        return False # run once, when called by gobject
+
+    def _text_inserted(self, buff, position, text, length):
+        if self._applying or self._core.sender is None:
+            return
+        self._core.sender.local([['ins', position.get_line(), \
+            position.get_line_offset(), text.decode('utf-8')]])
+
+    def _range_deleted(self, buff, start, end):
+        if self._applying or self._core.sender is None:
+            return
+        self._core.sender.local([['del', start.get_line(), \
+            start.get_line_offset(), end.get_line(), end.get_line_offset()]])
+
+    def _operations_lost(self, sender):
+        gobject.idle_add(self._reload_document, sender)
+
+    def _reload_document(self, sender):
+        '''
+        Our text is not the text of the server anymore: get it again
+        '''
+        if self._core.sender is not sender:
+            return False # already reloaded
+        LOG.warning('Reloading document %s' % self._core.document_uid)
+        self._core.abandon()
+        self.open_document(self._core.document_uid)
+        return False # run once, when called by gobject
+
+    def _fallback_to_polling(self):
+        self._install_worker_to_update()
+        return False # run once, when called by gobject
+
     def _update_from_server(self):
-        if self._opened_document is None:
+        if self._core.document_uid is None:
             LOG.critical("No opened document")
             return
 
+        self._apply_changes(self._core.get_changes().result())
+
+        # do it again
+        self._install_worker_to_update()
+
+    def _apply_changes(self, changes):
         # http://www.pardon-sleeuwaegen.be/antoon/python/page1.html
         gtk.gdk.threads_enter()
 
-        server = self._server
-        rows = server.list_changed_lines(self._uid, self._opened_document)
-
         try:
-            for row in rows:
-                text = server.get_document_row(self._uid, \
-                    self._opened_document, row).strip()
-                self.refresh_row(row, text)
+            core = self._core
+            if changes['full']:
+                core.forget()
+            for row, delta in changes.get('deltas', ()):
+                text = self.refresh_row_delta(row, delta)
+                core.known(row, text)
+            self.refresh_rows(changes['rows'], changes['row_count'], \
+                changes['full'])
+            for row, text in changes['rows']:
+                core.known(row, text.strip())
+            core.revision = changes['revision']
 
         except Exception, exp:
             LOG.warning("Error refreshing lines! %s" % exp)
 
         gtk.gdk.threads_leave()
-
-        # do it again
-        self._install_worker_to_update()
+        return False # run once, when called by gobject
 
     def _get_buffer(self):
         return self._text_box.get_buffer()
@@ -155,100 +252,153 @@ class Client(ClientGui):
         initial, final = self._get_line_iter(line)
         return buff.get_text(initial, final)
 
-    def _timer_update_row(self, line):
-        LOG.debug('Waiting to send row %i to server...' % line)
-        if self._timer:
-            self._timer.cancel()
-        timer = Timer(interval=1, function=self.update_row, args=[line])
-        timer.start()
-        self._timer = timer
+    def _get_rows(self, first):
+        '''
+        Lines from first to the end
+        '''
+        buff = self._get_buffer()
+        if first >= buff.get_line_count():
+            return []
+        text = buff.get_text(buff.get_iter_at_line(first), \
+            buff.get_end_iter())
+        return text.decode('utf-8').split('\n')
+
+    def _replace_in_row(self, line, start, end, text):
+        buff = self._get_buffer()
+        initial = buff.get_iter_at_line_offset(line, start)
+        buff.delete(initial, buff.get_iter_at_line_offset(line, end))
+        buff.insert(initial, text)
+
+    def _replace_rows(self, start, stop, rows):
+        '''
+        Replace the lines from start to stop (not included) by rows
+        '''
+        buff = self._get_buffer()
+        count = buff.get_line_count()
+        if stop - start == len(rows):
+            for i, text in enumerate(rows):
+                self.refresh_row(start + i, text)
+        elif stop < count:
+            buff.delete(buff.get_iter_at_line(start), \
+                buff.get_iter_at_line(stop))
+            buff.insert(buff.get_iter_at_line(start), \
+                ''.join('%s\n' % text for text in rows))
+        elif start == 0:
+            buff.delete(buff.get_start_iter(), buff.get_end_iter())
+            buff.insert(buff.get_start_iter(), '\n'.join(rows))
+        else:
+            # up to the end: from the "\n" before the line
+            initial = buff.get_end_iter()
+            if start < count:
+                initial = buff.get_iter_at_line(start)
+                initial.backward_char()
+            buff.delete(initial, buff.get_end_iter())
+            buff.insert(initial, ''.join('\n%s' % text for text in rows))
 
     def new_document(self):
         '''
         Create a new document in the server
         '''
-        server = self._server
-        document_uid = server.new_document(self._uid)
-        self._opened_document = document_uid
+        self._core.new_document()
+        self._install_listener()
 
     def open_document(self, document_uid):
         '''
-        Create a new document in the server
+        Open a document of the server
         '''
-        server = self._server
-        document_uid = server.open_document(self._uid, document_uid)
-        self._opened_document = document_uid
-
-        # load document content
-        buff = self._get_buffer()
-        all_text = []
-        for i in xrange(server.get_document_row_count(self._uid, document_uid)):
-            text = \
-                server.get_document_row(self._uid, self._opened_document, i)
-            all_text.append(text)
-        buff.set_text('\n'.join(all_text))
+        # load document content (an unknown revision: all rows)
+        changes = self._core.open_document(document_uid)
+        self._applying = True
+        self._get_buffer().set_text( \
+            '\n'.join(text for row, text in changes['rows']))
+        self._applying = False
+        self._install_listener()
 
     def typing(self, line):
         '''
         Verify if user can edit current line in the buffer
         Create a lock if user can edit
         '''
-        server = self._server
-        print 'LOCK', line
-        lock = server.lock_document(self._uid, self._opened_document, line)
+        if self.OPERATIONS:
+            return True # no locks: the server merges the operations
+        lock = self._core.lock(line).result()
         if lock:
             self._edit_line = line
         else:
             LOG.debug('Unable to get a lock into line %i' % line)
         return lock
 
-    def refresh_row(self, line, text):
+    def refresh_rows(self, rows, row_count, full=False):
         '''
-        Recieve a row from server and update into the GUI
+        Recieve rows from server [(row, text)] and update the GUI with the
+        fewest edits (see delta.plan_row_edits), in one user action.
+        Lines after row_count were removed by others, unless we are editing
+        (with locks): then they can be ours, not sent yet.
         '''
-        # FIXME find a better way to o this
-        LOG.debug('Refresh line %i with %s' % (
-            line, repr(text)))
+        trim = full or not self._core.locked_rows
+        if not rows and not trim:
+            return
+        first = min([row for row, text in rows] or [row_count])
+        local = self._get_rows(first)
+        new = list(local)
+        size = row_count - first
+        if trim:
+            del new[size:]
+        new.extend([''] * (size - len(new)))
+        for row, text in rows:
+            new[row - first] = text.strip()
+
+        buff = self._get_buffer()
+        buff.begin_user_action()
         try:
-            buff = self._get_buffer()
-            initial, final = self._get_line_iter(line)
-            final.forward_char()
-            buff.delete(initial, final)
-            buff.insert(initial, "%s\n" % text)
-            # LOG.debug("Replace %s by %s" % (
-            #    repr(self._get_text(line)), repr(text)))
-        except Exception, e:
-            print e
-        LOG.debug("Refresh ok!")
+            for start, stop, block in plan_row_edits(local, new):
+                LOG.debug('Refresh lines %i:%i with %i rows' % (
+                    first + start, first + stop, len(block)))
+                self._replace_rows(first + start, first + stop, block)
+        finally:
+            buff.end_user_action()
+
+    def refresh_row(self, line, text):
+        '''
+        Recieve a row from server and update into the GUI: just the
+        characters that changed
+        '''
+        old = self._get_text(line).decode('utf-8')
+        if old != text:
+            start, end, middle = make_delta(old, text)[:3]
+            self._replace_in_row(line, start, end, middle)
+
+    def refresh_row_delta(self, line, delta):
+        '''
+        Recieve the changed part of a row (see delta.py) and update just
+        that part in the GUI: the new row
+        '''
+        text = apply_delta(self._get_text(line).decode('utf-8'), delta)
+        if text is None:
+            # not the row the delta was made from: get it full
+            LOG.debug('Delta of line %i does not match' % line)
+            text = self._core.get_row(line).result().strip()
+            self.refresh_row(line, text)
+            return text
+        self._replace_in_row(line, *delta[:3])
+        return text
 
     def update_row(self, line):
         '''
-        Update a line into a server
+        Update a line into a server (soon, by the sender)
         '''
-        LOG.debug('Sending row %i to server...' % line)
-        server = self._server
-        text = self._get_text(line)
-        LOG.debug(repr(text))
-        doc_id = server.write_document(self._uid, self._opened_document, line, \
-            text)
-        self._edit_line = None
+        text = self._get_text(line).decode('utf-8')
+        LOG.debug('Row %i changed: %s' % (line, repr(text)))
+        self._core.write(line, text)
 
     def release_lock(self, line):
         '''
-        Release lock into the server
+        Release lock into the server, after the line is sent
         '''
-        LOG.debug('Sending unlock row %i to server...' % line)
-        server = self._server
-        local_text = self._get_text(line)
-        server_text = server.get_document_row(self._uid, \
-                        self._opened_document, line)
-        while server_text.strip() != local_text.strip():
-            self.update_row(line)
-            LOG.warning("Re-update row %i into the server" % line)
-            import time
-            time.sleep(1)
-
-        server.unlock_document(self._uid, self._opened_document, line)
+        LOG.debug('Unlock row %i...' % line)
+        self._core.unlock(line)
+        if self._edit_line == line:
+            self._edit_line = None
 
     def close_document(self):
         '''
@@ -256,19 +406,15 @@ class Client(ClientGui):
         '''
         if self._edit_line is not None:
             self.update_row(self._edit_line)
-
-        if self._timer:
-            timer = self._timer
-            timer.cancel()
-
-        self._server.close_document(self._uid, self._opened_document)
-        self._opened_document = None
+        self._core.close_document()
 
     def key_release(self, widget, event):
         '''
         Wait same seconds and update!
         '''
         super(Client, self).key_release(widget, event)
+        if self.OPERATIONS:
+            return # sent by the buffer signals
         line = self._get_cursor_row(widget)
 
         event_name = gtk.gdk.keyval_name(event.keyval)
@@ -279,7 +425,7 @@ class Client(ClientGui):
             self.release_lock(line-1)
         elif event.keyval <= 128 or event_name in ('BackSpace', 'Delete'):
             # just ASCII or delete
-            self._timer_update_row(line)
+            self.update_row(line)
         else:
             pass
             # do not send "ivisible" keys
@@ -291,14 +437,19 @@ class Client(ClientGui):
             self.release_lock(line)
 
     def quit(self, *args):
-        if self._opened_document:
+        if self._core.document_uid:
             self.close_document()
+        self._core.close()
         super(Client, self).quit(*args)
 
 if __name__ == '__main__':
     import sys
     args = sys.argv[1:]
+    if '--operations' in args:
+        args.remove('--operations')
+        Client.OPERATIONS = True
     LOG.addHandler(logging.StreamHandler(sys.stdout))
+    clientcore.LOG.addHandler(logging.StreamHandler(sys.stdout))
 
     client = Client()
     if args and args[0]:
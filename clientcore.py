@@ -0,0 +1,674 @@
+'''
+The client without a GUI: every call to the server goes through a pool of
+worker threads, each one with a proxy of its own (Pyro proxies cannot be
+shared between threads), so many calls are in flight at once. A call gives
+a Future. The GTK client (client.py) is a layer on top of it, and so can be
+scripts, bots and load tests:
+
+    core = ClientCore(lambda: FramedProxy(address))
+    core.new_document()
+    futures = [core.call('lock_and_write_document', core.document_uid,
+        row, text) for row, text in enumerate(texts)]
+    results = [future.result() for future in futures]
+
+connect() gives a new proxy: a Pyro4.Proxy, a transport.FramedProxy, a
+shard.ShardRouter or even a Server (it is thread safe).
+'''
+import time
+import Queue
+import logging
+import itertools
+import threading
+from threading import Thread, Condition
+from collections import deque
+
+from ot import OperationQueue
+from delta import make_delta, apply_delta, worth
+
+LOG = logging.Logger(name="client")
+LOG.addHandler(logging.NullHandler())
+
+
+class Future(object):
+    '''
+    The result of a call, when a worker has it
+    '''
+    class Timeout(Exception): # no result in time
+        pass
+
+    def __init__(self):
+        self._result = None
+        self._error = None
+        self._finished = False
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_error(self, error):
+        self._finish(None, error)
+
+    def _finish(self, result, error):
+        with self._lock:
+            self._result = result
+            self._error = error
+            self._finished = True
+            callbacks, self._callbacks = self._callbacks, []
+        # before done: who waits the result sees what callbacks did (but
+        # callbacks, and who comes in the middle, can read it already)
+        for callback in callbacks:
+            self._run(callback)
+        self._done.set()
+
+    def _run(self, callback):
+        try:
+            callback(self)
+        except Exception, exp:
+            LOG.warning('Callback of a call failed: %s', exp)
+
+    def add_done_callback(self, callback):
+        '''
+        Call callback(future) when finished (now, if it is)
+        '''
+        with self._lock:
+            if not self._finished:
+                self._callbacks.append(callback)
+                return
+        self._run(callback)
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        '''
+        Wait for the result (raise the exception of the call, if any)
+        '''
+        if not self._finished and not self._done.wait(timeout):
+            raise self.Timeout()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._finished and not self._done.wait(timeout):
+            raise self.Timeout()
+        return self._error
+
+
+def done_future(result):
+    '''
+    A Future with its result already
+    '''
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+class CallPool(object):
+    '''
+    Worker threads calling server methods. Calls with the same key go to
+    the same worker, in order; the others go to the workers in turn.
+    '''
+    def __init__(self, connect, workers=4):
+        self._connect = connect
+        self._queues = [Queue.Queue() for i in xrange(workers)]
+        self._turn = itertools.count()
+        self._threads = []
+        for queue in self._queues:
+            thread = Thread(target=self._work, args=(queue,))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def call(self, name, *args, **options):
+        '''
+        Future of server.name(*args). Option key: order of the calls.
+        '''
+        key = options.get('key')
+        if key is None:
+            queue = self._queues[next(self._turn) % len(self._queues)]
+        else:
+            queue = self._queues[hash(key) % len(self._queues)]
+        future = Future()
+        queue.put((future, name, args))
+        return future
+
+    def _work(self, queue):
+        proxy = error = None
+        try:
+            proxy = self._connect()
+        except Exception, exp:
+            LOG.warning('Unable to connect to the server: %s', exp)
+            error = exp
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            future, name, args = item
+            if proxy is None:
+                future.set_error(error)
+                continue
+            try:
+                result = getattr(proxy, name)(*args)
+            except Exception, exp:
+                future.set_error(exp)
+            else:
+                future.set_result(result)
+        # not getattr(proxy): a Pyro proxy has every remote method
+        if getattr(type(proxy), 'close', None) is not None:
+            proxy.close()
+
+    def close(self):
+        '''
+        Stop the workers, after the calls made
+        '''
+        for queue in self._queues:
+            queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+def apply_changes(rows, changes):
+    '''
+    Apply changes (see Server.get_changes_since) to a list of rows: the
+    rows with a delta for another text, to get them full. Rows after
+    row_count were removed (by operations, see ot.py).
+    '''
+    del rows[changes['row_count']:]
+    rows.extend([u''] * (changes['row_count'] - len(rows)))
+    missing = []
+    for row, delta in changes.get('deltas', ()):
+        text = apply_delta(rows[row], delta)
+        if text is None:
+            missing.append(row)
+        else:
+            rows[row] = text
+    for row, text in changes['rows']:
+        rows[row] = text.strip()
+    return missing
+
+
+class RowSender(object):
+    '''
+    Send rows to the server from a background thread.
+    Rows changed many times before a send (fast typing) are sent once, and
+    all the rows waiting (writes and unlocks) go in just one call.
+    Long rows the server has go as deltas (see delta.py).
+    '''
+    DELAY = 0.5 # seconds waiting more changes before a send
+
+    def __init__(self, connect, client_uid, document_uid, lock_lost=None,
+            delay=None):
+        self._connect = connect
+        self._client_uid = client_uid
+        self._document_uid = document_uid
+        self._lock_lost = lock_lost # called with a row locked by another
+        self._delay = self.DELAY if delay is None else delay
+        self._writes = {} # row: text
+        self._unlocks = set()
+        self._known = {} # row: text in the server, to send deltas
+        self._sending = False
+        self._closed = False
+        self._cond = Condition()
+        thread = Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def write(self, row, text):
+        with self._cond:
+            self._writes[row] = text
+            self._cond.notify_all()
+
+    def known(self, row, text):
+        '''
+        The server has this text in the row
+        '''
+        with self._cond:
+            self._known[row] = text
+
+    def forget(self):
+        '''
+        Rows of the server are not known anymore
+        '''
+        with self._cond:
+            self._known.clear()
+
+    def unlock(self, row):
+        '''
+        Release the lock after the row is sent
+        '''
+        with self._cond:
+            self._unlocks.add(row)
+            self._cond.notify_all()
+
+    def flush(self):
+        '''
+        Wait until every row is sent
+        '''
+        with self._cond:
+            while self._writes or self._unlocks or self._sending:
+                self._cond.wait()
+
+    def close(self):
+        self.flush()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def _write_operation(self, row, text):
+        known = self._known.get(row)
+        if known is not None:
+            delta = make_delta(known, text)
+            if worth(delta, text):
+                return ('lock_write_delta', self._document_uid, row, delta)
+        return ('lock_write', self._document_uid, row, text)
+
+    def _run(self):
+        server = self._connect()
+        while True:
+            with self._cond:
+                while not (self._writes or self._unlocks or self._closed):
+                    self._cond.wait()
+                if self._closed:
+                    return
+            time.sleep(self._delay) # more keys are coming
+
+            with self._cond:
+                writes = sorted(self._writes.items())
+                unlocks = sorted(self._unlocks)
+                self._writes = {}
+                self._unlocks = set()
+                self._sending = True
+                ops = [self._write_operation(row, text) \
+                    for row, text in writes]
+            LOG.debug('Sending rows %s and unlocks %s to server...',
+                [row for row, text in writes], unlocks)
+            try:
+                ops += [('unlock', self._document_uid, row) \
+                    for row in unlocks]
+                written = server.execute_batch(self._client_uid, ops)
+                for (row, text), ok in zip(writes, written):
+                    if ok is None:
+                        # the server has another row: send it full
+                        with self._cond:
+                            self._known.pop(row, None)
+                            self._writes.setdefault(row, text)
+                            if row in unlocks:
+                                self._unlocks.add(row) # after it again
+                    elif not ok and self._lock_lost:
+                        LOG.warning('Row %i is locked by another client', row)
+                        self._lock_lost(row)
+                    else:
+                        self.known(row, text.strip())
+            except Exception, exp:
+                LOG.warning('Error sending rows! %s', exp)
+            with self._cond:
+                self._sending = False
+                self._cond.notify_all()
+
+
+class OperationSender(object):
+    '''
+    Send the operations typed (see ot.py) from a background thread. They
+    are in the local text already: the server merges them with the ones of
+    other clients, and remote() gives those ones, ready to apply.
+    '''
+    DELAY = 0.1 # seconds waiting more operations before a send
+
+    def __init__(self, connect, client_uid, document_uid, revision,
+            lost=None, delay=None):
+        self._connect = connect
+        self._client_uid = client_uid
+        self._document_uid = document_uid
+        self._lost = lost # called if the server refuses the operations
+        self._delay = self.DELAY if delay is None else delay
+        self._queue = OperationQueue(revision)
+        self._closed = False
+        self._flush = True
+        self._cond = Condition()
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def get_revision(self):
+        return self._queue.revision
+
+    revision = property(get_revision)
+
+    def local(self, ops):
+        with self._cond:
+            self._queue.local(ops)
+            self._cond.notify_all()
+
+    def remote(self, revision, ops, own):
+        '''
+        Operations of a revision: the ones to apply in the local text
+        '''
+        with self._cond:
+            ops = self._queue.remote(revision, ops, own)
+            self._cond.notify_all()
+        return ops
+
+    def close(self, flush=True):
+        '''
+        Stop, after the server has every operation (if flush)
+        '''
+        with self._cond:
+            self._closed = True
+            self._flush = flush
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _ready(self):
+        return self._queue.sent is None and self._queue.pending
+
+    def _send(self, server):
+        with self._cond:
+            sending = self._queue.send()
+        if sending is None:
+            return True
+        revision, ops = sending
+        LOG.debug('Sending %i operations on revision %i...',
+            len(ops), revision)
+        try:
+            server.apply_operations(self._client_uid, self._document_uid,
+                revision, ops)
+        except Exception, exp:
+            LOG.warning('Error sending operations! %s', exp)
+            if self._lost:
+                self._lost()
+            return False
+        return True
+
+    def _run(self):
+        server = self._connect()
+        while True:
+            with self._cond:
+                while not (self._closed or self._ready()):
+                    self._cond.wait()
+                if self._closed:
+                    break
+            time.sleep(self._delay) # more keys are coming
+            if not self._send(server):
+                return
+
+        # closing, nobody listen the server: follow it here
+        while self._flush and (self._queue.sent or self._queue.pending):
+            changes = server.get_operations_since(self._client_uid,
+                self._document_uid, self._queue.revision)
+            if changes['changes'] is None:
+                LOG.warning('Operations lost: the server has a new text')
+                return
+            for revision, author, ops in changes['changes']:
+                self.remote(revision, ops, author == self._client_uid)
+            if not self._send(server):
+                return
+
+
+class ClientCore(object):
+    '''
+    A client of the server, with no GUI: a document opened, the rows it
+    locked, a sender of the changes made and listeners of the changes of
+    the others. Listener callbacks run in a thread of their own.
+    '''
+    WAIT_TIMEOUT = 30 # seconds waiting changes in each call
+    WORKERS = 4 # calls at once
+    IMPORT_CHUNK = 5000 # rows by append_rows call
+    IMPORT_WINDOW = 4 # append_rows calls in flight at once
+    EXPORT_CHUNK = 5000 # rows by export_rows call
+
+    class ExportChanged(Exception): # an export expired, the text changed
+        pass
+
+    def __init__(self, connect, operations=False, workers=None,
+            delay=None, lost=None):
+        self._connect = connect
+        self._lost = lost # lost(sender): the server refused operations
+        self._pool = CallPool(connect, workers or self.WORKERS)
+        self._delay = delay # of the senders (None: their DELAY)
+        self.operations = operations # edit by operations, no row locks
+        self.uid = self._pool.call('register_client').result()
+        self.document_uid = None
+        self.read_only = False
+        self.revision = -1 # last document revision received
+        self.sender = None # RowSender or OperationSender
+        self.locked_rows = set() # rows we know that are locked by us
+
+    def call(self, name, *args, **options):
+        '''
+        Future of server.name(client uid, *args). Calls with the same key
+        option are made in order.
+        '''
+        return self._pool.call(name, self.uid, *args, **options)
+
+    def _opened(self, document_uid, revision, read_only=False):
+        self.document_uid = document_uid
+        self.revision = revision
+        self.read_only = read_only
+        self.locked_rows.clear()
+        if read_only:
+            self.sender = None
+        elif self.operations:
+            self.sender = OperationSender(self._connect, self.uid,
+                document_uid, revision, lost=self._operations_lost,
+                delay=self._delay)
+        else:
+            self.sender = RowSender(self._connect, self.uid, document_uid,
+                lock_lost=self.locked_rows.discard, delay=self._delay)
+
+    def new_document(self):
+        '''
+        Create a document in the server and open it: its uid
+        '''
+        document_uid = self.call('new_document').result()
+        # operations need a known revision
+        self._opened(document_uid, 0 if self.operations else -1)
+        return document_uid
+
+    def open_document(self, document_uid, read_only=False):
+        '''
+        Open a document (to view, if read_only): its changes since nothing
+        (every row, see Server.get_changes_since)
+        '''
+        args = (True,) if read_only else ()
+        opened = self.call('open_document', document_uid, *args,
+            key=document_uid)
+        changes = self.call('get_changes_since', document_uid, -1,
+            key=document_uid)
+        document_uid = opened.result()
+        changes = changes.result()
+        self._opened(document_uid, changes['revision'], read_only)
+        return changes
+
+    def abandon(self):
+        '''
+        Forget the changes not sent (the text of the server is another)
+        '''
+        sender, self.sender = self.sender, None
+        if isinstance(sender, OperationSender):
+            sender.close(flush=False)
+        elif sender is not None:
+            sender.close()
+
+    def close_document(self):
+        '''
+        Send every change and close the document
+        '''
+        if self.sender is not None:
+            self.sender.close()
+            self.sender = None
+        self.call('close_document', self.document_uid).result()
+        self.document_uid = None
+
+    def close(self):
+        if self.document_uid is not None:
+            self.close_document()
+        self._pool.close()
+
+    # rows
+
+    def lock(self, row):
+        '''
+        Future of True if we have the lock of a row now
+        '''
+        if self.operations:
+            return done_future(True) # the server merges the operations
+        if row in self.locked_rows:
+            return done_future(True) # no need to ask the server
+
+        def locked(future):
+            if future.exception() is None and future.result():
+                self.locked_rows.add(row)
+        future = self.call('lock_document', self.document_uid, row)
+        future.add_done_callback(locked)
+        return future
+
+    def write(self, row, text):
+        '''
+        Send a row (soon, by the sender)
+        '''
+        self.sender.write(row, text)
+
+    def unlock(self, row):
+        '''
+        Release a lock, after the row is sent
+        '''
+        self.locked_rows.discard(row)
+        self.sender.unlock(row)
+
+    def known(self, row, text):
+        if self.sender is not None:
+            self.sender.known(row, text)
+
+    def forget(self):
+        if self.sender is not None:
+            self.sender.forget()
+
+    def get_changes(self):
+        '''
+        Future of the changes since the last revision received
+        '''
+        return self.call('get_changes_since', self.document_uid,
+            self.revision, True)
+
+    def get_row(self, row):
+        return self.call('get_document_row', self.document_uid, row)
+
+    # bulk
+
+    def import_rows(self, document_uid, rows, chunk_size=None):
+        '''
+        Replace every row of a document by rows (any iterable, like a
+        file: the ends of line are removed), sent in chunks with a few
+        calls in flight. The new revision.
+        '''
+        size = chunk_size or self.IMPORT_CHUNK
+        import_uid = self.call('begin_import', document_uid).result()
+        sent = deque()
+        chunk = []
+        try:
+            for row in rows:
+                chunk.append(row.rstrip('\r\n'))
+                if len(chunk) < size:
+                    continue
+                sent.append(self.call('append_rows', import_uid, chunk,
+                    key=import_uid))
+                chunk = []
+                if len(sent) >= self.IMPORT_WINDOW:
+                    sent.popleft().result() # memory stays bounded
+            if chunk:
+                sent.append(self.call('append_rows', import_uid, chunk,
+                    key=import_uid))
+            for future in sent:
+                future.result()
+        except Exception:
+            self.call('abort_import', import_uid, key=import_uid)
+            raise
+        return self.call('commit_import', import_uid,
+            key=import_uid).result()
+
+    def export_rows(self, document_uid, chunk_size=None):
+        '''
+        Iterate over the rows of a document (of one revision), got in
+        chunks: the next one is asked while a chunk is used
+        '''
+        size = chunk_size or self.EXPORT_CHUNK
+        future = self.call('export_rows', document_uid, 0, size,
+            key=document_uid)
+        revision = None
+        while future is not None:
+            chunk = future.result()
+            if revision is None:
+                revision = chunk['revision']
+            elif chunk['revision'] != revision:
+                raise self.ExportChanged(document_uid)
+            future = None
+            if chunk['next'] is not None:
+                future = self.call('export_rows', document_uid,
+                    chunk['next'], size, key=document_uid)
+            for row in chunk['rows']:
+                yield row
+
+    # listeners
+
+    def listen(self, changed, failed=None):
+        '''
+        Call changed(changes) after every change (see wait_for_changes) of
+        the document, from a thread, until it is closed. failed(error) if
+        the server cannot wait (poll it).
+        '''
+        thread = Thread(target=self._listen_changes,
+            args=(self.document_uid, self.revision, changed, failed))
+        thread.daemon = True
+        thread.start()
+
+    def _listen_changes(self, document_uid, revision, changed, failed):
+        server = self._connect()
+        while self.document_uid == document_uid:
+            try:
+                changes = server.wait_for_changes(self.uid, document_uid,
+                    revision, self.WAIT_TIMEOUT, True)
+            except Exception, exp:
+                LOG.warning('Unable to wait changes: %s', exp)
+                if failed is not None:
+                    failed(exp)
+                return
+            if changes['revision'] != revision:
+                changed(changes)
+            revision = changes['revision']
+
+    def listen_operations(self, changed, lost):
+        '''
+        Call changed(sender, [(revision, author, operations)]) after every
+        change of the document (apply them with sender.remote), from a
+        thread, while the sender is the same. lost(sender) if the server
+        does not remember our revision (open the document again).
+        '''
+        thread = Thread(target=self._listen_operations,
+            args=(self.document_uid, self.sender, changed, lost))
+        thread.daemon = True
+        thread.start()
+
+    def _listen_operations(self, document_uid, sender, changed, lost):
+        server = self._connect()
+        revision = sender.revision
+        while self.sender is sender:
+            try:
+                changes = server.wait_for_operations(self.uid,
+                    document_uid, revision, self.WAIT_TIMEOUT)
+            except Exception, exp:
+                LOG.warning('Unable to wait operations: %s', exp)
+                changes = {'changes': None}
+            if changes['changes'] is None:
+                lost(sender)
+                return
+            if changes['changes']:
+                changed(sender, changes['changes'])
+            revision = changes['revision']
+
+    def _operations_lost(self):
+        LOG.warning('Operations of %s lost', self.document_uid)
+        if self._lost is not None:
+            self._lost(self.sender)
@@ -0,0 +1,83 @@
+'''
+Deltas of rows: send only the changed part of a long row, and change only
+the rows that changed.
+
+A delta is a list [start, end, text, checksum]: the new row is
+old[:start] + text + old[end:], and checksum is the crc32 of the new row.
+A delta applied to another row gives another checksum, so the receiver
+knows it must get the full row.
+'''
+import zlib
+import difflib
+
+MIN_SAVING = 16 # characters: a delta saving less is not worth it
+
+
+def checksum(text):
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    return zlib.crc32(text) & 0xffffffff
+
+
+def common_affixes(old, new):
+    '''
+    Lengths of the common prefix and of the common suffix (not overlapped)
+    '''
+    limit = min(len(old), len(new))
+    prefix = 0
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    limit -= prefix
+    while suffix < limit and old[-suffix - 1] == new[-suffix - 1]:
+        suffix += 1
+    return prefix, suffix
+
+
+def make_delta(old, new):
+    '''
+    The delta from old to new
+    '''
+    prefix, suffix = common_affixes(old, new)
+    return [prefix, len(old) - suffix, new[prefix:len(new) - suffix],
+        checksum(new)]
+
+
+def apply_delta(old, delta):
+    '''
+    The new row, or None if old is not the row the delta was made from
+    '''
+    start, end, text, crc = delta
+    if not 0 <= start <= end <= len(old):
+        return None
+    new = old[:start] + text + old[end:]
+    if checksum(new) != crc:
+        return None
+    return new
+
+
+def worth(delta, new):
+    '''
+    Is the delta smaller enough than the new row?
+    '''
+    return len(new) - len(delta[2]) >= MIN_SAVING
+
+
+def plan_row_edits(old, new):
+    '''
+    The fewest edits turning the list of rows old into new: a list of
+    (start, stop, rows) replacing old[start:stop] by rows. The last rows go
+    first, so every edit is applied on the rows it was made for. Unchanged
+    rows are in no edit, and inserted or removed rows do not change the
+    rows after them.
+    '''
+    prefix, suffix = common_affixes(old, new)
+    matcher = difflib.SequenceMatcher(None, old[prefix:len(old) - suffix],
+        new[prefix:len(new) - suffix], autojunk=False)
+    edits = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != 'equal':
+            edits.append((prefix + i1, prefix + i2,
+                new[prefix + j1:prefix + j2]))
+    edits.reverse()
+    return edits
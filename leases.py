@@ -0,0 +1,107 @@
+'''
+Leases of row locks.
+A client keeps its locks in a document while it renews the lease, using the
+document. A reaper thread expires the leases not renewed in time: a heap
+ordered by expiry time gives the due leases without scanning documents.
+'''
+import time
+import heapq
+import atexit
+import weakref
+import threading
+
+_running = weakref.WeakSet() # with a reaper thread, to stop at exit
+
+
+@atexit.register
+def _close_all():
+    # stop before the interpreter tear down the modules
+    for leases in list(_running):
+        leases.close()
+
+
+class Leases(object):
+
+    def __init__(self, duration, expire, clock=time.time):
+        self._duration = duration # seconds
+        self._expire = expire # called with a list of expired keys
+        self._clock = clock
+        self._expires = {} # key: expiry time
+        self._heap = [] # (expiry time, key), one entry by key
+        self._cond = threading.Condition()
+        self._thread = None
+        self._closed = False
+        self.expired = 0
+
+    def __len__(self):
+        return len(self._expires)
+
+    def renew(self, key):
+        expires = self._clock() + self._duration
+        with self._cond:
+            if key not in self._expires:
+                heapq.heappush(self._heap, (expires, key))
+                self._cond.notify()
+            self._expires[key] = expires
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+                _running.add(self)
+
+    def release(self, key):
+        with self._cond:
+            self._expires.pop(key, None) # the heap entry is dropped later
+
+    def _pop_expired(self, now):
+        expired = []
+        heap = self._heap
+        while heap and heap[0][0] <= now:
+            expires, key = heapq.heappop(heap)
+            if key not in self._expires:
+                continue # released
+            if self._expires[key] <= now:
+                del self._expires[key]
+                expired.append(key)
+            else:
+                # renewed: wait for the new expiry time
+                heapq.heappush(heap, (self._expires[key], key))
+        self.expired += len(expired)
+        return expired
+
+    def reap(self, now=None):
+        '''
+        Expire every due lease, at once: the expired keys
+        '''
+        if now is None:
+            now = self._clock()
+        with self._cond:
+            expired = self._pop_expired(now)
+        if expired:
+            self._expire(expired)
+        return expired
+
+    def close(self):
+        '''
+        Stop the reaper thread
+        '''
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+        _running.discard(self)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._closed:
+                    return
+                if self._heap:
+                    timeout = max(0, self._heap[0][0] - self._clock())
+                else:
+                    timeout = None
+                self._cond.wait(timeout)
+                if self._closed:
+                    return
+            self.reap()
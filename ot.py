@@ -0,0 +1,201 @@
+'''
+Operational transformation of edits: clients edit the same rows at the same
+time, with no row locks, and every one ends with the same text.
+
+An operation is a list (to go by Pyro or JSON), positions are (row, column):
+    ['ins', row, column, text]           insert text (it can have "\n")
+    ['del', row, column, row2, column2]  delete from a position to another
+Two lists of operations made on the same revision are transformed to be
+applied one after the other (see transform_pair).
+'''
+
+
+class InvalidOperation(ValueError): # unknown operation or bad position
+    pass
+
+
+def end_of(row, column, text):
+    '''
+    Position after text inserted in (row, column)
+    '''
+    lines = text.split('\n')
+    if len(lines) == 1:
+        return row, column + len(text)
+    return row + len(lines) - 1, len(lines[-1])
+
+
+def _after_insert(position, at, end, before):
+    # text inserted from at to end; at the same position, stay before it?
+    if position < at or (position == at and before):
+        return position
+    if position[0] == at[0]:
+        return end[0], end[1] + position[1] - at[1]
+    return position[0] + end[0] - at[0], position[1]
+
+
+def _after_delete(position, start, stop):
+    # text deleted from start to stop
+    if position <= start:
+        return position
+    if position <= stop:
+        return start
+    if position[0] == stop[0]:
+        return start[0], start[1] + position[1] - stop[1]
+    return position[0] - (stop[0] - start[0]), position[1]
+
+
+def _delete(start, stop):
+    return ['del', start[0], start[1], stop[0], stop[1]]
+
+
+def _transform(op, other, first):
+    '''
+    op to be applied after other (both made on the same text): a list of
+    operations. Inserts at the same position: op goes first if first.
+    '''
+    if op[0] == 'del' and (op[1], op[2]) >= (op[3], op[4]):
+        return [] # nothing to delete
+
+    if other[0] == 'ins':
+        at = (other[1], other[2])
+        end = end_of(other[1], other[2], other[3])
+        if op[0] == 'ins':
+            row, column = _after_insert((op[1], op[2]), at, end, first)
+            return [['ins', row, column, op[3]]]
+        start, stop = (op[1], op[2]), (op[3], op[4])
+        if start < at < stop:
+            # keep the text inserted in the middle: delete around it
+            stop = _after_insert(stop, at, end, True)
+            return [_delete(end, stop), _delete(start, at)]
+        return [_delete(_after_insert(start, at, end, False),
+            _after_insert(stop, at, end, True))]
+
+    start, stop = (other[1], other[2]), (other[3], other[4])
+    if op[0] == 'ins':
+        row, column = _after_delete((op[1], op[2]), start, stop)
+        return [['ins', row, column, op[3]]]
+    new_start = _after_delete((op[1], op[2]), start, stop)
+    new_stop = _after_delete((op[3], op[4]), start, stop)
+    if new_start >= new_stop:
+        return [] # already deleted by other
+    return [_delete(new_start, new_stop)]
+
+
+def _transform_one(op, others):
+    # (op after others, others after op)
+    pieces = [op]
+    transformed = []
+    for other in others:
+        if not pieces:
+            transformed.append(other)
+        elif len(pieces) == 1:
+            transformed.extend(_transform(other, pieces[0], False))
+            pieces = _transform(pieces[0], other, True)
+        else:
+            # a delete split in two: one piece after the other
+            pieces, after = transform_pair(pieces, [other])
+            transformed.extend(after)
+    return pieces, transformed
+
+
+def transform_pair(ops, others):
+    '''
+    Two lists of operations made on the same text: (ops to apply after
+    others, others to apply after ops). Inserts at the same position: the
+    ones of ops go first.
+    '''
+    others = list(others)
+    result = []
+    for op in ops:
+        pieces, others = _transform_one(op, others)
+        result.extend(pieces)
+    return result, others
+
+
+def _check(rows, row, column):
+    if not 0 <= row < len(rows) or not 0 <= column <= len(rows[row]):
+        raise InvalidOperation('No position (%r, %r)' % (row, column))
+
+
+def apply(rows, op):
+    '''
+    Apply an operation to rows (a RowStore): the operation that undo it
+    '''
+    if op[0] == 'ins' and len(op) == 4:
+        name, row, column, text = op
+        _check(rows, row, column)
+        line = rows[row]
+        lines = text.split('\n')
+        lines[0] = line[:column] + lines[0]
+        lines[-1] = lines[-1] + line[column:]
+        rows.splice(row, row + 1, lines)
+        return _delete((row, column), end_of(row, column, text))
+
+    if op[0] == 'del' and len(op) == 5:
+        name, row, column, row2, column2 = op
+        _check(rows, row, column)
+        _check(rows, row2, column2)
+        if (row, column) > (row2, column2):
+            raise InvalidOperation('Delete backwards: %r' % (op,))
+        if row == row2:
+            deleted = rows[row][column:column2]
+        else:
+            lines = rows.get_range(row, row2 + 1)
+            lines[0] = lines[0][column:]
+            lines[-1] = lines[-1][:column2]
+            deleted = '\n'.join(lines)
+        rows.splice(row, row2 + 1,
+            [rows[row][:column] + rows[row2][column2:]])
+        return ['ins', row, column, deleted]
+
+    raise InvalidOperation('Unknown operation: %r' % (op,))
+
+
+def rows_added(op):
+    '''
+    Rows added by an operation (negative if removed)
+    '''
+    if op[0] == 'ins':
+        return op[3].count('\n')
+    return op[1] - op[3]
+
+
+class OperationQueue(object):
+    '''
+    Operations of a client the server does not have yet, applied in the
+    local text before (optimistic edits). Only one list is sent at a time:
+    the next goes when the server has the last one.
+    '''
+    def __init__(self, revision):
+        self.revision = revision # last revision of the server applied
+        self.sent = None # sent, waiting to be in a revision
+        self.pending = [] # not sent
+
+    def local(self, ops):
+        '''
+        Operations made (and applied) in the local text
+        '''
+        self.pending.extend(ops)
+
+    def send(self):
+        '''
+        (revision, operations) to send to the server, or None
+        '''
+        if self.sent is not None or not self.pending:
+            return None
+        self.sent, self.pending = self.pending, []
+        return self.revision, self.sent
+
+    def remote(self, revision, ops, own=False):
+        '''
+        A revision of the server (own if it has the operations sent): the
+        operations to apply in the local text
+        '''
+        self.revision = revision
+        if own:
+            self.sent = None # already in the local text
+            return []
+        if self.sent:
+            ops, self.sent = transform_pair(ops, self.sent)
+        ops, self.pending = transform_pair(ops, self.pending)
+        return ops
@@ -0,0 +1,348 @@
+'''
+Row storage for documents.
+Rows are kept in small chunks indexed by a Fenwick tree of the chunk sizes,
+so finding, replacing, inserting or deleting a row costs O(log n) instead of
+rebuilding the whole list on every edit.
+Chunks not changed for a while are packed (see PackedRows): a string object
+by row costs more than the text of most rows. Chunks of a saved document
+can be read from a mapped file (see MappedRows) until they are changed.
+'''
+import struct
+from array import array
+
+_OFFSETS = struct.Struct('<QQ') # a row and the next one in an index
+
+
+def group_rows(rows):
+    '''
+    Join sorted row indexes in (start, stop) ranges, to fetch them at once
+    '''
+    ranges = []
+    for row in rows:
+        if ranges and ranges[-1][1] == row:
+            ranges[-1][1] = row + 1
+        else:
+            ranges.append([row, row + 1])
+    return [tuple(range_) for range_ in ranges]
+
+
+class _ReadOnlyRows(object):
+    '''
+    A chunk of rows that is not a list: subclasses give __len__ and
+    _row(i), RowStore unpacks it to a list to change it
+    '''
+    __slots__ = ()
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._row(j) for j in xrange(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('row index out of range')
+        return self._row(i)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self._row(i)
+
+    def unpack(self):
+        return list(self)
+
+
+class PackedRows(_ReadOnlyRows):
+    '''
+    Rows of a chunk in one buffer (UTF-8 for unicode rows) with an array of
+    offsets: a few bytes by row more than the text
+    '''
+    __slots__ = ('_data', '_offsets', '_unicode')
+
+    def __init__(self, data, offsets, unicode_rows):
+        self._data = data
+        self._offsets = offsets # start of each row, and the end
+        self._unicode = unicode_rows
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def _row(self, i):
+        text = self._data[self._offsets[i]:self._offsets[i + 1]]
+        if self._unicode:
+            return text.decode('utf-8')
+        return text
+
+
+class MappedRows(_ReadOnlyRows):
+    '''
+    Rows of a chunk read from buffers (mapped files, see storage.py):
+    UTF-8 rows joined by "\n", and an index of little-endian 64 bits
+    offsets, where each row starts (and one more after the end + 1).
+    Nothing is read before a row is.
+    '''
+    __slots__ = ('_data', '_index', '_first', '_count')
+
+    def __init__(self, data, index, first, count):
+        self._data = data
+        self._index = index
+        self._first = first # row of the index where the chunk starts
+        self._count = count
+
+    def __len__(self):
+        return self._count
+
+    def _row(self, i):
+        start, stop = _OFFSETS.unpack_from(self._index,
+            8 * (self._first + i))
+        return self._data[start:stop - 1].decode('utf-8')
+
+
+def pack(rows):
+    '''
+    PackedRows of a list of rows, or the list if the rows mix str and
+    unicode (they could not be given back as they are)
+    '''
+    kinds = set(type(row) for row in rows)
+    if kinds == set([unicode]):
+        texts = [row.encode('utf-8') for row in rows]
+    elif kinds <= set([str]):
+        texts = rows
+    else:
+        return rows
+    offsets = array('I', [0])
+    end = 0
+    for text in texts:
+        end += len(text)
+        offsets.append(end)
+    return PackedRows(''.join(texts), offsets, unicode in kinds)
+
+
+class RowStore(object):
+    '''
+    A list-like sequence of rows split in chunks
+    '''
+    CHUNK = 512 # rows per chunk after a split
+
+    def __init__(self, rows=()):
+        rows = list(rows)
+        size = self.CHUNK
+        self._chunks = [pack(rows[i:i + size])
+            for i in xrange(0, len(rows), size)]
+        if not self._chunks:
+            self._chunks = [[]]
+        self._len = len(rows)
+        self._rebuild_index()
+
+    @classmethod
+    def _from_chunks(cls, chunks):
+        store = cls()
+        store._chunks = chunks or [[]]
+        store._len = sum(len(chunk) for chunk in store._chunks)
+        store._rebuild_index()
+        return store
+
+    @classmethod
+    def mapped(cls, data, index, count):
+        '''
+        A store of count rows read from buffers, see MappedRows
+        '''
+        size = cls.CHUNK
+        return cls._from_chunks([MappedRows(data, index, i,
+            min(size, count - i)) for i in xrange(0, count, size)])
+
+    def freeze(self):
+        '''
+        A copy that later changes of this store do not touch. Both share
+        the read-only chunks (the changed ones are packed first), so it
+        costs O(chunks), not O(rows).
+        '''
+        self.compact()
+        return self._from_chunks([list(chunk) if isinstance(chunk, list)
+            else chunk for chunk in self._chunks])
+
+    def _rebuild_index(self):
+        '''
+        Build the Fenwick tree with the size of every chunk: O(chunks)
+        '''
+        tree = [0] * (len(self._chunks) + 1)
+        for i, chunk in enumerate(self._chunks):
+            j = i + 1
+            tree[j] += len(chunk)
+            parent = j + (j & -j)
+            if parent < len(tree):
+                tree[parent] += tree[j]
+        self._tree = tree
+        # highest power of 2 to walk down the tree
+        step = 1
+        while step * 2 < len(tree):
+            step *= 2
+        self._step = step
+
+    def _grow(self, chunk_idx, delta):
+        tree = self._tree
+        j = chunk_idx + 1
+        while j < len(tree):
+            tree[j] += delta
+            j += j & -j
+        self._len += delta
+
+    def _locate(self, row):
+        '''
+        Find the chunk of a row: return (chunk index, offset into chunk)
+        '''
+        tree = self._tree
+        pos = 0
+        step = self._step
+        while step:
+            nxt = pos + step
+            if nxt < len(tree) and tree[nxt] <= row:
+                pos = nxt
+                row -= tree[nxt]
+            step //= 2
+        return pos, row
+
+    def _mutable(self, chunk_idx):
+        '''
+        The chunk as a list, to change it (unpacked if needed)
+        '''
+        chunk = self._chunks[chunk_idx]
+        if not isinstance(chunk, list):
+            chunk = self._chunks[chunk_idx] = chunk.unpack()
+        return chunk
+
+    def compact(self):
+        '''
+        Pack the chunks changed since the last time (see PackedRows)
+        '''
+        for i, chunk in enumerate(self._chunks):
+            if isinstance(chunk, list) and chunk:
+                self._chunks[i] = pack(chunk)
+
+    def _index(self, row):
+        if row < 0:
+            row += self._len
+        if not 0 <= row < self._len:
+            raise IndexError('row index out of range')
+        return row
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            for row in chunk:
+                yield row
+
+    def __getitem__(self, row):
+        if isinstance(row, slice):
+            start, stop, step = row.indices(self._len)
+            if step != 1:
+                return list(self)[row]
+            return self.get_range(start, stop)
+        chunk_idx, offset = self._locate(self._index(row))
+        return self._chunks[chunk_idx][offset]
+
+    def __setitem__(self, row, value):
+        chunk_idx, offset = self._locate(self._index(row))
+        self._mutable(chunk_idx)[offset] = value
+
+    def __eq__(self, other):
+        try:
+            if len(self) != len(other):
+                return False
+        except TypeError:
+            return NotImplemented
+        for mine, their in zip(self, other):
+            if mine != their:
+                return False
+        return True
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __repr__(self):
+        return 'RowStore(%r)' % list(self)
+
+    def get_range(self, start, stop):
+        '''
+        Rows from start to stop (not included), without copying other chunks
+        '''
+        start = max(0, min(start, self._len))
+        stop = max(start, min(stop, self._len))
+        result = []
+        if start == stop:
+            return result
+        chunk_idx, offset = self._locate(start)
+        remaining = stop - start
+        while remaining:
+            piece = self._chunks[chunk_idx][offset:offset + remaining]
+            result.extend(piece)
+            remaining -= len(piece)
+            chunk_idx += 1
+            offset = 0
+        return result
+
+    def append(self, row):
+        self.insert(self._len, [row])
+
+    def insert(self, row, rows):
+        '''
+        Insert a list of rows before row (row is clamped, like a slice)
+        '''
+        rows = list(rows)
+        if not rows:
+            return
+        row = max(0, min(row, self._len))
+        if row == self._len:
+            chunk_idx = len(self._chunks) - 1
+            offset = len(self._chunks[chunk_idx])
+        else:
+            chunk_idx, offset = self._locate(row)
+        chunk = self._mutable(chunk_idx)
+        chunk[offset:offset] = rows
+        if len(chunk) > 2 * self.CHUNK:
+            size = self.CHUNK
+            self._chunks[chunk_idx:chunk_idx + 1] = \
+                [chunk[i:i + size] for i in xrange(0, len(chunk), size)]
+            self._len += len(rows)
+            self._rebuild_index()
+        else:
+            self._grow(chunk_idx, len(rows))
+
+    def delete(self, start, stop):
+        '''
+        Remove rows from start to stop (not included)
+        '''
+        start = max(0, min(start, self._len))
+        stop = max(start, min(stop, self._len))
+        remaining = stop - start
+        while remaining:
+            chunk_idx, offset = self._locate(start)
+            chunk = self._mutable(chunk_idx)
+            count = min(remaining, len(chunk) - offset)
+            del chunk[offset:offset + count]
+            remaining -= count
+            if chunk or len(self._chunks) == 1:
+                self._grow(chunk_idx, -count)
+            else:
+                # empty chunk: drop it and rebuild the index
+                del self._chunks[chunk_idx]
+                self._len -= count
+                self._rebuild_index()
+
+    def splice(self, start, stop, rows):
+        '''
+        Replace rows from start to stop (not included) by a list of rows
+        '''
+        start = max(0, min(start, self._len))
+        stop = max(start, min(stop, self._len))
+        rows = list(rows)
+        common = min(stop - start, len(rows))
+        for i in xrange(common):
+            self[start + i] = rows[i]
+        if common < stop - start:
+            self.delete(start + common, stop)
+        else:
+            self.insert(start + common, rows[common:])
@@ -0,0 +1,67 @@
+'''
+A readers/writer lock: many readers or one writer at a time.
+Waiting writers block new readers, so writes are not starved.
+'''
+import time
+import threading
+from contextlib import contextmanager
+
+
+class RWLock(object):
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+        # contention: acquires that had to wait, and seconds waiting
+        self.contended = 0
+        self.wait_time = 0.0
+
+    def _wait(self, busy):
+        start = time.time()
+        while busy():
+            self._cond.wait()
+        self.contended += 1
+        self.wait_time += time.time() - start
+
+    def acquire_read(self):
+        with self._cond:
+            if self._writer or self._waiting_writers:
+                self._wait(lambda: self._writer or self._waiting_writers)
+            self._readers += 1
+
+    def release_read(self):
+        with self._cond:
+            self._readers -= 1
+            if not self._readers:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        with self._cond:
+            self._waiting_writers += 1
+            if self._writer or self._readers:
+                self._wait(lambda: self._writer or self._readers)
+            self._waiting_writers -= 1
+            self._writer = True
+
+    def release_write(self):
+        with self._cond:
+            self._writer = False
+            self._cond.notify_all()
+
+    @contextmanager
+    def reading(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def writing(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
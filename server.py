@@ -5,24 +5,129 @@ Sincronize texts between clients and avoid concurrency problems.
 HOST = '0.0.0.0'
 PORT = 4567
 VERBOSE = True
+PATH = '/tmp/docs' # where documents are saved
+FSYNC = 'interval' # always, interval or never: see storage.Storage
+MAX_DOCUMENTS = 1000 # documents kept in memory
+MAX_ROWS = 10000000 # rows kept in memory (of all documents)
+MAX_WAIT = 60 # seconds a client can wait for changes in one call
+LOCK_LEASE = 30 # seconds a client keeps its locks without using them
+STATS_INTERVAL = 300 # seconds between stats in the log (None: never)
+TRANSFER_TIMEOUT = 300 # seconds an import or export is kept without calls
+EXPORT_CHUNK = 10000 # rows by export_rows call, at most
 
 import uuid
+import time
+import threading
+from collections import deque, OrderedDict
+
+from rowstore import RowStore
+from cache import DocumentCache
+from rwlock import RWLock
+from leases import Leases
+from delta import common_affixes, checksum, apply_delta, worth
+import ot
+import stats
 
 # to LOG
 import logging
 import sys
 LOG = logging.Logger(name="server")
-## LOG.level = logging.CRITICAL # omit debug()
+LOG.setLevel(logging.INFO) # debug() costs nothing (see __main__)
+
+class LockTable(object):
+    '''
+    Row locks of a document: the owner of each locked row and, by client,
+    the rows it holds. Costs depend on the locks, not on the rows.
+    '''
+    __slots__ = ('_owners', '_rows')
+
+    def __init__(self):
+        self._owners = {} # row: client uid
+        self._rows = {} # client uid: set of rows
+
+    def __len__(self):
+        return len(self._owners)
+
+    def __repr__(self):
+        return 'LockTable(%r)' % self._owners
+
+    def owner(self, row):
+        return self._owners.get(row)
+
+    def rows_of(self, client_uid):
+        return self._rows.get(client_uid, frozenset())
+
+    def lock(self, row, client_uid):
+        self.unlock(row)
+        self._owners[row] = client_uid
+        self._rows.setdefault(client_uid, set()).add(row)
+
+    def unlock(self, row):
+        client_uid = self._owners.pop(row, None)
+        if client_uid is not None:
+            rows = self._rows[client_uid]
+            rows.discard(row)
+            if not rows:
+                del self._rows[client_uid]
+
+    def unlock_all(self, client_uid):
+        for row in self._rows.pop(client_uid, ()):
+            del self._owners[row]
+
+    def shift(self, start, delta):
+        '''
+        Rows were inserted (delta > 0) or removed (delta < 0) at start:
+        move the locks below them. Locks of removed rows are released.
+        '''
+        moved = [(row, client_uid) for row, client_uid in self._owners.items()
+            if row >= start]
+        for row, client_uid in moved:
+            self.unlock(row)
+        for row, client_uid in moved:
+            if row + delta >= start:
+                self.lock(row + delta, client_uid)
 
-class Lock:
-    def __init__(self, client_uid):
-        self._client_uid = client_uid
+def document_of_import(import_uid):
+    '''
+    The document uid of an import uid (see Server.begin_import)
+    '''
+    return import_uid.partition(u'.')[2]
+
+
+class Snapshot(object):
+    '''
+    The rows of a document in a revision (a frozen RowStore), shared by
+    every reader of that revision, with the results already made from it
+    '''
+    MAX_RESULTS = 64 # results kept (the oldest ones are dropped)
+
+    __slots__ = ('revision', 'rows', '_results', '_lock')
+
+    def __init__(self, revision, rows):
+        self.revision = revision
+        self.rows = rows
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def result(self, key, make):
+        '''
+        The result of make() for a key, made once in this revision.
+        It is shared: do not change it.
+        '''
+        with self._lock:
+            result = self._results.get(key)
+            if result is None:
+                result = self._results[key] = make()
+                if len(self._results) > self.MAX_RESULTS:
+                    self._results.popitem(last=False)
+        return result
 
-    def can_unlock(self, client_uid):
-        return self._client_uid == client_uid
 
 class Document(object):
-    PATH = '/tmp/docs'
+    CHANGE_LOG_SIZE = 1000 # writes remembered to send only the changes
+
+    __slots__ = ('_uid', '_rows', '_locks', '_changes', '_revision',
+        '_log_start', '_rwlock', '_changed', '_waiters', '_frozen')
 
     class DoesNotExist(Exception): # cannot find a document
         pass
@@ -30,100 +135,499 @@ class Document(object):
     class LockDenied(Exception): # cannot get a lock
         pass
 
+    class AlreadyExists(Exception): # cannot create a document
+        pass
+
+    class RevisionTooOld(Exception): # the change log does not have it
+        pass
+
     def __init__(self, uid):
         self._uid = uid
-        self._rows = ['']
-        self._lock_rows = [None]
+        self._rows = RowStore([''])
+        self._locks = LockTable()
+        # (revision, first row, last row + 1 or None to the end,
+        #  operations (see ot.py), client uid or None)
+        self._changes = deque(maxlen=self.CHANGE_LOG_SIZE)
+        self._revision = 0
+        self._log_start = 0 # the log has every change after this revision
+        # Server calls document methods inside reading() or writing()
+        self._rwlock = RWLock()
+        self._changed = threading.Condition() # wake up who wait changes
+        self._waiters = 0 # clients waiting changes
+        self._frozen = None # Snapshot of the last revision frozen
 
     def set_rows(self, rows):
-        self._lock_rows = [None] * len(rows)
-        self._rows = list(rows)
+        self._locks = LockTable()
+        if not isinstance(rows, RowStore):
+            rows = RowStore(rows)
+        self._rows = rows
+        self._frozen = None
+        # everything changed: clients need a full snapshot
+        self._revision += 1
+        self._changes.clear()
+        self._log_start = self._revision
+        self._notify_changed()
+
+    def _log_change(self, start, stop, ops, client_uid=None):
+        self._revision += 1
+        if len(self._changes) == self._changes.maxlen:
+            # the oldest change will be lost
+            self._log_start = self._changes[0][0]
+        self._changes.append((self._revision, start, stop, ops, client_uid))
+        self._notify_changed()
+
+    def _notify_changed(self):
+        with self._changed:
+            self._changed.notify_all()
 
-    def write_file(self):
-        filename = '%s/%s' % (self.PATH, self._uid)
-        file_ = file(filename, 'w')
-        file_.write('\n'.join(self._rows))
-        file_.close()
+    def wait_for_revision(self, revision, timeout):
+        '''
+        Block until the document is newer than revision, or timeout
+        '''
+        deadline = time.time() + timeout
+        with self._changed:
+            self._waiters += 1
+            while self._revision <= revision:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._changed.wait(remaining)
+            self._waiters -= 1
+        return self._revision
+
+    def is_idle(self):
+        '''
+        Nobody is waiting changes or holding a lock
+        '''
+        return not self._waiters and not self._locks
+
+    def reading(self):
+        return self._rwlock.reading()
+
+    def lock_contention(self):
+        '''
+        Acquires of reading() or writing() that waited, and seconds waiting
+        '''
+        return self._rwlock.contended, self._rwlock.wait_time
+
+    def writing(self):
+        return self._rwlock.writing()
+
+    def get_revision(self):
+        return self._revision
+
+    revision = property(get_revision)
+
+    def changed_rows(self, revision):
+        '''
+        Rows changed after a revision, or None if the log does not know
+        '''
+        if revision < self._log_start or revision > self._revision:
+            return None
+        rows = set()
+        tail = len(self._rows)
+        for change_revision, start, stop, ops, client_uid in \
+                reversed(self._changes):
+            if change_revision <= revision:
+                break
+            if stop is None:
+                tail = min(tail, start)
+            else:
+                rows.update(xrange(start, stop))
+        rows = [row for row in rows if row < tail]
+        rows.extend(xrange(tail, len(self._rows)))
+        return sorted(rows)
+
+    def operations_since(self, revision):
+        '''
+        [(revision, client uid, operations)] after a revision
+        '''
+        if revision < self._log_start or revision > self._revision:
+            raise self.RevisionTooOld()
+        changes = []
+        for change in reversed(self._changes):
+            if change[0] <= revision:
+                break
+            changes.append((change[0], change[4], change[3]))
+        changes.reverse()
+        return changes
+
+    def row_deltas(self, revision):
+        '''
+        Rows changed after a revision only inside themselves (no rows added
+        or removed above them): {row: delta (see delta.py) from the row in
+        that revision to the row now}
+        '''
+        if revision < self._log_start or revision > self._revision:
+            return {}
+        edits = {} # row: operations, the newest first
+        tail = len(self._rows)
+        for change_revision, start, stop, ops, client_uid in \
+                reversed(self._changes):
+            if change_revision <= revision:
+                break
+            if stop is None:
+                tail = min(tail, start)
+                continue
+            for op in reversed(ops):
+                if ot.rows_added(op):
+                    tail = min(tail, op[1])
+                else:
+                    edits.setdefault(op[1], []).append(op)
+
+        deltas = {}
+        for row, ops in edits.iteritems():
+            if row >= tail:
+                continue
+            text = self._rows[row]
+            # untouched prefix and suffix, going back to the old row
+            length = prefix = suffix = len(text)
+            for op in ops:
+                if op[0] == 'ins':
+                    end = op[2] + len(op[3])
+                    old_length = length - len(op[3])
+                else:
+                    end = op[2]
+                    old_length = length + op[4] - op[2]
+                prefix = min(prefix, op[2])
+                suffix = min(suffix, length - end)
+                length = old_length
+            suffix = min(suffix, len(text) - prefix, length - prefix)
+            deltas[row] = [prefix, length - suffix,
+                text[prefix:len(text) - suffix], checksum(text)]
+        return deltas
+
+    def restore(self, rows, revision):
+        '''
+        Load rows saved at a revision
+        '''
+        self.set_rows(rows)
+        self._revision = revision
+        self._log_start = revision
+
+    def get_frozen(self):
+        '''
+        The Snapshot of the current revision if it is made, or None.
+        Without a lock: it never changes.
+        '''
+        frozen = self._frozen
+        if frozen is not None and frozen.revision == self._revision:
+            return frozen
+        return None
+
+    def freeze(self):
+        '''
+        The Snapshot of the current revision, made once (inside writing())
+        '''
+        if self.get_frozen() is None:
+            self._frozen = Snapshot(self._revision, self._rows.freeze())
+        return self._frozen
+
+    def get_uid(self):
+        return self._uid
 
     def get_rows(self):
         return self._rows
 
     # property - just to external use
+    uid = property(get_uid)
     rows = property(get_rows, set_rows)
 
     def write(self, row, text):
-        LOG.debug('Writing line %i into %s...' % (
-            row, self._uid))
+        LOG.debug('Writing line %i into %s...',
+            row, self._uid)
 
         rows = text.strip().split('\n')
-        lock_rows = [None] * (len(rows)-1) # new lines are unlocked
+
+        # the same write, as operations (to transform concurrent ones):
+        # just the changed part, to send deltas (see delta.py)
+        if row < len(self._rows):
+            old = self._rows[row]
+            new = '\n'.join(rows)
+            prefix, suffix = common_affixes(old, new)
+            ops = []
+            if prefix + suffix < len(old):
+                ops.append(['del', row, prefix, row, len(old) - suffix])
+            if prefix + suffix < len(new):
+                ops.append(['ins', row, prefix,
+                    new[prefix:len(new) - suffix]])
+        else:
+            last = len(self._rows) - 1
+            ops = [['ins', last, len(self._rows[last]),
+                '\n' + '\n'.join(rows)]]
 
         # replace 1 line and add in the middle, if needed
-        all_rows = self._rows
-        print "***", all_rows
-        self._rows = all_rows[:row] + rows + all_rows[row+1:]
-        print '###', self._rows
+        self._rows.splice(row, row+1, rows)
+
+        # new lines are unlocked: move the locks below them
+        if len(rows) > 1:
+            self._locks.shift(row, len(rows)-1)
 
-        # do tha same to locks
-        all_lock_rows = self._lock_rows
-        self._lock_rows = \
-            all_lock_rows[:row] + lock_rows + all_lock_rows[row:]
+        if len(rows) == 1:
+            self._log_change(row, row+1, ops)
+        else:
+            # new lines move every row below
+            self._log_change(row, None, ops)
 
         LOG.debug('Writed!')
 
+    def apply_operations(self, client_uid, revision, ops):
+        '''
+        Apply operations (see ot.py) a client made on a revision, after
+        transforming them by every later change: the operations applied.
+        Row locks are not needed (nor respected). If an operation is
+        invalid, nothing is applied. Operations transformed to nothing
+        (already done by others) are logged empty: the client knows the
+        server has them.
+        '''
+        for change_revision, author, done in \
+                self.operations_since(revision):
+            done, ops = ot.transform_pair(done, ops)
+
+        undo = []
+        try:
+            for op in ops:
+                undo.append(ot.apply(self._rows, op))
+        except ot.InvalidOperation:
+            for op in reversed(undo):
+                ot.apply(self._rows, op)
+            raise
+        if not ops:
+            self._log_change(0, 0, ops, client_uid)
+            return ops
+
+        start = min(op[1] for op in ops)
+        stop = max(op[1] for op in ops) + 1
+        for op in ops:
+            added = ot.rows_added(op)
+            if added:
+                # the row of the operation keeps its lock (in write, the
+                # lock goes with the row to the last new line)
+                self._locks.shift(op[1] + 1, added)
+                stop = None
+        self._log_change(start, stop, ops, client_uid)
+        return ops
+
     def lock(self, client_uid, row):
-        if len(self._lock_rows) <= row:
-            # if create a new line, lock it
-            self._lock_rows.append(None)
-
-        if self._lock_rows[row] is not None and \
-                not self._lock_rows[row].can_unlock(client_uid):
-            LOG.debug("client %s try to replace a lock by %s" % (
-                    client_uid, self._lock_rows[row]._client_uid,
-                ))
+        owner = self._locks.owner(row)
+        if owner is not None and owner != client_uid:
+            LOG.debug("client %s try to replace a lock by %s",
+                    client_uid, owner)
             raise self.LockDenied()
 
         # update the lock
-        if self._lock_rows[row]:
-            LOG.debug('Update lock line %i from %s to %s' % (
+        if owner:
+            LOG.debug('Update lock line %i from %s to %s',
                     row,
-                    self._lock_rows[row]._client_uid,
-                    client_uid,))
+                    owner,
+                    client_uid)
         else:
-            LOG.debug('Lock line %i' % row)
-        self._lock_rows[row] = Lock(client_uid)
-        LOG.debug('Lock status from %s: %s' % (
-            self._uid, self._lock_rows))
+            LOG.debug('Lock line %i', row)
+        self._locks.lock(row, client_uid)
+        LOG.debug('Lock status from %s: %s',
+            self._uid, self._locks)
 
     def unlock(self, client_uid, row):
-        if self._lock_rows[row] is None:
+        owner = self._locks.owner(row)
+        if owner is None:
             # no lock?! ok, no one care
-            LOG.warning('Unlocking a non-locked line: %s:%s' % (
-                self._uid, row))
+            LOG.warning('Unlocking a non-locked line: %s:%s',
+                self._uid, row)
             return True
-        if not self._lock_rows[row].can_unlock(client_uid):
+        if owner != client_uid:
             assert False
-        self._lock_rows[row] = None
+        self._locks.unlock(row)
 
-        LOG.debug('Lock status from %s: %s' % (
-            self._uid, self._lock_rows))
+        LOG.debug('Lock status from %s: %s',
+            self._uid, self._locks)
 
     def unlock_all(self, client_uid):
-        for row in xrange(len(self._lock_rows)):
-            if self._lock_rows[row] and \
-                    self._lock_rows[row].can_unlock(client_uid):
-                self.unlock(client_uid, row)
+        self._locks.unlock_all(client_uid)
 
     def is_locked_by(self, client_uid, row):
-        if self._lock_rows[row] is None:
-            return False
-        return self._lock_rows[row]._client_uid == client_uid
+        return self._locks.owner(row) == client_uid
+
+    def locked_rows(self, client_uid):
+        '''
+        Rows locked by a client
+        '''
+        return self._locks.rows_of(client_uid)
+
+    def locks_of_others(self, client_uid):
+        '''
+        How many rows are locked by other clients
+        '''
+        return len(self._locks) - len(self._locks.rows_of(client_uid))
 
 
 class Server(object):
+    # operation: types of its arguments (after the document uid)
+    BATCH_OPERATIONS = {
+        'lock': ('row',),
+        'unlock': ('row',),
+        'write': ('row', 'text'),
+        'lock_write': ('row', 'text'),
+        'write_delta': ('row', 'delta'),
+        'lock_write_delta': ('row', 'delta'),
+        'read': ('row',),
+        'rows': ('row', 'row'),
+        'row_count': (),
+    }
 
-    def __init__(self):
-        self._documents = {}
+    _WRITES = frozenset(['write', 'lock_write', 'write_delta',
+        'lock_write_delta'])
+    _READS = frozenset(['read', 'rows', 'row_count'])
+
+    class InvalidOperation(Exception): # unknown operation in a batch
+        pass
+
+    class ReadOnly(Exception): # a viewer cannot lock or write
+        pass
+
+    class UnknownImport(Exception): # committed, aborted or expired
+        pass
+
+    def __init__(self, storage=None, max_documents=None, max_rows=None,
+            lock_lease=LOCK_LEASE, stats_interval=None):
+        load = save = None
+        if storage is not None:
+            # without a storage, documents cannot leave the memory
+            load = self._load_document
+            save = self._save_documents
+        self._documents = DocumentCache(load, save, self._can_evict,
+            max_documents=max_documents, max_rows=max_rows)
+        # document uid: {client uid: callback}
+        self._subscribers = {}
+        # (document uid, client uid) of read-only clients (see open_document)
+        self._viewers = set()
+        self._subscribers_lock = threading.Lock()
+        self._storage = storage
+        # (document uid, client uid): expiry of its locks in the document
+        self._leases = Leases(lock_lease, self._expire_leases)
+        self._expired_locks = 0
+        # imports and exports in chunks, dropped if not used (see Leases)
+        # import uid: (document uid, client uid, rows, lock of its calls)
+        self._imports = {}
+        self._exports = {} # (document uid, client uid): Snapshot
+        self._transfers_lock = threading.Lock()
+        self._transfers = Leases(TRANSFER_TIMEOUT, self._expire_transfers)
+        # calls of every method: see get_stats
+        self._stats = stats.Stats()
+        stats.instrument(self, self._stats, exclude=['get_stats', 'close'])
+        self._dumper = None
+        if stats_interval:
+            self._dumper = stats.Dumper(self.get_stats, LOG, stats_interval)
+
+    def close(self):
+        '''
+        Stop the threads of the server (not its storage: see Storage.close)
+        '''
+        self._leases.close()
+        self._transfers.close()
+        if self._dumper is not None:
+            self._dumper.close()
+
+    def _load_document(self, uid):
+        if not self._storage.exists(uid):
+            return None
+        LOG.debug('Loading document %s', uid)
+        return self._storage.load(Document(uid))
+
+    def _save_documents(self, documents):
+        # wait for their snapshots only, not for the whole queue
+        saved = [self._storage.snapshot(document) for document in documents]
+        for done in saved:
+            done.wait()
+        # not the ones whose snapshot failed
+        return [document for document in documents \
+            if self._storage.snapshot_revision(document.uid) >= \
+                document.revision]
+
+    def _can_evict(self, document):
+        with document.reading():
+            idle = document.is_idle()
+        with self._subscribers_lock:
+            return idle and not self._subscribers.get(document.uid)
+
+    def _expire_leases(self, leases):
+        for document_uid, client_uid in leases:
+            document = self._documents.peek(document_uid)
+            if document is None:
+                continue # evicted documents have no locks
+            with document.writing():
+                rows = len(document.locked_rows(client_uid))
+                document.unlock_all(client_uid)
+            self._expired_locks += rows
+            LOG.debug('Lease of %s in %s expired: %i locks released',
+                client_uid, document_uid, rows)
+
+    def _expire_transfers(self, keys):
+        with self._transfers_lock:
+            for key in keys:
+                if key[0] == 'import':
+                    self._imports.pop(key[1], None)
+                else:
+                    self._exports.pop(key[1:], None)
+        LOG.debug('Imports and exports expired: %s', keys)
+
+    def get_lease_stats(self):
+        '''
+        Active leases, expired leases and locks released by expiry
+        '''
+        return self._lease_stats()
+
+    def _lease_stats(self):
+        # also in get_stats (not counted as a call, see stats.instrument)
+        return {
+            'leases': len(self._leases),
+            'expired_leases': self._leases.expired,
+            'expired_locks': self._expired_locks,
+        }
+
+    def get_cache_stats(self):
+        '''
+        Documents in memory and hits, misses and evictions of the cache
+        '''
+        return self._documents.stats()
+
+    def get_stats(self):
+        '''
+        Calls, errors, latency and payload size of every method (see
+        stats.py), rows in memory, lock contention, cache and leases
+        '''
+        rows = contended = 0
+        wait_time = 0.0
+        for document in self._documents.values():
+            rows += len(document.rows)
+            document_contended, document_wait = document.lock_contention()
+            contended += document_contended
+            wait_time += document_wait
+        return {
+            'methods': self._stats.snapshot(),
+            'rows': rows,
+            'lock_contention': {
+                'contended': contended,
+                'wait_time': wait_time,
+            },
+            'cache': self._documents.stats(),
+            'leases': self._lease_stats(),
+        }
+
+    def _may_block(self, name, args):
+        '''
+        Can a call wait for the disk (a document loaded, or evicted ones
+        saved)? Single thread transports run those ones elsewhere.
+        '''
+        if self._storage is None:
+            return False
+        if name in ('new_document', 'create_document'):
+            return True # other documents can be evicted
+        if len(args) < 2 or not isinstance(args[1], basestring):
+            return False
+        uid = args[1]
+        if name in ('append_rows', 'commit_import', 'abort_import'):
+            uid = document_of_import(uid)
+        return uid not in self._documents
 
     def register_client(self):
         '''
@@ -134,41 +638,116 @@ class Server(object):
         return client_uid
 
     def _get_document(self, uid):
-        if uid in self._documents:
-            return self._documents[uid]
-        LOG.warning("Trying to open a nonexistent %s document (%s)" % (
+        document = self._documents.get(uid)
+        if document is not None:
+            return document
+        LOG.warning("Trying to open a nonexistent %s document (%i in memory)",
                 uid,
-                self._documents.keys(),
-            ))
+                len(self._documents))
         raise Document.DoesNotExist()
 
     def new_document(self, client_uid):
-        document_uid = u'D%s' % uuid.uuid4()
-        self._documents[document_uid] = Document(document_uid)
-        LOG.debug("New document: %s (by %s)" % (
+        return self.create_document(client_uid, u'D%s' % uuid.uuid4())
+
+    def create_document(self, client_uid, document_uid):
+        '''
+        New document with a chosen uid (by a shard router)
+        '''
+        if self._documents.get(document_uid) is not None:
+            raise Document.AlreadyExists()
+        document = Document(document_uid)
+        self._documents[document_uid] = document
+        if self._storage is not None:
+            self._storage.log_create(document)
+        LOG.debug("New document: %s (by %s)",
                 document_uid,
-                client_uid,
-            ))
-        LOG.debug('Document %s created!' % document_uid)
+                client_uid)
+        LOG.debug('Document %s created!', document_uid)
         return document_uid
 
-    def open_document(self, client_uid, document_uid):
-        LOG.debug('Client %s open document %s' % (
-            client_uid, document_uid))
+    def open_document(self, client_uid, document_uid, read_only=False):
+        '''
+        A read-only client (a viewer) cannot lock or write. Its reads come
+        from the Snapshot of a revision, shared by every viewer, with the
+        results made once by revision. Only the first read after a write
+        waits for the writers, to freeze the rows; the other reads of that
+        revision take no lock.
+        '''
+        LOG.debug('Client %s open document %s (read only: %s)',
+            client_uid, document_uid, read_only)
         document = self._get_document(document_uid)
+        if read_only:
+            self._viewers.add((document_uid, client_uid))
+        else:
+            self._viewers.discard((document_uid, client_uid))
         return document_uid
 
+    def _is_viewer(self, client_uid, document_uid):
+        return (document_uid, client_uid) in self._viewers
+
+    def _check_writer(self, client_uid, document_uid):
+        if (document_uid, client_uid) in self._viewers:
+            raise self.ReadOnly(document_uid)
+
+    def _snapshot(self, document):
+        '''
+        The Snapshot of the current revision, made by the first reader
+        (freezing packs the rows changed: it waits for the writers)
+        '''
+        snapshot = document.get_frozen()
+        if snapshot is None:
+            with document.writing():
+                snapshot = document.freeze()
+        return snapshot
+
     def close_document(self, client_uid, document_uid):
+        self._viewers.discard((document_uid, client_uid))
         document = self._get_document(document_uid)
-        document.write_file()
-        document.unlock_all(client_uid)
-        LOG.debug('Document %s closed' % document_uid)
+        with document.writing():
+            document.unlock_all(client_uid)
+        self._leases.release((document_uid, client_uid))
+        if self._storage is not None:
+            self._storage.snapshot(document)
+        self.unsubscribe(client_uid, document_uid)
+        LOG.debug('Document %s closed', document_uid)
+
+    def subscribe(self, client_uid, document_uid, callback):
+        '''
+        Call callback.document_changed(document_uid, revision) after every
+        write of another client. The callback should be a oneway Pyro method.
+        '''
+        self._get_document(document_uid)
+        LOG.debug('Client %s subscribed to %s', client_uid, document_uid)
+        with self._subscribers_lock:
+            subscribers = self._subscribers.setdefault(document_uid, {})
+            subscribers[client_uid] = callback
+        return True
+
+    def unsubscribe(self, client_uid, document_uid):
+        with self._subscribers_lock:
+            subscribers = self._subscribers.get(document_uid, {})
+            return subscribers.pop(client_uid, None) is not None
+
+    def _notify_subscribers(self, client_uid, document_uid, revision):
+        with self._subscribers_lock:
+            subscribers = self._subscribers.get(document_uid, {}).items()
+        for subscriber_uid, callback in subscribers:
+            if subscriber_uid == client_uid:
+                continue # who write already know
+            try:
+                callback.document_changed(document_uid, revision)
+            except Exception, exp:
+                # the client will get the changes polling
+                LOG.warning('Callback of %s failed, unsubscribed: %s',
+                    subscriber_uid, exp)
+                self.unsubscribe(subscriber_uid, document_uid)
 
     def unlock_document(self, client_uid, document_uid, row):
-        LOG.debug('try unlock %s(%s) by %s' % (document_uid, row, client_uid))
+        LOG.debug('try unlock %s(%s) by %s', document_uid, row, client_uid)
         document = self._get_document(document_uid)
         try:
-            document.unlock(client_uid, row)
+            with document.writing():
+                document.unlock(client_uid, row)
             LOG.debug('unlocked')
         except Document.LockDenied:
             LOG.debug('unlock denied!')
@@ -176,10 +755,13 @@ class Server(object):
         return False
 
     def lock_document(self, client_uid, document_uid, row):
-        LOG.debug('try lock %s(%s) by %s' % (document_uid, row, client_uid))
+        LOG.debug('try lock %s(%s) by %s', document_uid, row, client_uid)
+        self._check_writer(client_uid, document_uid)
         document = self._get_document(document_uid)
         try:
-            document.lock(client_uid, row)
+            with document.writing():
+                document.lock(client_uid, row)
+            self._leases.renew((document_uid, client_uid))
             LOG.debug('locked')
         except Document.LockDenied:
             LOG.debug('locked denied!')
@@ -187,41 +769,533 @@ class Server(object):
         return True
 
     def write_document(self, client_uid, document_uid, row, text):
-        LOG.debug('Writing %s by %s: %s' % (document_uid, client_uid, text))
+        LOG.debug('Writing %s by %s: %s', document_uid, client_uid, text)
+        self._check_writer(client_uid, document_uid)
         document = self._get_document(document_uid)
-        document.write(row, text)
+        with document.writing():
+            revision = self._write(document, row, text)
+        self._leases.renew((document_uid, client_uid))
+        self._notify_subscribers(client_uid, document_uid, revision)
         return document_uid
 
+    def write_document_delta(self, client_uid, document_uid, row, delta):
+        '''
+        Write just the changed part of a row (see delta.py). False if the
+        row is not the one the delta was made from: send the full row.
+        '''
+        LOG.debug('Writing a delta of %s(%s) by %s',
+            document_uid, row, client_uid)
+        self._check_writer(client_uid, document_uid)
+        document = self._get_document(document_uid)
+        with document.writing():
+            revision = self._write_delta(document, row, delta)
+        if revision is None:
+            LOG.debug('delta denied!')
+            return False
+        self._leases.renew((document_uid, client_uid))
+        self._notify_subscribers(client_uid, document_uid, revision)
+        return True
+
+    def lock_and_write_document(self, client_uid, document_uid, row, text):
+        '''
+        Lock a row and write it, with no other call in the middle.
+        False if the row is locked by another client (nothing is written).
+        '''
+        LOG.debug('Lock and write %s(%s) by %s',
+            document_uid, row, client_uid)
+        self._check_writer(client_uid, document_uid)
+        document = self._get_document(document_uid)
+        with document.writing():
+            try:
+                document.lock(client_uid, row)
+            except Document.LockDenied:
+                LOG.debug('locked denied!')
+                return False
+            revision = self._write(document, row, text)
+        self._leases.renew((document_uid, client_uid))
+        self._notify_subscribers(client_uid, document_uid, revision)
+        return True
+
+    def commit_rows(self, client_uid, document_uid, writes, unlocks=()):
+        '''
+        Many rows in one call: lock and write each (row, text) of writes,
+        then unlock the rows of unlocks. A list with, for each write, True
+        or False if the row is locked by another client (not written).
+        '''
+        ops = [('lock_write', document_uid, row, text) \
+            for row, text in writes]
+        ops += [('unlock', document_uid, row) for row in unlocks]
+        return self.execute_batch(client_uid, ops)[:len(writes)]
+
+    def execute_batch(self, client_uid, ops):
+        '''
+        Run a list of operations, in order, with every document used locked
+        during the whole batch: no other call sees a half done batch.
+        Each operation is a tuple (name, document uid, arguments...):
+            ('lock', document_uid, row) -> True or False (denied)
+            ('unlock', document_uid, row) -> True if it was locked by us
+            ('write', document_uid, row, text) -> the new revision
+            ('lock_write', document_uid, row, text) -> True or False
+            ('write_delta', document_uid, row, delta) -> the new revision,
+                or None if the delta is not for the row (see delta.py)
+            ('lock_write_delta', document_uid, row, delta) -> True, False
+                (locked) or None (not for the row)
+            ('read', document_uid, row) -> text, or None if no row
+            ('rows', document_uid, start, stop) -> list of texts
+            ('row_count', document_uid) -> int
+        Return the list of results, one by operation. An invalid operation
+        (unknown, or with wrong arguments) raises InvalidOperation before
+        anything is done: a batch is done entirely or not at all.
+        '''
+        ops = [tuple(op) for op in ops]
+        for op in ops:
+            self._check_batch_operation(op)
+        LOG.debug('Batch of %i operations by %s', len(ops), client_uid)
+
+        documents = {}
+        for op in ops:
+            if op[0] not in self._READS:
+                self._check_writer(client_uid, op[1])
+            if op[1] not in documents:
+                documents[op[1]] = self._get_document(op[1])
+        # always in the same order, to not deadlock with other batches
+        locking = [documents[uid] for uid in sorted(documents)]
+        written = {}
+        try:
+            return self._run_batch(client_uid, ops, documents, locking,
+                written)
+        finally:
+            # even if it failed: what was done has a lease and is seen
+            for document_uid in documents:
+                self._leases.renew((document_uid, client_uid))
+            for document_uid, revision in written.items():
+                self._notify_subscribers(client_uid, document_uid, revision)
+
+    def _check_batch_operation(self, op):
+        kinds = self.BATCH_OPERATIONS.get(op[0]) if op else None
+        if kinds is None or len(op) != len(kinds) + 2:
+            raise self.InvalidOperation(repr(op))
+        for kind, value in zip(kinds, op[2:]):
+            if kind == 'row':
+                valid = isinstance(value, (int, long)) and value >= 0
+            elif kind == 'text':
+                valid = isinstance(value, basestring)
+            else: # a delta: [start, end, text, checksum]
+                valid = isinstance(value, (list, tuple)) and \
+                    len(value) == 4 and isinstance(value[2], basestring) and \
+                    all(isinstance(value[i], (int, long)) for i in (0, 1, 3))
+            if not valid:
+                raise self.InvalidOperation(repr(op))
+
+    def _run_batch(self, client_uid, ops, documents, locking, written):
+        if locking:
+            with locking[0].writing():
+                return self._run_batch(client_uid, ops, documents,
+                    locking[1:], written)
+
+        results = []
+        for op in ops:
+            name, document_uid, args = op[0], op[1], op[2:]
+            document = documents[document_uid]
+            result = getattr(self, '_batch_%s' % name)(
+                client_uid, document, *args)
+            if name in self._WRITES and result:
+                written[document_uid] = document.revision
+            results.append(result)
+        return results
+
+    def _batch_lock(self, client_uid, document, row):
+        try:
+            document.lock(client_uid, row)
+        except Document.LockDenied:
+            return False
+        return True
+
+    def _batch_unlock(self, client_uid, document, row):
+        if not document.is_locked_by(client_uid, row):
+            return False
+        document.unlock(client_uid, row)
+        return True
+
+    def _batch_write(self, client_uid, document, row, text):
+        return self._write(document, row, text)
+
+    def _batch_lock_write(self, client_uid, document, row, text):
+        if not self._batch_lock(client_uid, document, row):
+            return False
+        self._write(document, row, text)
+        return True
+
+    def _batch_write_delta(self, client_uid, document, row, delta):
+        return self._write_delta(document, row, delta)
+
+    def _batch_lock_write_delta(self, client_uid, document, row, delta):
+        if not self._batch_lock(client_uid, document, row):
+            return False
+        if self._write_delta(document, row, delta) is None:
+            return None
+        return True
+
+    def _batch_read(self, client_uid, document, row):
+        if row >= len(document.rows):
+            return None
+        return document.rows[row]
+
+    def _batch_rows(self, client_uid, document, start, stop):
+        return document.rows.get_range(start, stop)
+
+    def _batch_row_count(self, client_uid, document):
+        return len(document.rows)
+
+    def _write(self, document, row, text):
+        '''
+        Write and log a row (inside document.writing()): the new revision
+        '''
+        document.write(row, text)
+        if self._storage is not None:
+            self._storage.log_write(document, document.revision, row, text)
+        return document.revision
+
+    def _write_delta(self, document, row, delta):
+        '''
+        Like _write, with a delta: None if it is not for the row
+        '''
+        if not 0 <= row < len(document.rows):
+            return None
+        text = apply_delta(document.rows[row], delta)
+        if text is None:
+            return None
+        return self._write(document, row, text)
+
     def get_document_row_count(self, client_uid, document_uid):
-        LOG.debug('Client %s request %s row count' % (
-            client_uid, document_uid))
+        LOG.debug('Client %s request %s row count',
+            client_uid, document_uid)
         document = self._get_document(document_uid)
-        total = len(document.rows)
-        LOG.debug('Result: %i' % total)
+        if self._is_viewer(client_uid, document_uid):
+            return len(self._snapshot(document).rows)
+        with document.reading():
+            total = len(document.rows)
+        LOG.debug('Result: %i', total)
         return total
 
     def get_document_row(self, client_uid, document_uid, row):
-        LOG.debug('Client %s request %s %s row' % (
-            client_uid, document_uid, row))
+        LOG.debug('Client %s request %s %s row',
+            client_uid, document_uid, row)
         document = self._get_document(document_uid)
-        LOG.debug(repr(document.rows[row]))
-        return document.rows[row]
+        if self._is_viewer(client_uid, document_uid):
+            return self._snapshot(document).rows[row]
+        with document.reading():
+            text = document.rows[row]
+        LOG.debug('%r', text)
+        return text
+
+    def get_document_rows(self, client_uid, document_uid, start, stop):
+        '''
+        Many rows in just one call: from start to stop (not included)
+        '''
+        LOG.debug('Client %s request %s rows %s:%s',
+            client_uid, document_uid, start, stop)
+        document = self._get_document(document_uid)
+        if self._is_viewer(client_uid, document_uid):
+            snapshot = self._snapshot(document)
+            return snapshot.result(('rows', start, stop),
+                lambda: snapshot.rows.get_range(start, stop))
+        with document.reading():
+            return document.rows.get_range(start, stop)
+
+    def get_document_snapshot(self, client_uid, document_uid):
+        '''
+        All rows of a document
+        '''
+        LOG.debug('Client %s request %s snapshot',
+            client_uid, document_uid)
+        document = self._get_document(document_uid)
+        if self._is_viewer(client_uid, document_uid):
+            snapshot = self._snapshot(document)
+            return snapshot.result(('snapshot',),
+                lambda: list(snapshot.rows))
+        with document.reading():
+            return list(document.rows)
+
+    def get_changes_since(self, client_uid, document_uid, revision,
+            deltas=False):
+        '''
+        Rows changed after a revision (except the ones locked by the client).
+        If the document does not remember that revision, "full" is True and
+        every row is sent.
+        With deltas, rows changed only inside themselves go in "deltas":
+        [(row, delta)] from the row in that revision (see delta.py).
+        '''
+        document = self._get_document(document_uid)
+        if self._is_viewer(client_uid, document_uid):
+            # a viewer has no locks: the same result for every viewer
+            def changes():
+                with document.reading():
+                    return self._changes_since(document, client_uid,
+                        revision, deltas)
+            return self._snapshot(document).result(
+                ('changes', revision, deltas), changes)
+        with document.reading():
+            return self._changes_since(document, client_uid, revision,
+                deltas)
+
+    def _changes_since(self, document, client_uid, revision, deltas):
+        rows = document.changed_rows(revision)
+        full = rows is None
+        if full:
+            LOG.debug('Client %s get a full %s snapshot',
+                client_uid, document.uid)
+            changes = enumerate(document.rows)
+        else:
+            changes = [(row, document.rows[row]) for row in rows]
+        locked = document.locked_rows(client_uid)
+        row_deltas = {}
+        if deltas and not full:
+            row_deltas = document.row_deltas(revision)
+        sent_rows = []
+        sent_deltas = []
+        for row, text in changes:
+            if row in locked:
+                continue
+            delta = row_deltas.get(row)
+            if delta is not None and worth(delta, text):
+                sent_deltas.append((row, delta))
+            else:
+                sent_rows.append((row, text))
+        result = {
+            'revision': document.revision,
+            'row_count': len(document.rows),
+            'full': full,
+            'rows': sent_rows,
+        }
+        if deltas:
+            result['deltas'] = sent_deltas
+        return result
+
+    def wait_for_changes(self, client_uid, document_uid, revision, timeout,
+            deltas=False):
+        '''
+        Long poll: like get_changes_since, but wait (up to timeout seconds)
+        until the document has a revision newer than revision
+        '''
+        document = self._get_document(document_uid)
+        document.wait_for_revision(revision, min(timeout, MAX_WAIT))
+        return self.get_changes_since(client_uid, document_uid, revision,
+            deltas)
+
+    def apply_operations(self, client_uid, document_uid, revision, ops):
+        '''
+        Edit with operations (see ot.py) made on a revision, with no row
+        locks: operations of other clients in the middle are merged.
+        The new revision. Raise Document.RevisionTooOld if the document
+        does not remember that revision (get a full snapshot again).
+        '''
+        LOG.debug('Client %s apply %i operations to %s on revision %i',
+            client_uid, len(ops), document_uid, revision)
+        self._check_writer(client_uid, document_uid)
+        document = self._get_document(document_uid)
+        with document.writing():
+            ops = document.apply_operations(client_uid, revision, ops)
+            revision = document.revision
+            if self._storage is not None:
+                self._storage.log_operations(document, revision, ops)
+        self._notify_subscribers(client_uid, document_uid, revision)
+        return revision
+
+    def get_operations_since(self, client_uid, document_uid, revision):
+        '''
+        Every change after a revision, as operations (even the writes):
+        {'revision': last revision, 'changes': [(revision, client uid or
+        None, operations)]}. "changes" is None if the document does not
+        remember that revision.
+        '''
+        document = self._get_document(document_uid)
+        with document.reading():
+            try:
+                changes = document.operations_since(revision)
+            except Document.RevisionTooOld:
+                changes = None
+            return {
+                'revision': document.revision,
+                'changes': changes,
+            }
+
+    def wait_for_operations(self, client_uid, document_uid, revision,
+            timeout):
+        '''
+        Long poll: like get_operations_since, but wait (up to timeout
+        seconds) until the document has a revision newer than revision
+        '''
+        document = self._get_document(document_uid)
+        document.wait_for_revision(revision, min(timeout, MAX_WAIT))
+        return self.get_operations_since(client_uid, document_uid, revision)
 
     def list_changed_lines(self, client_uid, document_uid):
         ## LOG.debug("Client %s requested changes of %s" % (
         ##     client_uid, document_uid))
         document = self._get_document(document_uid)
-        return [i for i in xrange(len(document.rows)) \
-            if not document.is_locked_by(client_uid, i)]
+        if self._is_viewer(client_uid, document_uid):
+            snapshot = self._snapshot(document)
+            return snapshot.result(('lines',),
+                lambda: range(len(snapshot.rows)))
+        with document.reading():
+            locked = document.locked_rows(client_uid)
+            return [i for i in xrange(len(document.rows)) if i not in locked]
+
+    def begin_import(self, client_uid, document_uid):
+        '''
+        Start to replace every row of a document: rows are sent with
+        append_rows (in chunks, without locking the document) and replace
+        the old ones at once with commit_import. The import uid: it has
+        the document uid, to find its shard (see document_of_import).
+        '''
+        self._check_writer(client_uid, document_uid)
+        self._get_document(document_uid)
+        import_uid = u'I%s.%s' % (uuid.uuid4(), document_uid)
+        with self._transfers_lock:
+            self._imports[import_uid] = (document_uid, client_uid,
+                RowStore(), threading.Lock())
+        self._transfers.renew(('import', import_uid))
+        LOG.debug('Import %s into %s by %s', import_uid, document_uid,
+            client_uid)
+        return import_uid
+
+    def _get_import(self, client_uid, import_uid):
+        with self._transfers_lock:
+            transfer = self._imports.get(import_uid)
+        if transfer is None or transfer[1] != client_uid:
+            raise self.UnknownImport(import_uid)
+        return transfer
+
+    def _close_import(self, import_uid):
+        # inside the lock of the import: no call uses it after this
+        with self._transfers_lock:
+            self._imports.pop(import_uid, None)
+        self._transfers.release(('import', import_uid))
+
+    def append_rows(self, client_uid, import_uid, rows):
+        '''
+        Rows at the end of an import (rows with "\n" are split): the rows
+        imported so far
+        '''
+        document_uid, owner, store, lock = self._get_import(client_uid,
+            import_uid)
+        lines = []
+        for row in rows:
+            lines.extend(row.split('\n'))
+        with lock:
+            # committed in the middle: the rows are the document now
+            self._get_import(client_uid, import_uid)
+            store.insert(len(store), lines)
+            store.compact() # packed while waiting the commit
+            self._transfers.renew(('import', import_uid))
+            return len(store)
+
+    def commit_import(self, client_uid, import_uid):
+        '''
+        Replace the rows of the document by the rows imported: the new
+        revision. Raise Document.LockDenied if another client has locks
+        in the document (the import can be committed later).
+        '''
+        document_uid, owner, store, lock = self._get_import(client_uid,
+            import_uid)
+        document = self._get_document(document_uid)
+        with lock:
+            self._get_import(client_uid, import_uid) # not committed twice
+            with document.writing():
+                if document.locks_of_others(client_uid):
+                    raise Document.LockDenied()
+                if not len(store):
+                    store.append('')
+                # no copy: the rows are the document
+                document.set_rows(store)
+                revision = document.revision
+                if self._storage is not None:
+                    # logged too: the snapshot may fail
+                    self._storage.log_rows(document, revision,
+                        document.freeze().rows)
+            self._close_import(import_uid)
+        if self._storage is not None:
+            self._storage.snapshot(document)
+        LOG.debug('Import %s committed: %i rows in %s',
+            import_uid, len(store), document_uid)
+        self._notify_subscribers(client_uid, document_uid, revision)
+        return revision
+
+    def abort_import(self, client_uid, import_uid):
+        '''
+        Forget an import not committed
+        '''
+        lock = self._get_import(client_uid, import_uid)[3]
+        with lock:
+            self._close_import(import_uid)
+
+    def export_rows(self, client_uid, document_uid, start, chunk_size):
+        '''
+        Rows of a document from start, chunk_size at most (and no more
+        than EXPORT_CHUNK): {'revision': revision of the rows, 'rows':
+        [texts], 'next': start of the next chunk or None in the end}.
+        The chunks of an export (from 0 to the end) are of the same
+        revision, unless it expired: then "revision" changes.
+        '''
+        document = self._get_document(document_uid)
+        key = (document_uid, client_uid)
+        snapshot = None
+        with self._transfers_lock:
+            if start:
+                snapshot = self._exports.get(key)
+        if snapshot is None:
+            snapshot = self._snapshot(document)
+        chunk_size = max(1, min(chunk_size, EXPORT_CHUNK))
+        rows = snapshot.rows.get_range(start, start + chunk_size)
+        next_start = start + len(rows)
+        with self._transfers_lock:
+            if next_start < len(snapshot.rows):
+                self._exports[key] = snapshot
+            else:
+                next_start = None
+                self._exports.pop(key, None)
+        if next_start is None:
+            self._transfers.release(('export',) + key)
+        else:
+            self._transfers.renew(('export',) + key)
+        return {
+            'revision': snapshot.revision,
+            'rows': rows,
+            'next': next_start,
+        }
 
 if __name__ == '__main__':
-    import Pyro4
-    daemon = Pyro4.Daemon(host=HOST, port=PORT)
-    server = Server()
+    import optparse
+    import storage
+    parser = optparse.OptionParser()
+    parser.add_option('--transport', choices=['pyro', 'framed'],
+        default='pyro', help='pyro (a thread by connection) or framed '
+        '(one thread, many connections: see transport.py)')
+    parser.add_option('--unix', metavar='PATH',
+        help='framed transport on a Unix socket, instead of TCP')
+    options, args = parser.parse_args()
+
     LOG.addHandler(logging.StreamHandler(sys.stdout))
+    if VERBOSE:
+        LOG.setLevel(logging.DEBUG)
+    storage.LOG.addHandler(logging.StreamHandler(sys.stdout))
+    server = Server(storage.Storage(PATH, fsync=FSYNC),
+        max_documents=MAX_DOCUMENTS, max_rows=MAX_ROWS,
+        stats_interval=STATS_INTERVAL)
 
-    Pyro4.Daemon.serveSimple({
-            server: 'documents.server',
-        }, daemon=daemon, ns=False, verbose=VERBOSE)
+    if options.transport == 'framed':
+        import transport
+        transport.LOG.addHandler(logging.StreamHandler(sys.stdout))
+        framed = transport.FramedServer(server, options.unix or (HOST, PORT))
+        if VERBOSE:
+            print 'Framed server ready on %s' % (framed.address,)
+        framed.serve_forever()
+    else:
+        import Pyro4
+        daemon = Pyro4.Daemon(host=HOST, port=PORT)
+        Pyro4.Daemon.serveSimple({
+                server: 'documents.server',
+            }, daemon=daemon, ns=False, verbose=VERBOSE)
 else:
-    LOG.addHandler(logging.NullHandler()) # run tests'
+    LOG.addHandler(logging.NullHandler()) # run tests'
\ No newline at end of file
@@ -0,0 +1,202 @@
+'''
+Many server processes, each one with a part of the documents.
+A document lives in the shard chosen by consistent hashing of its uid, so
+any router (in a process of its own or inside a client) finds it.
+
+    python shard.py 4 /tmp/shards  # 4 workers on Unix sockets + a router
+'''
+import os
+import sys
+import time
+import uuid
+import bisect
+import hashlib
+import multiprocessing
+
+from transport import FramedServer, FramedProxy
+from server import document_of_import
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+def _sum(stats):
+    '''
+    Sum of dicts of numbers (and of dicts of numbers)
+    '''
+    total = {}
+    for item in stats:
+        for key, value in item.items():
+            if isinstance(value, dict):
+                total[key] = _sum([total.get(key, {}), value])
+            else:
+                total[key] = total.get(key, 0) + value
+    return total
+
+
+class HashRing(object):
+    '''
+    Consistent hashing of uids into shards (0 to shards - 1)
+    '''
+    REPLICAS = 64 # points of each shard in the ring
+
+    def __init__(self, shards):
+        points = []
+        for shard in xrange(shards):
+            for replica in xrange(self.REPLICAS):
+                points.append((_hash(u'shard-%i-%i' % (shard, replica)), shard))
+        points.sort()
+        self._keys = [key for key, shard in points]
+        self._shards = [shard for key, shard in points]
+
+    def shard_of(self, uid):
+        i = bisect.bisect(self._keys, _hash(uid)) % len(self._keys)
+        return self._shards[i]
+
+
+class ShardRouter(object):
+    '''
+    Same methods of the Server, sent to the shard of each document.
+    Like the proxies it uses, it should be used by one thread at a time.
+    '''
+    class CrossShardBatch(Exception): # a batch with documents of 2 shards
+        pass
+
+    def __init__(self, addresses, proxy=FramedProxy):
+        self._shards = [proxy(address) for address in addresses]
+        self._ring = HashRing(len(addresses))
+
+    def _shard(self, document_uid):
+        return self._shards[self._ring.shard_of(document_uid)]
+
+    def register_client(self):
+        return u'C%s' % uuid.uuid4()
+
+    def new_document(self, client_uid):
+        '''
+        Create in the shard with less documents: a uid of that shard
+        '''
+        loads = [shard.get_cache_stats()['documents'] \
+            for shard in self._shards]
+        target = loads.index(min(loads))
+        document_uid = u'D%s' % uuid.uuid4()
+        while self._ring.shard_of(document_uid) != target:
+            document_uid = u'D%s' % uuid.uuid4()
+        return self._shards[target].create_document(client_uid, document_uid)
+
+    def execute_batch(self, client_uid, ops):
+        shards = set(self._ring.shard_of(op[1]) for op in ops)
+        if len(shards) > 1:
+            raise self.CrossShardBatch()
+        if not shards:
+            return []
+        return self._shards[shards.pop()].execute_batch(client_uid, ops)
+
+    def append_rows(self, client_uid, import_uid, rows):
+        shard = self._shard(document_of_import(import_uid))
+        return shard.append_rows(client_uid, import_uid, rows)
+
+    def commit_import(self, client_uid, import_uid):
+        shard = self._shard(document_of_import(import_uid))
+        return shard.commit_import(client_uid, import_uid)
+
+    def abort_import(self, client_uid, import_uid):
+        shard = self._shard(document_of_import(import_uid))
+        return shard.abort_import(client_uid, import_uid)
+
+    def get_cache_stats(self):
+        '''
+        Sum of the stats of every shard
+        '''
+        return _sum(shard.get_cache_stats() for shard in self._shards)
+
+    def get_lease_stats(self):
+        '''
+        Sum of the stats of every shard
+        '''
+        return _sum(shard.get_lease_stats() for shard in self._shards)
+
+    def get_stats(self):
+        '''
+        Sum of the counters of every shard, and the stats of each one in
+        "shards" (the latencies of methods cannot be summed)
+        '''
+        shards = [shard.get_stats() for shard in self._shards]
+        total = _sum(dict((key, value) for key, value in stats.items() \
+            if key != 'methods') for stats in shards)
+        total['shards'] = shards
+        return total
+
+    def __getattr__(self, name):
+        # every other method: (client_uid, document_uid, ...)
+        # (imports go by the document in their uid, see above)
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(client_uid, document_uid, *args):
+            method = getattr(self._shard(document_uid), name)
+            return method(client_uid, document_uid, *args)
+        return call
+
+    def close(self):
+        for shard in self._shards:
+            shard.close()
+
+
+def serve_shard(address, path=None):
+    '''
+    A worker: one Server (saved in path, if given) on a framed transport
+    '''
+    from server import Server
+    storage = None
+    if path is not None:
+        from storage import Storage
+        storage = Storage(path)
+    server = Server(storage)
+    try:
+        FramedServer(server, address).serve_forever()
+    finally:
+        server.close()
+
+
+def start_workers(shards, directory, persist=False):
+    '''
+    Start worker processes listening on Unix sockets in a directory.
+    Return the processes and their addresses, when they are ready.
+    '''
+    processes = []
+    addresses = []
+    for shard in xrange(shards):
+        address = os.path.join(directory, 'shard-%i.sock' % shard)
+        path = None
+        if persist:
+            path = os.path.join(directory, 'shard-%i' % shard)
+        process = multiprocessing.Process(target=serve_shard,
+            args=(address, path))
+        process.daemon = True
+        process.start()
+        processes.append(process)
+        addresses.append(address)
+
+    for address in addresses:
+        for attempt in xrange(100):
+            try:
+                FramedProxy(address).close()
+                break
+            except IOError:
+                time.sleep(0.05)
+    return processes, addresses
+
+
+if __name__ == '__main__':
+    from server import HOST, PORT
+    shards, directory = int(sys.argv[1]), sys.argv[2]
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    processes, addresses = start_workers(shards, directory, persist=True)
+    print 'Shards ready: %s' % ', '.join(addresses)
+    # clients can use a ShardRouter themselves or this one
+    router = FramedServer(ShardRouter(addresses), (HOST, PORT))
+    print 'Router ready on %s' % (router.address,)
+    router.serve_forever()
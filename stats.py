@@ -0,0 +1,195 @@
+'''
+Instrumentation of the server: counters and histograms of every RPC method
+(calls, errors, latency, payload size), shown by Server.get_stats and
+written to the log from time to time.
+'''
+import time
+import json
+import atexit
+import bisect
+import inspect
+import weakref
+import threading
+
+# upper bounds of the buckets (the last one has no bound)
+LATENCY_BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60) # seconds
+SIZE_BOUNDS = tuple(4 ** i for i in xrange(2, 13)) # characters
+SIZE_SAMPLE = 16 # items measured in a long list, to estimate its size
+
+
+class Histogram(object):
+    '''
+    Counts of values by bucket (not thread safe: see Stats)
+    '''
+    def __init__(self, bounds):
+        self._bounds = bounds
+        self._counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self._counts[bisect.bisect_left(self._bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percent):
+        '''
+        Upper bound of the bucket with the percentile (max in the last one)
+        '''
+        wanted = self.count * percent / 100.0
+        seen = 0
+        for bound, count in zip(self._bounds, self._counts):
+            seen += count
+            if seen >= wanted and seen:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            # (upper bound, count), None is no bound
+            'buckets': [(bound, count) for bound, count in
+                zip(self._bounds + (None,), self._counts) if count],
+        }
+
+
+def payload_size(value):
+    '''
+    Characters of the texts in a value: a rough size on the wire. Long
+    lists are estimated from SIZE_SAMPLE items spread along them, so the
+    cost does not depend on the rows.
+    '''
+    if isinstance(value, basestring):
+        return len(value)
+    if isinstance(value, dict):
+        value = value.values()
+    if isinstance(value, (list, tuple)):
+        if len(value) <= SIZE_SAMPLE:
+            return sum(payload_size(item) for item in value)
+        sample = value[::len(value) // SIZE_SAMPLE][:SIZE_SAMPLE]
+        return sum(payload_size(item) for item in sample) * len(value) // \
+            len(sample)
+    return 8
+
+
+class MethodStats(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.latency = Histogram(LATENCY_BOUNDS)
+        self.sizes = Histogram(SIZE_BOUNDS) # arguments + result
+
+    def snapshot(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'latency': self.latency.snapshot(),
+            'payload': self.sizes.snapshot(),
+        }
+
+
+class Stats(object):
+    '''
+    Stats of the methods of an object, by method name
+    '''
+    def __init__(self):
+        self._methods = {}
+        self._lock = threading.Lock()
+        # in a method call: methods it calls are not counted again
+        self._inside = threading.local()
+
+    def record(self, name, seconds, size, error):
+        with self._lock:
+            stats = self._methods.get(name)
+            if stats is None:
+                stats = self._methods[name] = MethodStats()
+            stats.calls += 1
+            stats.errors += error
+            stats.latency.add(seconds)
+            stats.sizes.add(size)
+
+    def snapshot(self):
+        with self._lock:
+            return dict((name, stats.snapshot())
+                for name, stats in self._methods.items())
+
+
+def _wrap(stats, name, method):
+    def call(*args, **options):
+        if getattr(stats._inside, 'call', False):
+            return method(*args, **options) # counted in the outer call
+        stats._inside.call = True
+        start = time.time()
+        error = True
+        result = None
+        try:
+            result = method(*args, **options)
+            error = False
+            return result
+        finally:
+            stats._inside.call = False
+            stats.record(name, time.time() - start,
+                payload_size(args) + payload_size(options) +
+                payload_size(result), error)
+    call.__name__ = name
+    call.__doc__ = method.__doc__
+    return call
+
+
+def instrument(obj, stats, exclude=()):
+    '''
+    Record every public method call of obj (but the excluded ones) in stats.
+    Only calls from outside are recorded, not the ones of its own methods.
+    '''
+    for name in dir(obj):
+        if name.startswith('_') or name in exclude:
+            continue
+        method = getattr(obj, name)
+        if inspect.ismethod(method):
+            setattr(obj, name, _wrap(stats, name, method))
+
+
+_dumping = weakref.WeakSet() # Dumpers running, to stop at exit
+
+
+@atexit.register
+def _close_all():
+    # stop before the interpreter tear down the modules
+    for dumper in list(_dumping):
+        dumper.close()
+
+
+class Dumper(object):
+    '''
+    Log a dict of stats (get_stats()) every interval seconds
+    '''
+    def __init__(self, get_stats, log, interval):
+        self._get_stats = get_stats
+        self._log = log
+        self._interval = interval
+        self._stop = threading.Event()
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+        self._thread = thread
+        _dumping.add(self)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        _dumping.discard(self)
+
+    def _run(self):
+        while not self._stop.wait(self._interval):
+            try:
+                self._log.info('Stats: %s', json.dumps(self._get_stats()))
+            except Exception, exp:
+                self._log.warning('Unable to dump stats: %s', exp)
@@ -0,0 +1,386 @@
+'''
+Persistence of documents.
+Every write goes to an append-only log (one per document) and, from time to
+time, the document is compacted into a snapshot. Disk access happens in a
+background thread, so RPC calls never wait for the disk.
+
+Files, in the storage path:
+    <uid>.log             JSON lines: [revision, row, text],
+                          [revision, null, operations] (see ot.py) or
+                          [revision, "rows", [texts]] (every row replaced)
+    <uid>.<revision>.snap rows joined by "\n", after that revision
+    <uid>.<revision>.idx  where each row of the snapshot starts (see
+                          rowstore.MappedRows): a big snapshot is mapped in
+                          memory and its rows read only when used
+A mapped file keeps a file descriptor open, and so does the log of each
+document written: only snapshots of MAP_ABOVE bytes are mapped (the index
+and small snapshots are read), and at most MAX_OPEN_LOGS logs are open.
+'''
+import os
+import mmap
+import json
+import time
+import Queue
+import struct
+import logging
+import threading
+from collections import OrderedDict
+
+from rowstore import RowStore
+
+MAP_ABOVE = 1024 * 1024 # bytes of a snapshot to map it instead of reading
+MAX_OPEN_LOGS = 64 # the least recently written ones are closed
+ROWS = 'rows' # the row of a log entry replacing every row
+
+LOG = logging.Logger(name="storage")
+LOG.addHandler(logging.NullHandler())
+
+
+def _encode(text):
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+
+def _write_rows(rows, data, index, batch=4096):
+    '''
+    Rows joined by "\n" in the data file and where each one starts (and
+    the end + 1) in the index file, in one pass, a batch at a time
+    '''
+    texts = []
+    offsets = [0]
+    end = 0
+    separator = ''
+    for row in rows:
+        text = _encode(row)
+        texts.append(text)
+        end += len(text) + 1
+        offsets.append(end)
+        if len(texts) == batch:
+            data.write(separator + '\n'.join(texts))
+            index.write(struct.pack('<%iQ' % len(offsets), *offsets))
+            texts = []
+            offsets = []
+            separator = '\n'
+    if texts:
+        data.write(separator + '\n'.join(texts))
+    index.write(struct.pack('<%iQ' % len(offsets), *offsets))
+
+
+def _write_entry(log, revision, row, text, batch=4096):
+    '''
+    A line of the log. The rows of a ROWS entry are streamed, a batch at a
+    time, not joined in memory.
+    '''
+    if row != ROWS:
+        log.write(json.dumps([revision, row, text]) + '\n')
+        return
+    log.write('[%i, "%s", [' % (revision, ROWS))
+    texts = []
+    separator = ''
+    for text_row in text:
+        texts.append(json.dumps(text_row))
+        if len(texts) == batch:
+            log.write(separator + ', '.join(texts))
+            texts = []
+            separator = ', '
+    if texts:
+        log.write(separator + ', '.join(texts))
+    log.write(']]\n')
+
+
+def _map(filename):
+    with open(filename, 'rb') as file_:
+        return mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _read(filename):
+    with open(filename, 'rb') as file_:
+        return file_.read()
+
+
+class Storage(object):
+    FSYNC_ALWAYS = 'always' # after every write
+    FSYNC_INTERVAL = 'interval' # at most once every fsync_interval seconds
+    FSYNC_NEVER = 'never' # let the OS decide
+
+    def __init__(self, path, fsync=FSYNC_INTERVAL, fsync_interval=1.0,
+            compact_after=1000, map_above=MAP_ABOVE,
+            max_open_logs=MAX_OPEN_LOGS):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._path = path
+        self._fsync = fsync
+        self._fsync_interval = fsync_interval
+        self._compact_after = compact_after # log entries before a snapshot
+        self._map_above = map_above
+        self._max_open_logs = max_open_logs
+
+        # used only by the flusher thread
+        self._logs = OrderedDict() # uid: log file, the last written last
+        self._log_size = {} # uid: entries after the last snapshot
+        self._snapshot_revision = {} # uid: revision of the last snapshot
+                                     # (read by snapshot_revision)
+        self._dirty = set() # uids written but not synced
+        self._last_sync = time.time()
+
+        self._queue = Queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    # called by the server: just enqueue
+
+    def log_create(self, document):
+        self._queue.put(('create', document, None))
+
+    def log_write(self, document, revision, row, text):
+        self._queue.put(('write', document, (revision, row, text)))
+
+    def log_operations(self, document, revision, ops):
+        self._queue.put(('write', document, (revision, None, ops)))
+
+    def log_rows(self, document, revision, rows):
+        '''
+        Every row replaced (rows of a Snapshot: they do not change while
+        they are written)
+        '''
+        self._queue.put(('write', document, (revision, ROWS, rows)))
+
+    def snapshot(self, document):
+        '''
+        An Event set when the snapshot is on disk or failed (the log still
+        has every write): see snapshot_revision
+        '''
+        done = threading.Event()
+        self._queue.put(('snapshot', document, done))
+        return done
+
+    def snapshot_revision(self, uid):
+        '''
+        The revision of the last snapshot on disk of a document (-1 if
+        none): what a snapshot saved
+        '''
+        return self._snapshot_revision.get(uid, -1)
+
+    def flush(self):
+        '''
+        Wait until everything enqueued is on disk
+        '''
+        self._queue.put(('sync', None, None))
+        self._queue.join()
+
+    def close(self):
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+
+    # flusher thread
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self._fsync_interval)
+            except Queue.Empty:
+                self._sync() # idle: a good time to sync
+                continue
+            if item is None:
+                self._queue.task_done()
+                break
+            kind, document, args = item
+            try:
+                if kind == 'create':
+                    self._get_log(document.uid)
+                elif kind == 'write':
+                    self._write(document, *args)
+                elif kind == 'snapshot':
+                    self._compact(document)
+                elif kind == 'sync':
+                    self._sync()
+            except Exception, exp:
+                LOG.error('Storage %s failed: %s' % (kind, exp))
+            if kind == 'snapshot':
+                args.set()
+            self._queue.task_done()
+
+        self._sync()
+        for log in self._logs.values():
+            log.close()
+        self._logs.clear()
+
+    def _filename(self, uid, extension):
+        return os.path.join(self._path, '%s.%s' % (uid, extension))
+
+    def _get_log(self, uid):
+        log = self._logs.pop(uid, None)
+        if log is None:
+            log = open(self._filename(uid, 'log'), 'a')
+            if len(self._logs) >= self._max_open_logs:
+                self._close_log(self._logs.keys()[0])
+        self._logs[uid] = log
+        return log
+
+    def _close_log(self, uid):
+        log = self._logs.pop(uid)
+        if uid in self._dirty:
+            self._dirty.discard(uid)
+            log.flush()
+            if self._fsync != self.FSYNC_NEVER:
+                os.fsync(log.fileno())
+        log.close()
+
+    def _write(self, document, revision, row, text):
+        uid = document.uid
+        if revision <= self._snapshot_revision.get(uid, 0):
+            return # already in the snapshot
+        log = self._get_log(uid)
+        _write_entry(log, revision, row, text)
+        self._dirty.add(uid)
+        if self._fsync == self.FSYNC_ALWAYS:
+            self._sync()
+        elif self._fsync == self.FSYNC_INTERVAL and \
+                time.time() - self._last_sync > self._fsync_interval:
+            self._sync()
+
+        self._log_size[uid] = self._log_size.get(uid, 0) + 1
+        if self._log_size[uid] >= self._compact_after:
+            self._compact(document)
+
+    def _sync(self):
+        for uid in self._dirty:
+            log = self._logs[uid]
+            log.flush()
+            if self._fsync != self.FSYNC_NEVER:
+                os.fsync(log.fileno())
+        self._dirty.clear()
+        self._last_sync = time.time()
+
+    def _compact(self, document):
+        '''
+        Write a snapshot (temp file + rename) and empty the log
+        '''
+        uid = document.uid
+        if document.revision <= self._snapshot_revision.get(uid, -1):
+            return # nothing new
+        # the rows written before the snapshot are cold now: packed and
+        # shared with the frozen rows (no copy of them)
+        with document.writing():
+            frozen = document.freeze()
+        revision = frozen.revision
+
+        # streamed from the frozen rows, not copied in memory
+        files = [self._filename(uid, '%i.%s' % (revision, extension)) \
+            for extension in ('idx', 'snap')]
+        index, data = [open(filename + '.tmp', 'wb') for filename in files]
+        try:
+            _write_rows(frozen.rows, data, index)
+            for file_ in (index, data):
+                file_.flush()
+                os.fsync(file_.fileno())
+        finally:
+            index.close()
+            data.close()
+        # the index first: a snapshot without it is read the slow way
+        for filename in files:
+            os.rename(filename + '.tmp', filename)
+        self._snapshot_revision[uid] = revision
+
+        # every entry in the log is older than the snapshot
+        self._dirty.discard(uid)
+        if uid in self._logs:
+            self._logs.pop(uid).close()
+        open(self._filename(uid, 'log'), 'w').close()
+        self._log_size[uid] = 0
+
+        for old_revision in self._snapshots(uid)[:-1]:
+            # a mapped snapshot stays readable after it is removed
+            os.remove(self._filename(uid, '%i.snap' % old_revision))
+            index = self._filename(uid, '%i.idx' % old_revision)
+            if os.path.exists(index):
+                os.remove(index)
+        LOG.debug('Snapshot of %s at revision %i' % (uid, revision))
+
+    # recovery
+
+    def _snapshots(self, uid):
+        '''
+        Revisions of the snapshots of a document, sorted
+        '''
+        prefix = '%s.' % uid
+        revisions = []
+        for name in os.listdir(self._path):
+            if name.startswith(prefix) and name.endswith('.snap'):
+                revisions.append(int(name[len(prefix):-len('.snap')]))
+        return sorted(revisions)
+
+    def _map_snapshot(self, uid, revision):
+        '''
+        Rows of a snapshot in a RowStore reading them from the file
+        (mapped if it is big), or None if it has no valid index
+        '''
+        filename = self._filename(uid, '%i.snap' % revision)
+        index = self._filename(uid, '%i.idx' % revision)
+        if not os.path.exists(index):
+            return None
+        size = os.path.getsize(filename)
+        count = os.path.getsize(index) // 8 - 1
+        if not size or count < 1:
+            return None # an empty file cannot be mapped (and it is fast)
+        index = _read(index)
+        if struct.unpack_from('<Q', index, 8 * count)[0] != size + 1:
+            LOG.warning('Ignoring the index of %s: not of the snapshot',
+                filename)
+            return None
+        if size >= self._map_above:
+            data = _map(filename)
+        else:
+            data = _read(filename)
+        return RowStore.mapped(data, index, count)
+
+    def exists(self, uid):
+        if os.sep in uid or uid.startswith('.'):
+            return False # not a document uid: out of the storage path
+        return os.path.exists(self._filename(uid, 'log')) or \
+            bool(self._snapshots(uid))
+
+    def load(self, document):
+        '''
+        Restore a document from its last snapshot plus its log
+        '''
+        uid = document.uid
+        revision = 0
+        rows = ['']
+        snapshots = self._snapshots(uid)
+        if snapshots:
+            revision = snapshots[-1]
+            rows = self._map_snapshot(uid, revision)
+            if rows is None:
+                file_ = open(self._filename(uid, '%i.snap' % revision))
+                rows = file_.read().decode('utf-8').split('\n')
+                file_.close()
+        document.restore(rows, revision)
+        self._snapshot_revision[uid] = revision
+
+        entries = []
+        filename = self._filename(uid, 'log')
+        if os.path.exists(filename):
+            for line in open(filename):
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # a write cut by a crash: the end of the log
+                    LOG.warning('Ignoring a broken entry in %s' % filename)
+                    break
+        # writes of many threads can be logged out of order
+        entries.sort()
+        for entry_revision, row, text in entries:
+            if entry_revision <= revision:
+                continue
+            if row is None:
+                document.apply_operations(None, document.revision, text)
+            elif row == ROWS:
+                document.restore(text, entry_revision)
+            else:
+                document.write(row, text)
+        self._log_size[uid] = len(entries)
+        return document
@@ -1,5 +1,22 @@
 import unittest
-from server import Server, Document
+import random
+import threading
+import time
+import os
+import shutil
+import tempfile
+from server import Server, Document, LockTable
+from rowstore import RowStore, group_rows
+from storage import Storage
+from cache import DocumentCache
+from leases import Leases
+from transport import FramedServer, FramedProxy, RemoteError
+import wire
+from stats import Histogram, payload_size
+from shard import HashRing, ShardRouter, start_workers
+from ot import OperationQueue, InvalidOperation, transform_pair
+from delta import make_delta, apply_delta, plan_row_edits
+from clientcore import ClientCore, Future, apply_changes
 
 class TestServerClient(unittest.TestCase):
     '''
@@ -8,6 +25,9 @@ class TestServerClient(unittest.TestCase):
     def setUp(self):
         self.server = Server()
 
+    def tearDown(self):
+        self.server.close()
+
     def test_new_client(self):
         '''
         Test to generate diferent id to clients
@@ -28,6 +48,9 @@ class TestServerDocument(unittest.TestCase):
         self.client0 = server.register_client()
         self.client1 = server.register_client()
 
+    def tearDown(self):
+        self.server.close()
+
     def test_new_document(self):
         '''
         Create a new document
@@ -74,16 +97,34 @@ class TestServerDocument(unittest.TestCase):
         document0 = server.new_document(client0)
         server.write_document(client0, document0, 0, 'row 000\nrow 001')
 
+    def test_document_rows(self):
+        '''
+        Read many rows in one call
+        '''
+        server = self.server
+        client0 = self.client0
+        document0 = server.new_document(client0)
+        server.write_document(client0, document0, 0, 'r0\nr1\nr2')
+        self.assertEqual(
+            server.get_document_rows(client0, document0, 1, 10), ['r1', 'r2'])
+        self.assertEqual(
+            server.get_document_snapshot(client0, document0),
+            ['r0', 'r1', 'r2'])
+
 class TestDocument(unittest.TestCase):
     '''
     Test document internal methods
     '''
     def setUp(self):
         server = Server()
+        self.server = server
         self.client0 = server.register_client()
         self.client1 = server.register_client()
         self.document = Document('uid')
 
+    def tearDown(self):
+        self.server.close()
+
     def test_write(self):
         '''
         Write into a document
@@ -148,74 +189,1912 @@ class TestDocument(unittest.TestCase):
             pass # ok
 
 
-class TestDocumentEdit(unittest.TestCase):
+class TestLockTable(unittest.TestCase):
     '''
-    Test document's editor methods
+    Test the index of row locks
     '''
+    def setUp(self):
+        table = LockTable()
+        table.lock(1, 'C0')
+        table.lock(3, 'C0')
+        table.lock(5, 'C1')
+        self.table = table
+
+    def test_unlock_all(self):
+        '''
+        Release every lock of a client
+        '''
+        table = self.table
+        table.unlock_all('C0')
+        self.assertEqual(len(table), 1)
+        self.assertEqual(table.rows_of('C0'), frozenset())
+        self.assertEqual(table.owner(5), 'C1')
 
+    def test_shift_insert(self):
+        '''
+        Rows inserted move the locks below them
+        '''
+        table = self.table
+        table.shift(3, 2)
+        self.assertEqual(table.rows_of('C0'), set([1, 5]))
+        self.assertEqual(table.rows_of('C1'), set([7]))
+        self.assertEqual(table.owner(3), None)
+
+    def test_shift_delete(self):
+        '''
+        Locks of removed rows are released, the ones below move up
+        '''
+        table = self.table
+        table.shift(2, -2)
+        self.assertEqual(table.rows_of('C0'), set([1]))
+        self.assertEqual(table.owner(3), 'C1')
+
+    def test_relock(self):
+        '''
+        A lock moves from a client to another
+        '''
+        table = self.table
+        table.lock(5, 'C0')
+        self.assertEqual(table.rows_of('C1'), frozenset())
+        self.assertEqual(table.rows_of('C0'), set([1, 3, 5]))
+
+
+class TestLeases(unittest.TestCase):
+    '''
+    Test lock leases and their expiry
+    '''
     def setUp(self):
-        server = Server()
-        server = server
+        self.now = 0
+        self.expired = []
+        self.leases = Leases(10, self.expired.extend, clock=lambda: self.now)
+
+    def tearDown(self):
+        self.leases.close()
+
+    def test_expire(self):
+        '''
+        Leases not renewed expire together
+        '''
+        leases = self.leases
+        leases.renew('a')
+        leases.renew('b')
+        self.now = 5
+        leases.renew('c')
+        self.assertEqual(leases.reap(9), [])
+        self.assertEqual(sorted(leases.reap(12)), ['a', 'b'])
+        self.assertEqual(self.expired, ['a', 'b'])
+        self.assertEqual(len(leases), 1)
+
+    def test_renew(self):
+        '''
+        A renewed lease does not expire in the old time
+        '''
+        leases = self.leases
+        leases.renew('a')
+        self.now = 8
+        leases.renew('a')
+        self.assertEqual(leases.reap(12), [])
+        self.assertEqual(leases.reap(18), ['a'])
+        self.assertEqual(leases.expired, 1)
+
+    def test_server(self):
+        '''
+        Locks of a client that stopped using the document are released
+        '''
+        server = Server(lock_lease=10)
         client0 = server.register_client()
         client1 = server.register_client()
+        document0 = server.new_document(client0)
+        server.write_document(client0, document0, 0, 'r0\nr1')
+        server.lock_document(client0, document0, 0)
+        server.lock_document(client0, document0, 1)
+        self.failIf(server.lock_document(client1, document0, 0))
 
-        # document with 2 lines
+        server._leases.reap(time.time() + 11)
+        self.assertTrue(server.lock_document(client1, document0, 0))
+        stats = server.get_lease_stats()
+        self.assertEqual(stats['expired_locks'], 2)
+        self.assertEqual(stats['leases'], 1) # client1
+        server.close()
+
+    def test_close(self):
+        '''
+        A closed server stops its threads (reapers and stats dumper)
+        '''
+        threads = threading.active_count()
+        server = Server(stats_interval=60)
+        client0 = server.register_client()
         document0 = server.new_document(client0)
-        server.write_document(client0, document0, 0, 'row 000\nrow 001')
+        server.lock_document(client0, document0, 0)
+        server.begin_import(client0, document0)
+        self.assertEqual(threading.active_count(), threads + 3)
+        server.close()
+        self.assertEqual(threading.active_count(), threads)
 
-        server.open_document(client1, document0)
 
+class TestDocumentChanges(unittest.TestCase):
+    '''
+    Test the revision and the log of changed rows
+    '''
+    def setUp(self):
+        server = Server()
         self.server = server
-        self.client0 = client0
-        self.client1 = client1
-        self.document = document0
+        self.client0 = server.register_client()
+        self.client1 = server.register_client()
+        self.document = server.new_document(self.client0)
+        server.write_document(self.client0, self.document, 0, 'r0\nr1\nr2')
 
-    def test_edit_different_paragraphs(self):
+    def tearDown(self):
+        self.server.close()
+
+    def test_no_changes(self):
         '''
-        Lock different paragraphs to update, by 2 different users
+        Nothing changed after the last revision
         '''
         server = self.server
-        client0 = self.client0
-        client1 = self.client1
-        document0 = self.document
+        changes = server.get_changes_since(self.client1, self.document, -1)
+        self.assertTrue(changes['full'])
+        self.assertEqual(changes['row_count'], 3)
+        changes = server.get_changes_since(self.client1, self.document,
+            changes['revision'])
+        self.failIf(changes['full'])
+        self.assertEqual(changes['rows'], [])
 
-        server.lock_document(client0, document0, 0) # lock document0, row 0
-        server.lock_document(client0, document0, 1) # lock document0, row 1
+    def test_changed_row(self):
+        '''
+        Only the written row is sent
+        '''
+        server = self.server
+        revision = server.get_changes_since(
+            self.client1, self.document, -1)['revision']
+        server.write_document(self.client0, self.document, 1, 'changed')
+        changes = server.get_changes_since(self.client1, self.document,
+            revision)
+        self.failIf(changes['full'])
+        self.assertEqual(changes['rows'], [(1, 'changed')])
+        self.assertEqual(changes['revision'], revision + 1)
 
-        server.write_document(client0, document0, 0, 'changed row 0')
-        server.write_document(client1, document0, 1, 'changed row 1')
+    def test_new_rows(self):
+        '''
+        New lines move the rows below: all of them are sent
+        '''
+        server = self.server
+        revision = server.get_changes_since(
+            self.client1, self.document, -1)['revision']
+        server.write_document(self.client0, self.document, 0, 'a\nb')
+        changes = server.get_changes_since(self.client1, self.document,
+            revision)
+        self.assertEqual([row for row, text in changes['rows']], [0, 1, 2, 3])
 
-        # write clear the lock, let's check
-        server.lock_document(client0, document0, 1) # ok, no exception
+    def test_locked_row(self):
+        '''
+        Rows locked by the client are not sent to it
+        '''
+        server = self.server
+        server.lock_document(self.client1, self.document, 1)
+        changes = server.get_changes_since(self.client1, self.document, -1)
+        self.assertEqual([row for row, text in changes['rows']], [0, 2])
 
-    def test_edit_same_paragraph(self):
+    def test_truncated_log(self):
         '''
-        2 users try to edit the same paragraph, at same time
+        An old revision, lost from the log, gets a full snapshot
         '''
         server = self.server
-        client0 = self.client0
-        client1 = self.client1
-        document0 = self.document
+        document = server._get_document(self.document)
+        revision = document.revision
+        for i in xrange(Document.CHANGE_LOG_SIZE + 1):
+            server.write_document(self.client0, self.document, 0, 'r%i' % i)
+        changes = server.get_changes_since(self.client1, self.document,
+            revision)
+        self.assertTrue(changes['full'])
+        self.assertEqual(len(changes['rows']), 3)
 
-        server.lock_document(client0, document0, 0) # lock document0, row 0
-        self.failIf(
-            # lock document0, row 0
-            server.lock_document(client1, document0, 0)
-        )
 
-    def test_edit_same_paragraph_same_user(self):
+class TestDocumentNotify(unittest.TestCase):
+    '''
+    Test change notifications: long poll and callbacks
+    '''
+    class Callback(object):
+        def __init__(self, fail=False):
+            self.fail = fail
+            self.calls = []
+
+        def document_changed(self, document_uid, revision):
+            if self.fail:
+                raise IOError('client is gone')
+            self.calls.append((document_uid, revision))
+
+    def setUp(self):
+        server = Server()
+        self.server = server
+        self.client0 = server.register_client()
+        self.client1 = server.register_client()
+        self.document = server.new_document(self.client0)
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_wait_timeout(self):
         '''
-        1 users try to get 2x the same paragraph
+        Nobody writes: return after the timeout without changes
         '''
         server = self.server
-        client0 = self.client0
-        document0 = self.document
+        revision = server._get_document(self.document).revision
+        changes = server.wait_for_changes(self.client1, self.document,
+            revision, 0.01)
+        self.assertEqual(changes['revision'], revision)
+        self.assertEqual(changes['rows'], [])
 
-        server.lock_document(client0, document0, 0) # lock document0, row 0
-        self.assertTrue(
-            # lock document0, row 0
-            server.lock_document(client0, document0, 0)
-        )
+    def test_wait_write(self):
+        '''
+        A write wakes up who is waiting
+        '''
+        server = self.server
+        revision = server._get_document(self.document).revision
+        timer = threading.Timer(0.05, server.write_document,
+            args=[self.client0, self.document, 0, 'new'])
+        timer.start()
+        changes = server.wait_for_changes(self.client1, self.document,
+            revision, 5)
+        timer.join()
+        self.assertEqual(changes['rows'], [(0, 'new')])
+
+    def test_callback(self):
+        '''
+        Subscribers are called after writes of other clients
+        '''
+        server = self.server
+        callback0 = self.Callback()
+        callback1 = self.Callback()
+        server.subscribe(self.client0, self.document, callback0)
+        server.subscribe(self.client1, self.document, callback1)
+        server.write_document(self.client0, self.document, 0, 'new')
+        self.assertEqual(callback0.calls, [])
+        self.assertEqual(len(callback1.calls), 1)
+
+    def test_callback_fail(self):
+        '''
+        A broken callback is unsubscribed
+        '''
+        server = self.server
+        server.subscribe(self.client1, self.document, self.Callback(True))
+        server.write_document(self.client0, self.document, 0, 'new')
+        self.failIf(server.unsubscribe(self.client1, self.document))
+
+
+class TestStorage(unittest.TestCase):
+    '''
+    Test the log and snapshots of documents
+    '''
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.storage = Storage(self.path, fsync=Storage.FSYNC_ALWAYS,
+            compact_after=10)
+        server = Server(self.storage)
+        self.server = server
+        self.client0 = server.register_client()
+        self.document = server.new_document(self.client0)
+
+    def tearDown(self):
+        self.server.close()
+        self.storage.close()
+        shutil.rmtree(self.path)
+
+    def _restart(self):
+        self.server.close()
+        self.storage.close()
+        self.storage = Storage(self.path, fsync=Storage.FSYNC_ALWAYS,
+            compact_after=10)
+        self.server = Server(self.storage)
+        return self.server
+
+    def test_recover_log(self):
+        '''
+        Writes are recovered from the log
+        '''
+        server = self.server
+        server.write_document(self.client0, self.document, 0, 'r0\nr1')
+        server.write_document(self.client0, self.document, 1, 'changed')
+        revision = server._get_document(self.document).revision
+
+        server = self._restart()
+        document = server._get_document(self.document)
+        self.assertEqual(document.rows, ['r0', 'changed'])
+        self.assertEqual(document.revision, revision)
+
+    def test_recover_empty(self):
+        '''
+        A new document, never written, is recovered
+        '''
+        server = self._restart()
+        self.assertEqual(server._get_document(self.document).rows, [''])
+
+    def test_compact(self):
+        '''
+        A long log becomes a snapshot
+        '''
+        server = self.server
+        for i in xrange(25):
+            server.write_document(self.client0, self.document, i, 'r%i' % i)
+        server.close_document(self.client0, self.document)
+        self.storage.flush()
+        names = os.listdir(self.path)
+        self.assertEqual(names.count('%s.25.snap' % self.document), 1)
+        self.assertEqual(len(names), 3) # 1 snapshot, its index and the log
+
+        server = self._restart()
+        document = server._get_document(self.document)
+        self.assertEqual(document.rows, ['r%i' % i for i in xrange(25)])
+        self.assertEqual(document.revision, 25)
+
+    def test_mapped(self):
+        '''
+        A snapshot is read from the mapped file, and copied to memory only
+        where it is written
+        '''
+        server = self.server
+        rows = [u'row %i caf\xe9' % i for i in xrange(2000)] + [u'']
+        server.write_document(self.client0, self.document, 0,
+            u'\n'.join(rows) + u'\nlast')
+        rows.append(u'last')
+        document = server._get_document(self.document)
+        self.storage.snapshot(document)
+        self.storage.flush()
+
+        server = self._restart()
+        document = server._get_document(self.document)
+        self.assertEqual(document.rows, rows)
+        self.assertEqual(document.rows[1999:2002], rows[1999:])
+        chunks = document.rows._chunks
+        self.failIf([chunk for chunk in chunks
+            if type(chunk).__name__ != 'MappedRows'])
+        server.write_document(self.client0, self.document, 1, u'changed')
+        self.assertEqual(document.rows[1], u'changed')
+        self.assertEqual(type(chunks[0]), list)
+        self.assertEqual(type(chunks[1]).__name__, 'MappedRows')
+
+        # without its index, a snapshot is read the old way
+        self.storage.snapshot(document)
+        self.storage.flush()
+        for name in os.listdir(self.path):
+            if name.endswith('.idx'):
+                os.remove(os.path.join(self.path, name))
+        rows[1] = u'changed'
+        server = self._restart()
+        self.assertEqual(server._get_document(self.document).rows, rows)
+
+    def test_big_snapshot(self):
+        '''
+        A snapshot of many batches of rows is read back the same
+        '''
+        server = self.server
+        rows = [i % 7 != 1 and u'r%i caf\xe9' % i or u'' \
+            for i in xrange(9000)]
+        server.write_document(self.client0, self.document, 0,
+            u'\n'.join(rows) + u'\nend')
+        rows.append(u'end')
+        self.storage.snapshot(server._get_document(self.document)).wait()
+        server = self._restart()
+        self.assertEqual(list(server._get_document(self.document).rows),
+            rows)
+
+    def test_open_files(self):
+        '''
+        Loaded documents keep a file open only if their snapshot is big
+        (mapped), and only some logs are open
+        '''
+        def open_files():
+            return len(os.listdir('/proc/self/fd'))
+        self.server.close()
+        self.storage.close()
+        before = open_files()
+        self.storage = Storage(self.path, max_open_logs=2)
+        server = self.server = Server(self.storage)
+        documents = [server.new_document(self.client0) for i in xrange(20)]
+        for document in documents:
+            server.write_document(self.client0, document, 0, 'a\nb')
+        self.storage.flush()
+        self.assertEqual(open_files() - before, 2)
+        for document in documents:
+            self.storage.snapshot(server._get_document(document))
+        self.storage.flush()
+        for map_above, mapped in ((1000, 0), (0, 20)):
+            self.server.close()
+            self.storage.close()
+            before = open_files()
+            self.storage = Storage(self.path, map_above=map_above,
+                max_open_logs=1)
+            self.server = Server(self.storage)
+            for document in documents:
+                self.assertEqual(self.server.get_document_snapshot(
+                    self.client0, document), ['a', 'b'])
+            self.assertEqual(open_files() - before, mapped)
+
+    def test_unchanged(self):
+        '''
+        A snapshot of a document not changed since the last one does not
+        read it (not even waiting for a writer)
+        '''
+        server = self.server
+        document = server._get_document(self.document)
+        self.storage.snapshot(document).wait()
+        writing = threading.Event()
+        done = threading.Event()
+        def write():
+            with document.writing():
+                writing.set()
+                done.wait()
+        thread = threading.Thread(target=write)
+        thread.start()
+        writing.wait()
+        saved = self.storage.snapshot(document).wait(5)
+        done.set()
+        thread.join()
+        self.assertTrue(saved)
+
+    def test_failed_snapshot(self):
+        '''
+        An import whose snapshot failed is recovered from the log, and its
+        document is not taken as saved
+        '''
+        server = self.server
+        def fail(document):
+            raise IOError('No space left on device')
+        self.storage._compact = fail
+        import_uid = server.begin_import(self.client0, self.document)
+        server.append_rows(self.client0, import_uid, ['r0', u'caf\xe9'])
+        server.commit_import(self.client0, import_uid)
+        server.write_document(self.client0, self.document, 2, 'r2')
+        document = server._get_document(self.document)
+        revision = document.revision
+        self.assertEqual(server._save_documents([document]), [])
+
+        server = self._restart()
+        document = server._get_document(self.document)
+        self.assertEqual(document.rows, ['r0', u'caf\xe9', 'r2'])
+        self.assertEqual(document.revision, revision)
+
+    def test_recover_operations(self):
+        '''
+        Operations are recovered from the log
+        '''
+        server = self.server
+        server.write_document(self.client0, self.document, 0, 'r0\nr1')
+        revision = server.apply_operations(self.client0, self.document, 1,
+            [['ins', 0, 2, ' and\nmore'], ['del', 2, 0, 2, 1]])
+
+        server = self._restart()
+        document = server._get_document(self.document)
+        self.assertEqual(document.rows, ['r0 and', 'more', '1'])
+        self.assertEqual(document.revision, revision)
+
+    def test_broken_log(self):
+        '''
+        A write cut in the end of the log is ignored
+        '''
+        server = self.server
+        server.write_document(self.client0, self.document, 0, 'r0')
+        self.storage.flush()
+        log = open(os.path.join(self.path, '%s.log' % self.document), 'a')
+        log.write('[2, 0, "cut')
+        log.close()
+
+        server = self._restart()
+        self.assertEqual(server._get_document(self.document).rows, ['r0'])
+
+
+class TestOperations(unittest.TestCase):
+    '''
+    Test edits by operations, with no locks
+    '''
+    def setUp(self):
+        server = Server()
+        self.server = server
+        self.client0 = server.register_client()
+        self.client1 = server.register_client()
+        self.document = server.new_document(self.client0)
+        server.write_document(self.client0, self.document, 0, 'abc\ndef')
+        self.revision = server._get_document(self.document).revision
+
+    def tearDown(self):
+        self.server.close()
+
+    def _rows(self):
+        return list(self.server._get_document(self.document).rows)
+
+    def test_same_row(self):
+        '''
+        Two clients edit the same row at the same time
+        '''
+        server = self.server
+        server.apply_operations(self.client0, self.document, self.revision,
+            [['ins', 0, 1, 'X']])
+        revision = server.apply_operations(self.client1, self.document,
+            self.revision, [['del', 0, 0, 0, 2], ['ins', 0, 0, 'Y\n']])
+        self.assertEqual(self._rows(), ['XY', 'c', 'def'])
+        self.assertEqual(revision, self.revision + 2)
+
+    def test_write(self):
+        '''
+        Operations made before a write (of a locked row) are transformed
+        '''
+        server = self.server
+        server.lock_document(self.client0, self.document, 0)
+        server.write_document(self.client0, self.document, 0, 'new\nrow')
+        server.apply_operations(self.client1, self.document, self.revision,
+            [['ins', 1, 3, '!']])
+        self.assertEqual(self._rows(), ['new', 'row', 'def!'])
+        document = self.server._get_document(self.document)
+        self.assertTrue(document.is_locked_by(self.client0, 1))
+
+    def test_same_delete(self):
+        '''
+        Two clients delete the same text: the second one, done already, is
+        logged empty, and the next operations of that client are sent
+        '''
+        server = self.server
+        queues = dict((client, OperationQueue(self.revision)) \
+            for client in (self.client0, self.client1))
+        for client, queue in queues.items():
+            queue.local([['del', 0, 0, 0, 2]])
+            server.apply_operations(client, self.document, *queue.send())
+        self.assertEqual(self._rows(), ['c', 'def'])
+        for client, queue in queues.items():
+            changes = server.get_operations_since(client, self.document,
+                queue.revision)
+            for revision, author, ops in changes['changes']:
+                queue.remote(revision, ops, author == client)
+            self.assertEqual(queue.sent, None)
+        queue = queues[self.client1]
+        queue.local([['ins', 0, 0, 'X']])
+        server.apply_operations(self.client1, self.document, *queue.send())
+        self.assertEqual(self._rows(), ['Xc', 'def'])
+
+    def test_locks(self):
+        '''
+        Rows added or removed by operations move the locks below them
+        '''
+        server = self.server
+        server.lock_document(self.client0, self.document, 0)
+        server.lock_document(self.client0, self.document, 1)
+        revision = server.apply_operations(self.client1, self.document,
+            self.revision, [['ins', 0, 1, '\n']])
+        document = server._get_document(self.document)
+        self.assertEqual(document.locked_rows(self.client0), set([0, 2]))
+        server.apply_operations(self.client1, self.document, revision,
+            [['del', 0, 1, 1, 0]])
+        self.assertEqual(document.locked_rows(self.client0), set([0, 1]))
+
+    def test_invalid(self):
+        '''
+        Nothing is applied if an operation is invalid
+        '''
+        server = self.server
+        self.assertRaises(InvalidOperation, server.apply_operations,
+            self.client0, self.document, self.revision,
+            [['ins', 0, 0, 'ok'], ['del', 1, 0, 5, 0]])
+        self.assertRaises(InvalidOperation, server.apply_operations,
+            self.client0, self.document, self.revision, [['move', 0]])
+        self.assertEqual(self._rows(), ['abc', 'def'])
+        self.assertEqual(server._get_document(self.document).revision,
+            self.revision)
+
+    def test_operations_since(self):
+        '''
+        Changes after a revision, if the document remembers it
+        '''
+        server = self.server
+        server.apply_operations(self.client0, self.document, self.revision,
+            [['ins', 0, 0, '>']])
+        changes = server.get_operations_since(self.client1, self.document,
+            self.revision)
+        self.assertEqual(changes['revision'], self.revision + 1)
+        self.assertEqual(changes['changes'],
+            [(self.revision + 1, self.client0, [['ins', 0, 0, '>']])])
+
+        server._get_document(self.document).set_rows(['other'])
+        changes = server.get_operations_since(self.client1, self.document,
+            self.revision)
+        self.assertEqual(changes['changes'], None)
+        self.assertRaises(Document.RevisionTooOld, server.apply_operations,
+            self.client0, self.document, self.revision, [])
+
+    def test_transform(self):
+        '''
+        Any two lists of operations end in the same text
+        '''
+        ops0 = [['ins', 0, 3, '\nxy'], ['del', 0, 1, 1, 1]]
+        ops1 = [['del', 0, 2, 1, 2], ['ins', 0, 2, 'z']]
+        after0, after1 = transform_pair(ops0, ops1)
+        rows = []
+        for ops in (ops0 + after1, ops1 + after0):
+            document = Document('D0')
+            document.rows = ['abc', 'def']
+            document.apply_operations(None, document.revision, ops)
+            rows.append(list(document.rows))
+        self.assertEqual(rows[0], rows[1])
+
+    def test_queues(self):
+        '''
+        Clients applying their operations before the server end with the
+        same text of the server
+        '''
+        server = self.server
+        clients = {}
+        for client in (self.client0, self.client1):
+            document = Document('D0')
+            document.rows = ['abc', 'def']
+            clients[client] = (document, OperationQueue(self.revision))
+
+        def edit(client, ops):
+            document, queue = clients[client]
+            document.apply_operations(None, document.revision, ops)
+            queue.local(ops)
+
+        def sync(client, send=True):
+            document, queue = clients[client]
+            changes = server.get_operations_since(client, self.document,
+                queue.revision)
+            for revision, author, ops in changes['changes']:
+                ops = queue.remote(revision, ops, author == client)
+                document.apply_operations(None, document.revision, ops)
+            sending = send and queue.send()
+            if sending:
+                server.apply_operations(client, self.document, *sending)
+
+        edit(self.client0, [['ins', 0, 3, '0']])
+        edit(self.client1, [['ins', 0, 3, '1']])
+        sync(self.client0)
+        edit(self.client0, [['del', 0, 0, 1, 1]])
+        sync(self.client1, send=False)
+        edit(self.client1, [['ins', 1, 0, '\n']])
+        sync(self.client0)
+        sync(self.client1)
+        for i in xrange(2):
+            sync(self.client0)
+            sync(self.client1)
+        for document, queue in clients.values():
+            self.assertEqual(list(document.rows), self._rows())
+        self.assertEqual(self._rows(), ['1', 'ef'])
+
+
+class TestRowDeltas(unittest.TestCase):
+    '''
+    Test the changed part of rows, instead of full rows
+    '''
+    LONG = 'a long row, long enough to send just the changed part'
+
+    def setUp(self):
+        server = Server()
+        self.server = server
+        self.client0 = server.register_client()
+        self.client1 = server.register_client()
+        self.document = server.new_document(self.client0)
+        server.write_document(self.client0, self.document, 0,
+            'short\n%s' % self.LONG)
+        self.revision = server._get_document(self.document).revision
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_delta(self):
+        '''
+        A delta gives the new row only from the old one
+        '''
+        for old, new in (('abcdef', 'abXef'), ('', 'new'), ('old', ''),
+                ('aaa', 'aaaa'), (u'\xe1 b', u'\xe1 c')):
+            delta = make_delta(old, new)
+            self.assertEqual(apply_delta(old, delta), new)
+        self.assertEqual(make_delta('abcdef', 'abXef')[:3], [2, 4, 'X'])
+        self.assertEqual(apply_delta('abcdeF', make_delta('abcdef', 'abXef')),
+            None)
+        self.assertEqual(apply_delta('ab', make_delta('abcdef', 'abXef')),
+            None)
+
+    def test_plan_row_edits(self):
+        '''
+        Only different rows are edited, new rows do not move the next ones
+        '''
+        old = ['r%i' % i for i in xrange(10)]
+        new = old[:3] + ['new', 'rows'] + old[3:8] + ['changed']
+        edits = plan_row_edits(old, new)
+        self.assertEqual(edits,
+            [(8, 10, ['changed']), (3, 3, ['new', 'rows'])])
+        for start, stop, rows in edits:
+            old[start:stop] = rows
+        self.assertEqual(old, new)
+
+        rand = random.Random(0)
+        for i in xrange(200):
+            old = [rand.choice('abc') for j in xrange(rand.randint(0, 8))]
+            new = [rand.choice('abc') for j in xrange(rand.randint(0, 8))]
+            rows = list(old)
+            for start, stop, block in plan_row_edits(old, new):
+                rows[start:stop] = block
+            self.assertEqual(rows, new)
+        self.assertEqual(plan_row_edits(new, new), [])
+
+    def test_feed(self):
+        '''
+        Long rows changed inside go as deltas, the others as rows
+        '''
+        server = self.server
+        server.write_document(self.client1, self.document, 1,
+            self.LONG.replace('just', 'only'))
+        server.write_document(self.client1, self.document, 1,
+            self.LONG.replace('just', 'only').replace('row', 'line'))
+        server.write_document(self.client1, self.document, 0, 'changed')
+        changes = server.get_changes_since(self.client0, self.document,
+            self.revision, True)
+        self.assertEqual(changes['rows'], [(0, 'changed')])
+        text = server.get_document_row(self.client0, self.document, 1)
+        self.assertEqual(changes['deltas'], [(1, make_delta(self.LONG, text))])
+
+        changes = server.get_changes_since(self.client0, self.document,
+            self.revision)
+        self.failIf('deltas' in changes)
+        self.assertEqual(len(changes['rows']), 2)
+
+    def test_feed_new_rows(self):
+        '''
+        Rows moved by new rows are sent full
+        '''
+        server = self.server
+        server.write_document(self.client1, self.document, 1,
+            self.LONG + '!')
+        server.write_document(self.client1, self.document, 0, 'new\nrows')
+        changes = server.get_changes_since(self.client0, self.document,
+            self.revision, True)
+        self.assertEqual(changes['deltas'], [])
+        self.assertEqual([row for row, text in changes['rows']], [0, 1, 2])
+
+    def test_write_delta(self):
+        '''
+        A delta is written only in the row it was made from
+        '''
+        server = self.server
+        new = self.LONG.replace('long', 'big')
+        delta = make_delta(self.LONG, new)
+        self.failIf(server.write_document_delta(self.client0, self.document,
+            0, delta))
+        self.assertTrue(server.write_document_delta(self.client0,
+            self.document, 1, delta))
+        self.assertEqual(server.get_document_row(self.client0, self.document,
+            1), new)
+        self.assertEqual(server.execute_batch(self.client1, [
+            ('lock_write_delta', self.document, 1, delta),
+            ('lock_write_delta', self.document, 1,
+                make_delta(new, 'other'))]), [None, True])
+        self.assertEqual(server.get_document_snapshot(self.client0,
+            self.document), ['short', 'other'])
+
+
+class TestStats(unittest.TestCase):
+    '''
+    Test the instrumentation of the server
+    '''
+    def setUp(self):
+        server = Server()
+        self.server = server
+        self.client0 = server.register_client()
+        self.document = server.new_document(self.client0)
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_methods(self):
+        '''
+        Calls, errors, latency and payload of every method
+        '''
+        server = self.server
+        server.write_document(self.client0, self.document, 0, 'x' * 100)
+        server.get_document_snapshot(self.client0, self.document)
+        self.assertRaises(Document.DoesNotExist, server.open_document,
+            self.client0, 'D_invalid')
+        methods = server.get_stats()['methods']
+        self.assertEqual(methods['register_client']['calls'], 1)
+        self.assertEqual(methods['open_document']['errors'], 1)
+        write = methods['write_document']
+        self.assertEqual((write['calls'], write['errors']), (1, 0))
+        self.assertEqual(write['latency']['count'], 1)
+        self.assertTrue(write['payload']['sum'] >= 100)
+        self.failIf('get_stats' in methods)
+
+    def test_payload_size(self):
+        '''
+        Sizes of long lists are estimated from some items
+        '''
+        self.assertEqual(payload_size(['abc', ('de', 1)]), 13)
+        self.assertEqual(payload_size(['x' * 10] * 100000), 1000000)
+        self.assertEqual(payload_size({'rows': [(0, 'ab')] * 1000}), 10000)
+
+    def test_inner_calls(self):
+        '''
+        Methods called by other methods are counted once, in the outer one
+        '''
+        server = self.server
+        server.commit_rows(self.client0, self.document, [(0, 'a')], [0])
+        server.wait_for_changes(self.client0, self.document, 0, 0)
+        methods = server.get_stats()['methods']
+        self.assertEqual(methods['commit_rows']['calls'], 1)
+        self.assertEqual(methods['wait_for_changes']['calls'], 1)
+        self.failIf('execute_batch' in methods)
+        self.failIf('get_changes_since' in methods)
+
+    def test_keywords(self):
+        '''
+        Methods called with keyword arguments
+        '''
+        server = self.server
+        server.open_document(self.client0, self.document, read_only=True)
+        changes = server.get_changes_since(self.client0, self.document, -1,
+            deltas=True)
+        self.assertEqual(changes['deltas'], [])
+        self.assertEqual(server.get_stats()['methods']['open_document'][
+            'calls'], 1)
+
+    def test_memory_and_locks(self):
+        '''
+        Rows in memory and readers waiting a writer
+        '''
+        server = self.server
+        server.write_document(self.client0, self.document, 0, 'r0\nr1\nr2')
+        document = server._get_document(self.document)
+        with document.writing():
+            reader = threading.Thread(target=server.get_document_snapshot,
+                args=(self.client0, self.document))
+            reader.start()
+            time.sleep(0.05)
+        reader.join()
+        stats = server.get_stats()
+        self.assertEqual(stats['rows'], 3)
+        self.assertEqual(stats['cache']['documents'], 1)
+        self.assertEqual(stats['lock_contention']['contended'], 1)
+        self.assertTrue(stats['lock_contention']['wait_time'] > 0.02)
+
+    def test_histogram(self):
+        '''
+        Percentiles are bounds of buckets
+        '''
+        histogram = Histogram((1, 10, 100))
+        self.assertEqual(histogram.percentile(50), 0)
+        for value in [0.5] * 90 + [50] * 9 + [500]:
+            histogram.add(value)
+        self.assertEqual(histogram.percentile(50), 1)
+        self.assertEqual(histogram.percentile(99), 100)
+        self.assertEqual(histogram.percentile(100), 500)
+        self.assertEqual(histogram.snapshot()['buckets'],
+            [(1, 90), (100, 9), (None, 1)])
+
+
+class TestDocumentCache(unittest.TestCase):
+    '''
+    Test loading and evicting documents
+    '''
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.storage = Storage(self.path)
+        server = Server(self.storage, max_documents=2)
+        self.server = server
+        self.client0 = server.register_client()
+        self.documents = []
+        for i in xrange(3):
+            document = server.new_document(self.client0)
+            server.write_document(self.client0, document, 0, 'doc %i' % i)
+            self.documents.append(document)
+
+    def tearDown(self):
+        self.server.close()
+        self.storage.close()
+        shutil.rmtree(self.path)
+
+    def test_evict(self):
+        '''
+        The least recently used document leaves the memory
+        '''
+        server = self.server
+        self.assertEqual(len(server._documents.keys()), 2)
+        self.failIf(self.documents[0] in server._documents)
+        self.assertEqual(server.get_cache_stats()['evictions'], 1)
+
+    def test_load(self):
+        '''
+        An evicted document is loaded again when used
+        '''
+        server = self.server
+        misses = server.get_cache_stats()['misses']
+        self.assertEqual(
+            server.get_document_row(self.client0, self.documents[0], 0),
+            'doc 0')
+        stats = server.get_cache_stats()
+        self.assertEqual(stats['misses'], misses + 1)
+        self.assertEqual(stats['evictions'], 2)
+
+    def test_locked(self):
+        '''
+        Documents with locks are not evicted
+        '''
+        server = self.server
+        server.lock_document(self.client0, self.documents[1], 0)
+        server.get_document_row(self.client0, self.documents[2], 0)
+        # the locked document is the oldest now
+        server.new_document(self.client0)
+        self.assertTrue(self.documents[1] in server._documents)
+        self.failIf(self.documents[2] in server._documents)
+
+    def test_check_unlocked(self):
+        '''
+        A document held by a writer does not block the cache while its
+        eviction waits to check it
+        '''
+        def can_evict(document):
+            with document.reading():
+                return document.is_idle()
+        cache = DocumentCache(Document, None, can_evict, max_documents=1)
+        document = Document('D0')
+        cache['D0'] = document
+        writing = threading.Event()
+        done = threading.Event()
+        def write():
+            with document.writing():
+                writing.set()
+                done.wait()
+        writer = threading.Thread(target=write)
+        writer.start()
+        writing.wait()
+        evict = threading.Thread(target=cache.__setitem__,
+            args=('D1', Document('D1')))
+        evict.start()
+        got = []
+        reader = threading.Thread(target=lambda: got.append(cache.get('D1')))
+        reader.start()
+        reader.join(5)
+        done.set()
+        writer.join()
+        evict.join()
+        self.assertEqual([document.uid for document in got], ['D1'])
+        self.failIf('D0' in cache)
+
+    def test_save_unlocked(self):
+        '''
+        Other documents are used while the evicted ones are saved, and a
+        document used while it is saved is not evicted
+        '''
+        saving = threading.Event()
+        saved = threading.Event()
+        def save(documents):
+            saving.set()
+            saved.wait()
+            return documents
+        cache = DocumentCache(Document, save, max_documents=1)
+        cache['D0'] = Document('D0')
+        evict = threading.Thread(target=cache.__setitem__,
+            args=('D1', Document('D1')))
+        evict.start()
+        saving.wait()
+        self.assertEqual(cache.get('D1').uid, 'D1')
+        self.assertEqual(cache.get('D0').uid, 'D0')
+        saved.set()
+        evict.join()
+        self.assertTrue('D0' in cache)
+        self.assertEqual(cache.stats()['evictions'], 0)
+
+    def test_not_saved(self):
+        '''
+        A document whose save failed is not evicted
+        '''
+        cache = DocumentCache(Document, lambda documents: [],
+            max_documents=1)
+        cache['D0'] = Document('D0')
+        cache['D1'] = Document('D1')
+        self.assertTrue('D0' in cache)
+        self.assertEqual(cache.stats()['evictions'], 0)
+
+    def test_nonexistent(self):
+        '''
+        Unknown documents are not loaded
+        '''
+        try:
+            self.server.open_document(self.client0, '../D_invalid')
+            self.failIf(True)
+        except Document.DoesNotExist:
+            pass
+
+
+class TestConcurrency(unittest.TestCase):
+    '''
+    Many threads using the same server, like the Pyro threaded server
+    '''
+    THREADS = 8
+    WRITES = 200
+
+    def setUp(self):
+        server = Server()
+        self.server = server
+        self.clients = [server.register_client() \
+            for i in xrange(self.THREADS)]
+        self.document = server.new_document(self.clients[0])
+        server.write_document(self.clients[0], self.document, 0,
+            '\n'.join('row %i' % i for i in xrange(self.THREADS)))
+        self.errors = []
+
+    def tearDown(self):
+        self.server.close()
+
+    def _run(self, threads):
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.errors, [])
+
+    def _editor(self, row):
+        server = self.server
+        client = self.clients[row]
+        try:
+            for i in xrange(self.WRITES):
+                if not server.lock_and_write_document(client, self.document,
+                        row, 'row %i: %i' % (row, i)):
+                    self.errors.append('lock denied: %i' % row)
+                text = server.get_document_row(client, self.document, row)
+                if text != 'row %i: %i' % (row, i):
+                    self.errors.append('lost write: %r' % text)
+            server.unlock_document(client, self.document, row)
+        except Exception, exp:
+            self.errors.append(exp)
+
+    def _reader(self):
+        server = self.server
+        client = server.register_client()
+        try:
+            revision = -1
+            for i in xrange(self.WRITES):
+                changes = server.get_changes_since(client, self.document,
+                    revision)
+                if changes['row_count'] != self.THREADS:
+                    self.errors.append('rows: %i' % changes['row_count'])
+                revision = changes['revision']
+        except Exception, exp:
+            self.errors.append(exp)
+
+    def test_stress(self):
+        '''
+        Each thread edits its row while others read the document
+        '''
+        threads = [threading.Thread(target=self._editor, args=[row]) \
+            for row in xrange(self.THREADS)]
+        threads += [threading.Thread(target=self._reader) \
+            for i in xrange(self.THREADS)]
+        self._run(threads)
+
+        document = self.server._get_document(self.document)
+        self.assertEqual(document.rows, ['row %i: %i' % (row, self.WRITES - 1)
+            for row in xrange(self.THREADS)])
+        self.assertEqual(document.revision, 1 + self.THREADS * self.WRITES)
+        self.assertTrue(document.is_idle())
+
+    def test_same_row(self):
+        '''
+        Threads fighting for the same row: one lock at a time
+        '''
+        server = self.server
+        owners = []
+
+        def fight(client):
+            try:
+                for i in xrange(self.WRITES):
+                    if server.lock_and_write_document(client, self.document,
+                            0, client):
+                        owners.append(client)
+                        server.unlock_document(client, self.document, 0)
+            except Exception, exp:
+                self.errors.append(exp)
+
+        self._run([threading.Thread(target=fight, args=[client]) \
+            for client in self.clients])
+        document = server._get_document(self.document)
+        self.assertEqual(document.revision, 1 + len(owners))
+        self.assertTrue(document.is_idle())
+
+
+class TestViewers(unittest.TestCase):
+    '''
+    Test read-only clients and the snapshots they share
+    '''
+    def setUp(self):
+        server = Server()
+        self.server = server
+        self.editor = server.register_client()
+        self.document = server.new_document(self.editor)
+        server.write_document(self.editor, self.document, 0, 'r0\nr1\nr2')
+        self.viewers = [server.register_client() for i in xrange(2)]
+        for viewer in self.viewers:
+            server.open_document(viewer, self.document, True)
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_shared(self):
+        '''
+        Viewers get the same results, made once by revision
+        '''
+        server = self.server
+        viewer0, viewer1 = self.viewers
+        changes = server.get_changes_since(viewer0, self.document, 0)
+        self.assertEqual(changes['rows'], [(0, 'r0'), (1, 'r1'), (2, 'r2')])
+        self.failIf(server.get_changes_since(viewer1, self.document, 0) \
+            is not changes)
+        snapshot = server.get_document_snapshot(viewer0, self.document)
+        self.failIf(server.get_document_snapshot(viewer1, self.document) \
+            is not snapshot)
+
+        server.write_document(self.editor, self.document, 1, 'changed')
+        self.assertEqual(snapshot, ['r0', 'r1', 'r2'])
+        self.assertEqual(server.get_document_row(viewer0, self.document, 1),
+            'changed')
+        self.assertEqual(server.get_document_rows(viewer1, self.document,
+            1, 3), ['changed', 'r2'])
+        self.assertEqual(server.list_changed_lines(viewer0, self.document),
+            [0, 1, 2])
+
+    def test_read_only(self):
+        '''
+        Viewers cannot lock or write, until they open it to edit
+        '''
+        server = self.server
+        viewer0 = self.viewers[0]
+        for method, args in (
+                (server.lock_document, (0,)),
+                (server.write_document, (0, 'text')),
+                (server.lock_and_write_document, (0, 'text')),
+                (server.apply_operations, (0, [['ins', 0, 0, 'x']]))):
+            self.assertRaises(Server.ReadOnly, method, viewer0,
+                self.document, *args)
+        self.assertRaises(Server.ReadOnly, server.execute_batch, viewer0,
+            [('read', self.document, 0), ('write', self.document, 0, 'x')])
+        self.assertEqual(server.execute_batch(viewer0,
+            [('read', self.document, 0)]), ['r0'])
+
+        server.open_document(viewer0, self.document)
+        self.assertTrue(server.lock_document(viewer0, self.document, 0))
+
+    def test_transport(self):
+        '''
+        A result shared by viewers is encoded once by the transport
+        '''
+        framed = FramedServer(self.server, ('127.0.0.1', 0))
+        thread = threading.Thread(target=framed.serve_forever)
+        thread.start()
+        try:
+            for compact in (True, False):
+                results = []
+                for viewer in self.viewers:
+                    proxy = FramedProxy(framed.address, compact)
+                    results.append(proxy.get_document_snapshot(viewer,
+                        self.document))
+                    proxy.close()
+                self.assertEqual(results, [[u'r0', u'r1', u'r2']] * 2)
+            self.assertEqual(framed.results.hits, 2)
+        finally:
+            framed.stop()
+            thread.join()
+
+
+class TestClientCore(unittest.TestCase):
+    '''
+    Test the client with no GUI, on a server in this process
+    '''
+    def setUp(self):
+        self.server = Server()
+        self.cores = []
+
+    def tearDown(self):
+        for core in self.cores:
+            core.close()
+        self.server.close()
+
+    def _core(self, **options):
+        core = ClientCore(lambda: self.server, delay=0, **options)
+        self.cores.append(core)
+        return core
+
+    def test_pipeline(self):
+        '''
+        Many calls in flight, results and errors by future
+        '''
+        core = self._core()
+        document_uid = core.new_document()
+        futures = [core.call('lock_and_write_document', document_uid, 0,
+            'r%i' % i, key=document_uid) for i in xrange(20)]
+        self.assertEqual([future.result(5) for future in futures],
+            [True] * 20)
+        self.assertEqual(core.get_row(0).result(5), 'r19')
+        future = core.call('get_document_row', 'D_invalid', 0)
+        self.assertRaises(Document.DoesNotExist, future.result, 5)
+        self.assertRaises(Future.Timeout, Future().result, 0.01)
+
+    def test_rows(self):
+        '''
+        Rows written by one client are seen by another
+        '''
+        editor = self._core()
+        document_uid = editor.new_document()
+        editor.call('write_document', document_uid, 0, u'x\nr1').result(5)
+        self.assertTrue(editor.lock(0).result(5))
+        self.assertEqual(editor.locked_rows, set([0]))
+        editor.write(0, u'r0')
+        editor.unlock(0)
+        editor.sender.flush()
+
+        other = self._core()
+        changed = []
+        event = threading.Event()
+        changes = other.open_document(document_uid)
+        rows = []
+        apply_changes(rows, changes)
+        self.assertEqual(rows, [u'r0', u'r1'])
+        other.listen(lambda changes: (changed.append(changes), event.set()))
+        self.failIf(other.lock(1).result(5) is not True)
+
+        self.assertFalse(editor.lock(1).result(5))
+        self.assertTrue(editor.lock(0).result(5))
+        editor.write(0, u'changed')
+        event.wait(5)
+        self.assertEqual(apply_changes(rows, changed[0]), [])
+        self.assertEqual(rows, [u'changed', u'r1'])
+
+    def test_removed_rows(self):
+        '''
+        Rows removed by operations leave the rows of a mirror
+        '''
+        editor = self._core()
+        document_uid = editor.new_document()
+        editor.call('write_document', document_uid, 0, u'a\nb\nc').result(5)
+        changes = editor.get_changes().result(5)
+        rows = []
+        apply_changes(rows, changes)
+        editor.call('apply_operations', document_uid, changes['revision'],
+            [['del', 0, 1, 2, 1]]).result(5)
+        changes = editor.call('get_changes_since', document_uid,
+            changes['revision']).result(5)
+        self.failIf(changes['full'])
+        apply_changes(rows, changes)
+        self.assertEqual(rows, [u'a'])
+
+    def test_read_only(self):
+        '''
+        A viewer has no sender and cannot lock
+        '''
+        editor = self._core()
+        document_uid = editor.new_document()
+        viewer = self._core()
+        viewer.open_document(document_uid, read_only=True)
+        self.assertEqual(viewer.sender, None)
+        self.assertRaises(Server.ReadOnly, viewer.lock(0).result, 5)
+
+    def test_operations(self):
+        '''
+        Operations are sent when the document is closed
+        '''
+        core = self._core(operations=True)
+        document_uid = core.new_document()
+        core.sender.local([['ins', 0, 0, 'a\nb']])
+        core.close_document()
+        self.assertEqual(self.server.get_document_snapshot(core.uid,
+            document_uid), ['a', 'b'])
+
+
+class TestImportExport(unittest.TestCase):
+    '''
+    Test imports and exports of rows in chunks
+    '''
+    def setUp(self):
+        server = Server()
+        self.server = server
+        self.client0 = server.register_client()
+        self.client1 = server.register_client()
+        self.document = server.new_document(self.client0)
+        server.write_document(self.client0, self.document, 0, 'old')
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_import(self):
+        '''
+        Rows replace the document at once, in the commit
+        '''
+        server = self.server
+        import_uid = server.begin_import(self.client0, self.document)
+        self.assertEqual(server.append_rows(self.client0, import_uid,
+            ['r0', 'r1\nr2']), 3)
+        self.assertRaises(Server.UnknownImport, server.append_rows,
+            self.client1, import_uid, ['r3'])
+        self.assertEqual(server.get_document_snapshot(self.client1,
+            self.document), ['old'])
+
+        self.assertTrue(server.lock_document(self.client1, self.document, 0))
+        self.assertRaises(Document.LockDenied, server.commit_import,
+            self.client0, import_uid)
+        server.close_document(self.client1, self.document)
+        revision = server.commit_import(self.client0, import_uid)
+        self.assertEqual(server.get_document_snapshot(self.client1,
+            self.document), ['r0', 'r1', 'r2'])
+        changes = server.get_changes_since(self.client1, self.document, 1)
+        self.assertTrue(changes['full'])
+        self.assertEqual(changes['revision'], revision)
+        self.assertRaises(Server.UnknownImport, server.commit_import,
+            self.client0, import_uid)
+
+        import_uid = server.begin_import(self.client0, self.document)
+        server.abort_import(self.client0, import_uid)
+        self.assertRaises(Server.UnknownImport, server.append_rows,
+            self.client0, import_uid, ['r3'])
+
+    def test_append_while_committing(self):
+        '''
+        Rows appended while the import is committed are in the commit or
+        refused: they never change the document later
+        '''
+        server = self.server
+        import_uid = server.begin_import(self.client0, self.document)
+        server.append_rows(self.client0, import_uid, ['r0'])
+        def append():
+            for i in xrange(200):
+                try:
+                    server.append_rows(self.client0, import_uid,
+                        ['r%i' % i] * 100)
+                except Server.UnknownImport:
+                    return
+        thread = threading.Thread(target=append)
+        thread.start()
+        time.sleep(0.001)
+        revision = server.commit_import(self.client0, import_uid)
+        rows = server.get_document_snapshot(self.client0, self.document)
+        thread.join()
+        self.assertEqual(server.get_document_snapshot(self.client0,
+            self.document), rows)
+        self.assertEqual(server._get_document(self.document).revision,
+            revision)
+
+    def test_export(self):
+        '''
+        Every chunk of an export is of the same revision
+        '''
+        server = self.server
+        server.write_document(self.client0, self.document, 0,
+            '\n'.join('r%i' % i for i in xrange(5)))
+        chunk = server.export_rows(self.client1, self.document, 0, 2)
+        self.assertEqual((chunk['rows'], chunk['next']), (['r0', 'r1'], 2))
+        server.write_document(self.client0, self.document, 2, 'changed')
+        rows = chunk['rows']
+        while chunk['next'] is not None:
+            chunk = server.export_rows(self.client1, self.document,
+                chunk['next'], 2)
+            rows += chunk['rows']
+        self.assertEqual(rows, ['r%i' % i for i in xrange(5)])
+        chunk = server.export_rows(self.client1, self.document, 2, 2)
+        self.assertEqual(chunk['rows'], ['changed', 'r3'])
+
+    def test_client(self):
+        '''
+        A file in and out with clientcore, in chunks
+        '''
+        core = ClientCore(lambda: self.server)
+        try:
+            lines = ['line %i\n' % i for i in xrange(2500)]
+            core.import_rows(self.document, iter(lines), chunk_size=300)
+            self.assertEqual(list(core.export_rows(self.document, 700)),
+                [line[:-1] for line in lines])
+        finally:
+            core.close()
+
+
+class TestFramedTransport(unittest.TestCase):
+    '''
+    Test the server through the framed transport
+    '''
+    def _start(self, address):
+        self.server = Server()
+        self.framed = FramedServer(self.server, address)
+        self.thread = threading.Thread(target=self.framed.serve_forever)
+        self.thread.start()
+        return self.framed.address
+
+    def setUp(self):
+        self.address = self._start(('127.0.0.1', 0))
+
+    def tearDown(self):
+        self.framed.stop()
+        self.thread.join()
+        self.server.close()
+
+    def test_calls(self):
+        '''
+        Call server methods like a Pyro proxy
+        '''
+        proxy = FramedProxy(self.address)
+        client0 = proxy.register_client()
+        document0 = proxy.new_document(client0)
+        proxy.write_document(client0, document0, 0, u'r0\nr\xe9')
+        self.assertEqual(proxy.get_document_snapshot(client0, document0),
+            [u'r0', u'r\xe9'])
+        self.assertTrue(proxy.lock_document(client0, document0, 0))
+        proxy.close()
+
+    def test_errors(self):
+        '''
+        Exceptions of the server, private and blocking methods
+        '''
+        proxy = FramedProxy(self.address)
+        for name, args in (
+                ('open_document', ['C0', 'D_invalid']),
+                ('_get_document', ['D_invalid']),
+                ('wait_for_changes', ['C0', 'D_invalid', 0, 1])):
+            try:
+                proxy._call(name, args)
+                self.failIf(True)
+            except RemoteError, exp:
+                self.assertTrue(exp.args[0] in \
+                    ('DoesNotExist', 'AttributeError'))
+        # the connection is still fine
+        self.assertTrue(proxy.register_client())
+        proxy.close()
+
+    def test_wire(self):
+        '''
+        Rows and changes in the compact format, compressed or not
+        '''
+        rows = [u'r0', u'', u'r\xe9'] + [u'row %i' % i for i in xrange(5000)]
+        changes = {'revision': 3, 'row_count': 7, 'full': False,
+            'rows': [(0, u'a'), (5, u'\xe9')],
+            'deltas': [(2, [1, 4, u'xyz', 1234])]}
+        for compress_above in (None, 0):
+            data = wire.encode(rows, compress_above)
+            self.assertEqual(wire.decode(data), rows)
+            self.assertEqual(wire.decode(wire.encode(changes,
+                compress_above)), changes)
+        self.assertTrue(len(wire.encode(rows)) < len(wire.encode(rows, None)))
+        del changes['deltas']
+        self.assertEqual(wire.decode(wire.encode(changes)), changes)
+        self.assertEqual(wire.decode(wire.encode([])), [])
+        self.assertRaises(ValueError, wire.encode, [u'a\nb'])
+
+    def test_negotiate(self):
+        '''
+        The same results with the compact format or JSON
+        '''
+        results = []
+        for compact in (True, False):
+            proxy = FramedProxy(self.address, compact)
+            self.assertEqual(proxy.format, compact and wire.FORMAT or None)
+            client0 = proxy.register_client()
+            document0 = proxy.new_document(client0)
+            proxy.write_document(client0, document0, 0, u'r0\nr\xe9\nr2')
+            results.append((
+                proxy.get_document_snapshot(client0, document0),
+                proxy.get_document_rows(client0, document0, 1, 3),
+                proxy.get_changes_since(client0, document0, 0, True)))
+            proxy.close()
+        self.assertEqual(results[0][:2], results[1][:2])
+        for changes in (results[0][2], results[1][2]):
+            changes['rows'] = [tuple(row) for row in changes['rows']]
+        self.assertEqual(results[0][2], results[1][2])
+
+    def test_many_connections(self):
+        '''
+        One thread serving many connections
+        '''
+        proxies = [FramedProxy(self.address) for i in xrange(200)]
+        uids = [proxy.register_client() for proxy in proxies]
+        self.assertEqual(len(set(uids)), len(proxies))
+        self.assertEqual(self.framed.connections(), len(proxies))
+        for proxy in proxies:
+            proxy.close()
+
+    def test_disk_calls(self):
+        '''
+        A call loading a document runs out of the loop: other connections
+        are served meanwhile, and the next call of its connection waits
+        '''
+        path = tempfile.mkdtemp()
+        storage = Storage(path)
+        loading = threading.Event()
+        loaded = threading.Event()
+        def load(document):
+            loading.set()
+            loaded.wait()
+            return Storage.load(storage, document)
+        storage.load = load
+        server = Server(storage, max_documents=1)
+        client0 = server.register_client()
+        document0 = server.new_document(client0)
+        server.write_document(client0, document0, 0, 'saved')
+        server.new_document(client0) # document0 leaves the memory
+        self.tearDown()
+        self.server = server
+        self.framed = FramedServer(server, ('127.0.0.1', 0))
+        self.thread = threading.Thread(target=self.framed.serve_forever)
+        self.thread.start()
+
+        slow = FramedProxy(self.framed.address)
+        rows = []
+        reader = threading.Thread(target=lambda: rows.append(
+            slow.get_document_row(client0, document0, 0)))
+        reader.start()
+        loading.wait()
+        proxy = FramedProxy(self.framed.address)
+        self.assertTrue(proxy.register_client())
+        loaded.set()
+        reader.join()
+        self.assertEqual(rows, ['saved'])
+        self.assertTrue(slow.register_client())
+        slow.close()
+        proxy.close()
+        storage.close()
+        shutil.rmtree(path)
+
+    def test_unix_socket(self):
+        '''
+        Serve on a Unix socket
+        '''
+        self.tearDown()
+        path = tempfile.mktemp()
+        self._start(path)
+        proxy = FramedProxy(path)
+        self.assertTrue(proxy.register_client())
+        proxy.close()
+        os.remove(path)
+
+
+class TestShards(unittest.TestCase):
+    '''
+    Test many server processes with a router
+    '''
+    SHARDS = 3
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.processes, self.addresses = \
+            start_workers(self.SHARDS, self.directory)
+        self.router = ShardRouter(self.addresses)
+
+    def tearDown(self):
+        self.router.close()
+        for process in self.processes:
+            process.terminate()
+            process.join()
+        shutil.rmtree(self.directory)
+
+    def test_ring(self):
+        '''
+        Uids are spread by all shards, always in the same shard
+        '''
+        ring = HashRing(self.SHARDS)
+        uids = [u'D%i' % i for i in xrange(300)]
+        shards = [ring.shard_of(uid) for uid in uids]
+        for shard in xrange(self.SHARDS):
+            self.assertTrue(shards.count(shard) > 50)
+        self.assertEqual(shards, [HashRing(self.SHARDS).shard_of(uid) \
+            for uid in uids])
+
+    def test_new_document(self):
+        '''
+        New documents go to the shard with less documents
+        '''
+        router = self.router
+        client0 = router.register_client()
+        for i in xrange(2 * self.SHARDS):
+            router.new_document(client0)
+        for address in self.addresses:
+            proxy = FramedProxy(address)
+            self.assertEqual(proxy.get_cache_stats()['documents'], 2)
+            proxy.close()
+
+    def test_route(self):
+        '''
+        Calls go to the shard of the document
+        '''
+        router = self.router
+        client0 = router.register_client()
+        document0 = router.new_document(client0)
+        router.write_document(client0, document0, 0, 'r0\nr1')
+        self.assertEqual(router.get_document_snapshot(client0, document0),
+            ['r0', 'r1'])
+        self.assertEqual(router.execute_batch(client0, [
+            ('lock_write', document0, 1, 'changed'),
+            ('read', document0, 1)]), [True, 'changed'])
+
+        shard = HashRing(self.SHARDS).shard_of(document0)
+        proxy = FramedProxy(self.addresses[shard])
+        self.assertEqual(proxy.get_document_row(client0, document0, 1),
+            'changed')
+        proxy.close()
+
+    def test_stats(self):
+        '''
+        Stats of every shard, summed
+        '''
+        router = self.router
+        client0 = router.register_client()
+        for i in xrange(self.SHARDS):
+            document = router.new_document(client0)
+            router.lock_document(client0, document, 0)
+        self.assertEqual(router.get_lease_stats()['leases'], self.SHARDS)
+        stats = router.get_stats()
+        self.assertEqual(stats['leases']['leases'], self.SHARDS)
+        self.assertEqual(stats['cache']['documents'], self.SHARDS)
+        self.assertEqual(len(stats['shards']), self.SHARDS)
+
+    def test_import(self):
+        '''
+        The calls of an import go to the shard of its document
+        '''
+        router = self.router
+        client0 = router.register_client()
+        documents = [router.new_document(client0) \
+            for i in xrange(2 * self.SHARDS)]
+        for i, document in enumerate(documents):
+            import_uid = router.begin_import(client0, document)
+            self.assertEqual(router.append_rows(client0, import_uid,
+                ['a%i' % i, 'b']), 2)
+            router.commit_import(client0, import_uid)
+            self.assertEqual(router.get_document_snapshot(client0, document),
+                ['a%i' % i, 'b'])
+        import_uid = router.begin_import(client0, documents[0])
+        router.abort_import(client0, import_uid)
+        self.assertRaises(RemoteError, router.append_rows, client0,
+            import_uid, ['c'])
+
+    def test_cross_shard_batch(self):
+        '''
+        A batch cannot change documents of two shards
+        '''
+        router = self.router
+        client0 = router.register_client()
+        documents = {}
+        while len(documents) < 2:
+            document = router.new_document(client0)
+            documents[HashRing(self.SHARDS).shard_of(document)] = document
+        document0, document1 = documents.values()[:2]
+        self.assertRaises(ShardRouter.CrossShardBatch, router.execute_batch,
+            client0, [('write', document0, 0, 'a'),
+                ('write', document1, 0, 'b')])
+
+
+class TestDocumentEdit(unittest.TestCase):
+    '''
+    Test document's editor methods
+    '''
+
+    def setUp(self):
+        server = Server()
+        server = server
+        client0 = server.register_client()
+        client1 = server.register_client()
+
+        # document with 2 lines
+        document0 = server.new_document(client0)
+        server.write_document(client0, document0, 0, 'row 000\nrow 001')
+
+        server.open_document(client1, document0)
+
+        self.server = server
+        self.client0 = client0
+        self.client1 = client1
+        self.document = document0
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_edit_different_paragraphs(self):
+        '''
+        Lock different paragraphs to update, by 2 different users
+        '''
+        server = self.server
+        client0 = self.client0
+        client1 = self.client1
+        document0 = self.document
+
+        server.lock_document(client0, document0, 0) # lock document0, row 0
+        server.lock_document(client0, document0, 1) # lock document0, row 1
+
+        server.write_document(client0, document0, 0, 'changed row 0')
+        server.write_document(client1, document0, 1, 'changed row 1')
+
+        # write clear the lock, let's check
+        server.lock_document(client0, document0, 1) # ok, no exception
+
+    def test_commit_rows(self):
+        '''
+        Write many rows and unlock in one call
+        '''
+        server = self.server
+        client0 = self.client0
+        client1 = self.client1
+        document0 = self.document
+
+        server.lock_document(client1, document0, 1)
+        written = server.commit_rows(client0, document0,
+            [(0, 'changed row 0'), (1, 'changed row 1')], [0])
+        self.assertEqual(written, [True, False])
+        self.assertEqual(
+            server.get_document_snapshot(client0, document0),
+            ['changed row 0', 'row 001'])
+        # row 0 is unlocked
+        self.assertTrue(server.lock_document(client1, document0, 0))
+
+    def test_execute_batch(self):
+        '''
+        Many operations, of 2 documents, in one call
+        '''
+        server = self.server
+        client0 = self.client0
+        client1 = self.client1
+        document0 = self.document
+        document1 = server.new_document(client1)
+
+        server.lock_document(client1, document0, 1)
+        results = server.execute_batch(client0, [
+            ('lock_write', document0, 0, 'changed row 0'),
+            ('lock', document0, 1),
+            ('write', document1, 0, 'a\nb'),
+            ('read', document0, 0),
+            ('rows', document1, 0, 2),
+            ('row_count', document1),
+            ('unlock', document0, 0),
+            ('unlock', document0, 1),
+        ])
+        self.assertEqual(results[:2], [True, False])
+        self.assertEqual(results[3:], ['changed row 0', ['a', 'b'], 2,
+            True, False])
+
+    def test_execute_batch_invalid(self):
+        '''
+        Unknown operations: nothing is done
+        '''
+        server = self.server
+        try:
+            server.execute_batch(self.client0, [
+                ('write', self.document, 0, 'changed'),
+                ('drop', self.document),
+            ])
+            self.failIf(True)
+        except Server.InvalidOperation:
+            pass
+        self.assertEqual(
+            server.get_document_row(self.client0, self.document, 0),
+            'row 000')
+
+    def test_execute_batch_arguments(self):
+        '''
+        Wrong arguments: nothing is done, not even the locks. A missing row
+        is read as None.
+        '''
+        server = self.server
+        client0 = self.client0
+        for bad in [('read', self.document), ('write', self.document, 0),
+                ('rows', self.document, 0, '2'),
+                ('write_delta', self.document, 0, [0, 1])]:
+            self.assertRaises(Server.InvalidOperation, server.execute_batch,
+                client0, [('lock_write', self.document, 0, 'changed'), bad])
+        self.assertEqual(server.get_document_row(client0, self.document, 0),
+            'row 000')
+        self.assertTrue(server.lock_and_write_document(self.client1,
+            self.document, 0, 'other'))
+        self.assertEqual(server.execute_batch(client0, [
+            ('lock', self.document, 1),
+            ('read', self.document, 1000),
+        ]), [True, None])
+        self.assertEqual(server.get_lease_stats()['leases'], 2)
+
+    def test_edit_same_paragraph(self):
+        '''
+        2 users try to edit the same paragraph, at same time
+        '''
+        server = self.server
+        client0 = self.client0
+        client1 = self.client1
+        document0 = self.document
+
+        server.lock_document(client0, document0, 0) # lock document0, row 0
+        self.failIf(
+            # lock document0, row 0
+            server.lock_document(client1, document0, 0)
+        )
+
+    def test_edit_same_paragraph_same_user(self):
+        '''
+        1 users try to get 2x the same paragraph
+        '''
+        server = self.server
+        client0 = self.client0
+        document0 = self.document
+
+        server.lock_document(client0, document0, 0) # lock document0, row 0
+        self.assertTrue(
+            # lock document0, row 0
+            server.lock_document(client0, document0, 0)
+        )
+
+class TestRowStore(unittest.TestCase):
+    '''
+    Test the chunked row storage used by documents
+    '''
+    def setUp(self):
+        # small chunks, to split and merge a lot
+        self.store = RowStore()
+        self.store.CHUNK = 4
+
+    def test_list_behaviour(self):
+        '''
+        Same result as a list after random edits
+        '''
+        store = self.store
+        rows = []
+        rand = random.Random(0)
+        for i in xrange(500):
+            start = rand.randint(0, len(rows))
+            stop = start + rand.randint(0, 3)
+            new = ['r%i' % i] * rand.randint(0, 5)
+            rows[start:stop] = new
+            store.splice(start, stop, new)
+            self.assertEqual(len(store), len(rows))
+        self.assertEqual(store, rows)
+        self.assertEqual(store[3:17], rows[3:17])
+        self.assertEqual(store[-1], rows[-1])
+
+    def test_group_rows(self):
+        '''
+        Contiguous row indexes become ranges
+        '''
+        self.assertEqual(group_rows([0, 1, 2, 5, 7, 8]),
+            [(0, 3), (5, 6), (7, 9)])
+        self.assertEqual(group_rows([]), [])
+
+    def test_packed(self):
+        '''
+        Packed chunks give the rows back as they were, and can be changed
+        '''
+        rows = [u'caf\xe9', u'', u'row %i' % 2] * 5
+        store = RowStore(rows)
+        store.CHUNK = 4
+        self.assertEqual(store, rows)
+        self.assertEqual(type(store[0]), unicode)
+        store.splice(1, 2, [u'new', u'rows'])
+        rows[1:2] = [u'new', u'rows']
+        store.compact()
+        self.assertEqual(store, rows)
+        self.assertEqual(store[2:5], rows[2:5])
+
+        # str rows stay str; a mix of str and unicode is not packed
+        self.assertEqual(type(RowStore(['a', 'b'])[1]), str)
+        self.assertEqual(list(RowStore(['\xff', u'b'])), ['\xff', u'b'])
+
+    def test_freeze(self):
+        '''
+        A frozen copy does not see later changes
+        '''
+        store = RowStore(['r%i' % i for i in xrange(20)])
+        store.CHUNK = 4
+        store.splice(2, 3, ['a', 'b'])
+        frozen = store.freeze()
+        store.splice(0, 10, ['x'])
+        store[5] = 'y'
+        self.assertEqual(frozen, ['r0', 'r1', 'a', 'b'] +
+            ['r%i' % i for i in xrange(3, 20)])
+        self.assertEqual(len(store), 12)
+
+    def test_index_error(self):
+        '''
+        Read a row after the end
+        '''
+        store = self.store
+        store.insert(0, ['r0', 'r1'])
+        try:
+            store[2]
+            self.failIf(True)
+        except IndexError:
+            pass
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,395 @@
+'''
+A single thread transport to the Server methods, an alternative to the Pyro
+daemon (one thread per connection). One asyncore loop keeps thousands of
+connections, on TCP or on a Unix socket.
+
+Protocol: frames of a 4 bytes length (big endian) and a JSON payload.
+    request:  [call id, method name, [arguments]]
+    response: [call id, true, result] or [call id, false, [error, message]]
+A connection can ask for the compact format (see wire.py) calling
+"_negotiate" with the formats it knows. After that, results of wire.METHODS
+go in binary frames: the length has the BINARY bit, the payload is the call
+id (4 bytes) and the encoded result.
+Results of wire.METHODS are encoded once if many calls get the same result
+object (viewers of a document: see Server.open_document).
+Calls that can wait for the disk (server._may_block) run in worker threads,
+not in the loop; the next calls of their connection wait for them.
+'''
+import os
+import json
+import Queue
+import threading
+import collections
+import select
+import socket
+import struct
+import asyncore
+import logging
+
+import wire
+
+LOG = logging.Logger(name="transport")
+LOG.addHandler(logging.NullHandler())
+
+HEADER = struct.Struct('>I')
+MAX_FRAME = 64 * 1024 * 1024 # bytes
+BINARY = 0x80000000 # in the length of binary frames
+RESULT_CACHE = 32 # encoded results kept, see ResultCache
+WORKERS = 4 # threads running the calls that can wait for the disk
+NEGOTIATE = '_negotiate' # not a server method: choose the wire format
+
+# methods that block (and would stop every connection) or need callbacks
+BLOCKING = frozenset([
+    'wait_for_changes', 'wait_for_operations', 'subscribe'])
+# methods for the process running the server, not for its clients
+LOCAL = frozenset(['close'])
+
+
+class RemoteError(Exception):
+    '''
+    An exception raised by the server: args are (name, message)
+    '''
+    pass
+
+
+def _dumps(value):
+    return json.dumps(value, separators=(',', ':'))
+
+
+def encode_frame(payload):
+    data = _dumps(payload)
+    return HEADER.pack(len(data)) + data
+
+
+def encode_result_frame(call_id, data):
+    '''
+    Like encode_frame([call_id, True, result]), with the result encoded
+    '''
+    data = '[%s,true,%s]' % (_dumps(call_id), data)
+    return HEADER.pack(len(data)) + data
+
+
+def encode_binary_frame(call_id, data):
+    return HEADER.pack(BINARY | (HEADER.size + len(data))) + \
+        HEADER.pack(call_id) + data
+
+
+def _error_frame(call_id, exp):
+    LOG.debug('Call %s failed: %r' % (call_id, exp))
+    return encode_frame([call_id, False, [type(exp).__name__, str(exp)]])
+
+
+def _exposed(name):
+    return not name.startswith('_') and name not in BLOCKING and \
+        name not in LOCAL
+
+
+class ResultCache(object):
+    '''
+    The last results encoded, by result object (kept, so its id is not
+    reused): a result the server shares between calls is encoded once
+    '''
+    def __init__(self, size=RESULT_CACHE):
+        self._size = size
+        self._results = collections.OrderedDict() # (id, kind): (result, data)
+        self._lock = threading.Lock() # the loop and the workers use it
+        self.hits = 0
+
+    def encode(self, result, kind, encode):
+        key = (id(result), kind)
+        with self._lock:
+            entry = self._results.pop(key, None)
+            if entry is not None and entry[0] is result:
+                self.hits += 1
+                self._results[key] = entry
+                return entry[1]
+        entry = (result, encode(result)) # out of the lock: it can be big
+        with self._lock:
+            self._results[key] = entry
+            if len(self._results) > self._size:
+                self._results.popitem(last=False)
+        return entry[1]
+
+
+class _Wakeup(asyncore.file_dispatcher):
+    '''
+    The read end of a pipe in the loop: workers write to wake it up, and
+    their responses are sent from the loop
+    '''
+    def __init__(self, map_, poller):
+        read, self._write = os.pipe()
+        asyncore.file_dispatcher.__init__(self, read, map=map_)
+        os.close(read) # file_dispatcher has a copy
+        self._poller = poller
+        self._done = collections.deque() # (connection, response frame)
+        if poller is not None:
+            poller.register(self._fileno, select.EPOLLIN)
+
+    def done(self, connection, response):
+        # from a worker thread
+        self._done.append((connection, response))
+        os.write(self._write, 'x')
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+        while self._done:
+            connection, response = self._done.popleft()
+            connection.called(response)
+
+    def close(self):
+        if self._poller is not None and self._fileno is not None:
+            self._poller.unregister(self._fileno)
+        asyncore.file_dispatcher.close(self)
+        os.close(self._write)
+
+
+class Connection(asyncore.dispatcher):
+
+    def __init__(self, sock, server, map_, poller=None, results=None,
+            workers=None):
+        asyncore.dispatcher.__init__(self, sock, map=map_)
+        self._server = server
+        self._poller = poller
+        self._results = results # a ResultCache shared by connections
+        self._workers = workers # Queue of the calls to run in a worker
+        self._busy = False # a call of this connection is in a worker
+        self._in = ''
+        self._out = ''
+        self._wire = False # results of wire.METHODS in binary frames
+        if poller is not None:
+            poller.register(self._fileno, select.EPOLLIN)
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if not data:
+            return
+        self._in += data
+        self._process()
+
+    def _process(self):
+        while not self._busy and len(self._in) >= HEADER.size:
+            size, = HEADER.unpack_from(self._in)
+            if size > MAX_FRAME:
+                LOG.warning('Frame too big (%i bytes), closing' % size)
+                self.close()
+                return
+            if len(self._in) < HEADER.size + size:
+                break
+            frame = self._in[HEADER.size:HEADER.size + size]
+            self._in = self._in[HEADER.size + size:]
+            self._start(frame)
+        self._watch()
+
+    def _start(self, frame):
+        try:
+            call_id, name, args = json.loads(frame)
+        except Exception, exp:
+            self._out += _error_frame(None, exp)
+            return
+        may_block = getattr(self._server, '_may_block', None)
+        if self._workers is not None and may_block is not None and \
+                _exposed(name) and may_block(name, args):
+            self._busy = True
+            self._workers.put((self, call_id, name, args))
+        else:
+            self._out += self._call(call_id, name, args)
+
+    def called(self, response):
+        '''
+        The response of a call run in a worker (in the loop)
+        '''
+        self._busy = False
+        if not self.connected:
+            return
+        self._out += response
+        self._process()
+
+    def _watch(self):
+        # epoll: wait to write only when there is something to write
+        if self._poller is not None and self.connected:
+            events = select.EPOLLIN
+            if self._out:
+                events |= select.EPOLLOUT
+            self._poller.modify(self._fileno, events)
+
+    def _call(self, call_id, name, args):
+        '''
+        Run a request: the response frame
+        '''
+        try:
+            if name == NEGOTIATE:
+                self._wire = wire.FORMAT in args[0]
+                return encode_frame([call_id, True,
+                    self._wire and wire.FORMAT or None])
+            if not _exposed(name):
+                raise AttributeError('%s is not available' % name)
+            result = getattr(self._server, name)(*args)
+        except Exception, exp:
+            return _error_frame(call_id, exp)
+        if name not in wire.METHODS:
+            return encode_frame([call_id, True, result])
+        if self._wire and isinstance(call_id, (int, long)):
+            return encode_binary_frame(call_id,
+                self._encode(result, 'wire', wire.encode))
+        return encode_result_frame(call_id,
+            self._encode(result, 'json', _dumps))
+
+    def _encode(self, result, kind, encode):
+        if self._results is None:
+            return encode(result)
+        return self._results.encode(result, kind, encode)
+
+    def writable(self):
+        return bool(self._out)
+
+    def handle_write(self):
+        sent = self.send(self._out)
+        self._out = self._out[sent:]
+        if not self._out:
+            self._watch()
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        if self._poller is not None and self._fileno is not None:
+            self._poller.unregister(self._fileno)
+        asyncore.dispatcher.close(self)
+
+
+class FramedServer(asyncore.dispatcher):
+    '''
+    Listen on a (host, port) address or a Unix socket path.
+    Calls for which server._may_block(name, args) is true run in workers.
+    '''
+    def __init__(self, server, address, backlog=1024, workers=WORKERS):
+        self._map = {}
+        asyncore.dispatcher.__init__(self, map=self._map)
+        self._server = server
+        self._running = True # until stop()
+        self.results = ResultCache()
+        # epoll watches only what changed; asyncore polls every socket
+        self._poller = None
+        if hasattr(select, 'epoll'):
+            self._poller = select.epoll()
+        self._wakeup = _Wakeup(self._map, self._poller)
+        self._calls = Queue.Queue() # (connection, call id, name, args)
+        self._workers = []
+        for i in xrange(workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._workers.append(thread)
+        if isinstance(address, basestring):
+            if os.path.exists(address):
+                os.remove(address)
+            self.create_socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.set_reuse_addr()
+        self.bind(address)
+        self.listen(backlog)
+        self.address = self.socket.getsockname()
+        if self._poller is not None:
+            self._poller.register(self._fileno, select.EPOLLIN)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            Connection(pair[0], self._server, self._map, self._poller,
+                self.results, self._workers and self._calls or None)
+
+    def _work(self):
+        while True:
+            call = self._calls.get()
+            if call is None:
+                break
+            connection = call[0]
+            self._wakeup.done(connection, connection._call(*call[1:]))
+
+    def connections(self):
+        return len(self._map) - 2 # not the listener nor the wakeup
+
+    def serve_forever(self):
+        while self._running:
+            if self._poller is None:
+                # poll(): select() cannot watch more than 1024 sockets
+                asyncore.loop(timeout=0.1, use_poll=True, map=self._map,
+                    count=1)
+                continue
+            try:
+                events = self._poller.poll(0.1)
+            except IOError: # EINTR
+                continue
+            for fileno, flags in events:
+                dispatcher = self._map.get(fileno)
+                if dispatcher is not None:
+                    asyncore.readwrite(dispatcher, flags)
+        for thread in self._workers:
+            self._calls.put(None)
+        for thread in self._workers:
+            thread.join()
+        for dispatcher in self._map.values():
+            dispatcher.close()
+        if self._poller is not None:
+            self._poller.close()
+
+    def stop(self):
+        '''
+        Stop serve_forever (from another thread) and close everything
+        '''
+        self._running = False
+
+
+class FramedProxy(object):
+    '''
+    Blocking client: call server methods like a Pyro proxy.
+    With compact, rows come in the wire format (if the server knows it).
+    '''
+    def __init__(self, address, compact=True):
+        if isinstance(address, basestring):
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        else:
+            self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._socket.connect(address)
+        self._address = address
+        self._call_id = 0
+        self.format = None # the wire format negotiated
+        if compact:
+            try:
+                self.format = self._call(NEGOTIATE, [[wire.FORMAT]])
+            except RemoteError:
+                pass # an older server
+
+    def _recv(self, size):
+        data = ''
+        while len(data) < size:
+            chunk = self._socket.recv(size - len(data))
+            if not chunk:
+                raise IOError('Connection closed by the server')
+            data += chunk
+        return data
+
+    def _call(self, name, args):
+        self._call_id += 1
+        self._socket.sendall(encode_frame([self._call_id, name, args]))
+        size, = HEADER.unpack(self._recv(HEADER.size))
+        if size & BINARY:
+            data = self._recv(size & ~BINARY)
+            return wire.decode(data[HEADER.size:])
+        call_id, ok, result = json.loads(self._recv(size))
+        if not ok:
+            raise RemoteError(*result)
+        return result
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda *args: self._call(name, list(args))
+
+    def close(self):
+        self._socket.close()
@@ -0,0 +1,120 @@
+'''
+A compact format for the big results: rows and changes of documents.
+Rows go in blocks (count of rows, length in bytes, the UTF-8 rows joined
+by "\n": rows never have one), with no per-row overhead of a generic
+serializer, and zlib compression above a size.
+
+    payload: flags (1 byte: 1 if compressed), kind (1 byte), body
+    'R' rows:    block of rows
+    'C' changes: revision, row count, full, has deltas,
+                 row indexes + block of rows,
+                 [deltas: (row, start, end, checksum) each + block of texts]
+
+A transport uses it only if both sides have the same FORMAT (negotiated).
+'''
+import zlib
+import struct
+
+FORMAT = 'rows/1'
+COMPRESS_ABOVE = 16384 # bytes
+COMPRESS_LEVEL = 1 # fast: most of the gain with a small cost
+
+# results sent in this format
+METHODS = frozenset(['get_document_rows', 'get_document_snapshot',
+    'get_changes_since'])
+
+_COUNT = struct.Struct('>I')
+_BLOCK = struct.Struct('>II')
+_CHANGES = struct.Struct('>iIBB')
+_COMPRESSED = 1
+
+
+def _ints(values):
+    return _COUNT.pack(len(values)) + struct.pack('>%iI' % len(values),
+        *values)
+
+
+def _unints(data, offset):
+    count, = _COUNT.unpack_from(data, offset)
+    offset += _COUNT.size
+    values = struct.unpack_from('>%iI' % count, data, offset)
+    return values, offset + 4 * count
+
+
+def _block(texts):
+    data = u'\n'.join(texts).encode('utf-8')
+    if data.count('\n') != max(len(texts) - 1, 0):
+        raise ValueError('A row with a new line')
+    return _BLOCK.pack(len(texts), len(data)) + data
+
+
+def _unblock(data, offset):
+    count, size = _BLOCK.unpack_from(data, offset)
+    offset += _BLOCK.size
+    if not count:
+        return [], offset + size
+    return data[offset:offset + size].decode('utf-8').split(u'\n'), \
+        offset + size
+
+
+def _encode_changes(changes):
+    has_deltas = 'deltas' in changes
+    parts = [_CHANGES.pack(changes['revision'], changes['row_count'],
+        changes['full'], has_deltas)]
+    rows = changes['rows']
+    parts.append(_ints([row for row, text in rows]))
+    parts.append(_block([text for row, text in rows]))
+    if has_deltas:
+        deltas = changes['deltas']
+        values = []
+        for row, delta in deltas:
+            values.extend((row, delta[0], delta[1], delta[3]))
+        parts.append(_ints(values))
+        parts.append(_block([delta[2] for row, delta in deltas]))
+    return ''.join(parts)
+
+
+def _decode_changes(data, offset):
+    revision, row_count, full, has_deltas = _CHANGES.unpack_from(data,
+        offset)
+    offset += _CHANGES.size
+    rows, offset = _unints(data, offset)
+    texts, offset = _unblock(data, offset)
+    changes = {
+        'revision': revision,
+        'row_count': row_count,
+        'full': bool(full),
+        'rows': zip(rows, texts),
+    }
+    if has_deltas:
+        values, offset = _unints(data, offset)
+        texts, offset = _unblock(data, offset)
+        deltas = []
+        for i, text in enumerate(texts):
+            row, start, end, crc = values[4 * i:4 * i + 4]
+            deltas.append((row, [start, end, text, crc]))
+        changes['deltas'] = deltas
+    return changes
+
+
+def encode(result, compress_above=COMPRESS_ABOVE):
+    '''
+    Rows (a list) or changes (a dict, see Server.get_changes_since)
+    '''
+    if isinstance(result, dict):
+        body = 'C' + _encode_changes(result)
+    else:
+        body = 'R' + _block(result)
+    if compress_above is not None and len(body) > compress_above:
+        return chr(_COMPRESSED) + zlib.compress(body, COMPRESS_LEVEL)
+    return chr(0) + body
+
+
+def decode(data):
+    flags = ord(data[0])
+    body = data[1:]
+    if flags & _COMPRESSED:
+        body = zlib.decompress(body)
+    if body[0] == 'C':
+        return _decode_changes(body, 1)
+    return _unblock(body, 1)[0]